@@ -0,0 +1,1451 @@
+# -*- coding: utf-8 -*-
+"""
+Numerical core of PRINSAS 2.0: reading SAS data files, calculating the PDSP
+kernel and fitting the PDSP model. This module does not import matplotlib or
+Qt, so worker processes and scripts can use it without loading the GUI stack.
+"""
+
+import os
+import csv
+import hashlib
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+import scipy.interpolate as sci_interp
+import scipy.linalg as sci_linalg
+import scipy.optimize as sci_opt
+import scipy.sparse as sci_sparse
+import shared_kernels as sk
+import pore_models as pm
+
+# The sphere form factor and volume of the PDSP model live in pore_models with
+# the other pore models, and are re-exported here
+from pore_models import calc_Fsph, calc_Vsph
+
+
+# Number of Q grids whose kernels (and smearing matrices) are kept in memory.
+# Kernels may be calculated in background threads (see file_prefetch), the
+# lock guards the cache
+kernel_cache_size = 16
+kernel_cache = collections.OrderedDict()
+kernel_cache_lock = threading.Lock()
+
+# Number of r_i per block of the kernel calculation. Blocks bound the memory
+# of the (subinterval, r_i, Q) arrays and are calculated in parallel threads
+kernel_block_size = 8
+
+# Number of PDSP fit results kept in memory, and the folder in which fit
+# results are also kept between sessions (None: in memory only) together with
+# the maximum number of results kept in that folder
+fit_cache_size = 32
+fit_cache = collections.OrderedDict()
+fit_cache_dir = None
+fit_cache_disk_size = 1000
+
+# Methods of estimating the errors of the PDSP result: 'heuristic' projects
+# the fit error of I(Q) onto r = 2.5/Q and scales it for the sample
+# properties, 'laplace' propagates the posterior covariance of log IQ0i from
+# the Gauss-Newton Hessian of Ξ at the optimum
+uncertainty_modes = ('heuristic', 'laplace')
+
+# Degree of the B-spline of log IQ0i in spline fits (cubic)
+spline_degree = 3
+
+
+# Function used to subtract flat background and limit the background-subtracted 
+# data to Q-max
+def subtract_background(QQ_original, IQ_original, dIQ_original, bkgrd, QQ_min, QQ_max):
+    # Subtract background and find negative IQ values
+    IQ_subtract = IQ_original - bkgrd
+    idx_IQ_negative = np.where(IQ_subtract <= 0)
+    dIQ_percent = dIQ_original/IQ_original
+    
+    # Remove negative IQ values
+    try:
+        QQ_subtract = QQ_original[:np.min(idx_IQ_negative)]
+        IQ_subtract = IQ_subtract[:np.min(idx_IQ_negative)]
+        dIQ_subtract = dIQ_percent[:np.min(idx_IQ_negative)]
+    except ValueError:
+        QQ_subtract = QQ_original
+        dIQ_subtract = dIQ_percent
+    
+    # Remove data points at Q values outside the specified Q range and return
+    select_pos = np.logical_and(QQ_min < QQ_subtract, QQ_subtract < QQ_max) 
+    QQ_trim = QQ_subtract[select_pos]
+    IQ_trim = IQ_subtract[select_pos]
+    dIQ_trim = dIQ_subtract[select_pos]
+    return QQ_trim, IQ_trim, dIQ_trim*IQ_trim
+
+
+# Function used to identify the most appropriate delimiter of the SAS data file
+def find_delimiter(data_raw):
+    # Extract all the potential dilimiters of the file
+    delim_list = []
+    for line in data_raw:
+        try:
+            delim_list.append(csv.Sniffer().sniff(line).delimiter)
+        except csv.Error: pass
+    
+    # Ensure delim_list is not empty
+    if not delim_list:
+        raise ValueError("No valid delimiters found in the data.")
+    
+    # Identify the most appropriate delimiter from the list of obtained delimiters
+    delim, count = np.unique(delim_list, return_counts=True)
+    return delim[count.argmax()]
+
+
+# Function used to read SAS data file and return the corresponding Q, IQ and 
+# dIQ values
+def read_SANS_data(dir_data):
+    # Read file content
+    with open(dir_data) as file:
+        data_raw = file.readlines()
+    return parse_SANS_data(data_raw, find_delimiter(data_raw))
+
+
+# Function used to select the data rows of the lines of a SAS data file split
+# with the delimiter found by find_delimiter. The data rows are the lines with
+# the most common number of non-negative entries. Return the entries of each
+# data row, keeping their sign
+def select_SANS_rows(data_raw, select_delim):
+    # Obtained data entries using the identified delimiters
+    data_splitted = []
+    for line in data_raw:
+        entry_selected = []
+        for entry in line.split(select_delim):
+            try: 
+                entry_selected.append(float(entry))
+            except ValueError: pass 
+        data_splitted.append(entry_selected)
+    line_len = [sum(entry >= 0 for entry in line) for line in data_splitted]
+    num_col = max(set(line_len), key=line_len.count)
+    return [line for line, num_entries in zip(data_splitted, line_len)
+            if num_entries == num_col]
+
+
+# Function used to obtain Q, IQ and dIQ from the lines of a SAS data file
+# split with the delimiter found by find_delimiter
+def parse_SANS_data(data_raw, select_delim):
+    try:
+        data_selected = np.array([[entry for entry in line if entry >= 0] 
+                                  for line in select_SANS_rows(data_raw, select_delim)])
+    except ValueError:
+        raise ValueError('Cannot read file content')
+        
+    # Check whether return result contains any data
+    if data_selected.size == 0:
+        raise ValueError('Cannot read file content')
+        
+    # Assigned and return read data to Q, IQ, and dIQ
+    if data_selected.shape[1] == 2:
+        return data_selected[:,0], data_selected[:,1], 0
+    elif data_selected.shape[1] > 2:        
+        return data_selected[:,0], data_selected[:,1], data_selected[:,2]
+
+
+# Function used to read the instrument resolution of the SAS data file. The
+# resolution is taken from the optional fourth column (sigmaQ, DX, Delta Q).
+# Following the NIST/Kookaburra convention, negative values in this column 
+# denote slit-smeared data with a slit length equal to their absolute value.
+# The data rows are selected as by read_SANS_data and sorted by Q, so dQ can be
+# interpolated onto the Q of read_SANS_data.
+# Returns (QQ, dQ, slit_length), where dQ or slit_length is None if unavailable
+def read_SANS_resolution(dir_data):
+    with open(dir_data) as file:
+        data_raw = file.readlines()
+    select_delim = find_delimiter(data_raw)
+    
+    # Keep the sign of the entries, as the sign of the resolution column 
+    # identifies slit-smeared data
+    try:
+        data_splitted = select_SANS_rows(data_raw, select_delim)
+    except ValueError:
+        return None, None, None
+    if not data_splitted or any(len(line) < 4 for line in data_splitted):
+        return None, None, None
+    
+    data_selected = np.array([line[:4] for line in data_splitted])
+    data_selected = data_selected[np.argsort(data_selected[:,0], kind = 'stable')]
+    QQ, resolution = data_selected[:,0], data_selected[:,3]
+    if np.all(resolution < 0):
+        return QQ, None, np.median(-resolution)
+    elif np.all(resolution > 0):
+        return QQ, resolution, None
+    return None, None, None
+
+
+# Check whether the dI(Q) read from the data file can be used as the
+# measurement error, otherwise percentage errors are to be used instead
+def has_valid_dIQ(QQ, IQ, dIQ):
+    return not (isinstance(dIQ, int) or len(dIQ) != len(QQ) or 
+                np.sum(dIQ/IQ) < 1e-5)
+
+
+# Return the default name of the PDSP result file of a data file
+def result_file_name(data_file_dir):
+    return (os.path.basename(data_file_dir).replace('.txt','').replace('.ABS','')
+            .replace('.dat','').replace('.csv','') + " PDSP Result.txt")
+
+
+# Return the default name of the sensitivity table file of a data file
+def sensitivity_file_name(data_file_dir):
+    return result_file_name(data_file_dir).replace(' PDSP Result.txt', ' PDSP Sensitivity.txt')
+
+
+# Write the PDSP fit result of the data file data_file_name, fitted with the 
+# parameters in params (see default_fit_parameters), into a text file
+def write_PDSP_result(save_file_dir, data_file_name, params, PDSP_result):
+    # create result table for r vs f(r), SSA(R), and dV/dr 
+    data_table = np.column_stack((PDSP_result.rr, PDSP_result.f_r[:,0], 
+                                  PDSP_result.SSA[:,0], PDSP_result.dV_dr[:,0], 
+                                  PDSP_result.IQ0_fitted[:,1]))
+    phi, Vpore_avg = PDSP_result.phi, PDSP_result.Vpore_avg
+    phi_on_Vavg, SSA_extrapolate = PDSP_result.phi_on_Vavg, PDSP_result.SSA_extrapolate
+    
+    with open(save_file_dir, 'w') as file:
+        # Write file header, including file name, background value,
+        # Q-max, contrast, solid density, porosity, average pore volume,
+        # pore concentration, extrapolated SSA
+        file.write('PDSP Fit Result for ' + data_file_name)
+        file.write('\n\n')
+        file.write('Background value (cm-1): {:.3e}'.format(params['bkgrd']))
+        file.write('\n')
+        file.write('Selected Q range (A-1): [{:.3e}, {:.3e}]'.format(params['Qmin'], params['Qmax']))
+        file.write('\n')
+        if params['dIQ_percent'] is None:
+            file.write('Measurement error dI(Q): From data')
+        else:
+            file.write('Measurement error dI(Q): {:.1f}% I(Q)'.format(params['dIQ_percent']))
+        file.write('\n')
+        file.write('Smoothing factor Lambda: {:.1e}'.format(params['lambda_']))
+        file.write('\n')
+        if params['resolution'] == 'Slit length':
+            file.write('Resolution smearing: Slit length {:.3e} A-1'.format(params['slit_length']))
+        else:
+            file.write('Resolution smearing: ' + params['resolution'])
+        file.write('\n')
+        if params.get('spline_knots') is not None:
+            file.write('Distribution: cubic B-spline of log IQ0 with {:d} knots'
+                       .format(params['spline_knots']))
+            file.write('\n')
+        if params.get('pore_model', 'sphere') != 'sphere':
+            file.write('Pore model: ' + pm.get_pore_model(params['pore_model']).name)
+            file.write('\n')
+        if params.get('uncertainty') == 'laplace':
+            file.write('Errors: propagated from the Hessian of the fit (Laplace)')
+            file.write('\n')
+        file.write('Contrast between 2 phases (cm-2): {:.3e}'.format(params['contrast']))
+        file.write('\n')
+        file.write('Density of Solid (g/cm3): {:.3f}'.format(params['density']))
+        file.write('\n\n')            
+        file.write('Porosity: {:.5e} ± {:.5e}'.format(phi[0], phi[1]*phi[0]))
+        file.write('\n')
+        file.write('Average Pore Volume (cm3): {:.3e} ± {:.3e}'.format(Vpore_avg[0], 
+                                                                       Vpore_avg[1]*Vpore_avg[0]))
+        file.write('\n')
+        file.write('Pore Concentration (cm-3): {:.3e} ± {:.3e}'.format(phi_on_Vavg[0], 
+                                                                       phi_on_Vavg[1]*phi_on_Vavg[0]))
+        file.write('\n')
+        file.write('SSA interpolated to r = {:.2f} nm (cm2/cm3): '
+                   .format(params['r_SSA_extrapolate']) +
+                   '{:.3e} ± {:.3e}'.format(SSA_extrapolate[0],
+                                            SSA_extrapolate[1]*SSA_extrapolate[0]))
+        file.write('\n\n')
+        
+        # Write result table for r vs f(r), SSA(R), and dV/dr
+        file.write('Pore size distribution table\n')
+        file.write('\t\t'.join(['r\t', 'f(r)', 'SSA\t', 'dV/dr', '% error']) + '\n')
+        [file.write('\t'.join(val if isinstance(val, str)
+                              else '{:.5e}'.format(val) 
+                              if val > 0 
+                              else '{:.4e}'.format(val) 
+                              for val in line) + '\n')
+         for line in data_table]
+
+
+# Return the default parameters of the PDSP fit, using the same names and 
+# default values as the GUI inputs.
+# dIQ_percent: percentage error of I(Q), or None to use dI(Q) from the data
+# resolution: 'None', 'dQ from data' or 'Slit length'
+# lambda_auto: None to fit with lambda_, or the method choosing λ for each data
+# file ('gcv', 'lcurve' or 'discrepancy', see lambda_selection)
+# uncertainty: method of estimating the errors, see uncertainty_modes
+# pore_model: name of the pore model of the kernel, see pore_models
+# spline_knots: None to fit log IQ0i at every r_i, or the number of knots of
+# the B-spline of log IQ0i (see PDSPFitter.fit_spline)
+def default_fit_parameters():
+    return {'bkgrd': 0, 'Qmin': 0, 'Qmax': np.inf, 'dIQ_percent': None,
+            'pts_per_dec': 10, 'lambda_': 1, 'lambda_auto': None,
+            'resolution': 'None', 'slit_length': 0,
+            'contrast': 3e10, 'density': 1, 'r_SSA_extrapolate': 0.2,
+            'num_pts_SSA_extrapolate': 7, 'major_phase': 'solid',
+            'uncertainty': 'heuristic', 'pore_model': 'sphere', 'spline_knots': None}
+
+
+# Raise an error if spline_knots is not None or a valid number of knots
+def check_spline_knots(spline_knots):
+    if spline_knots is not None and (int(spline_knots) != spline_knots or spline_knots < 2):
+        raise ValueError('Number of spline knots must be an integer >= 2')
+
+
+# Raise an error if uncertainty is not a method of estimating the errors
+def check_uncertainty_mode(uncertainty):
+    if uncertainty not in uncertainty_modes:
+        raise ValueError('Unknown uncertainty mode: ' + str(uncertainty) +
+                         '. Must be one of ' + ', '.join(uncertainty_modes))
+
+
+# This function execute the PDSP model fitting routine, detailed explanation
+# and mathematical background of the fitting routine is explained in the accompanied
+# paper. With multigrid_levels > 0 the fit is first solved on coarser r grids
+# and refined level by level, see PDSPFitter.fit_multigrid. With spline_knots,
+# log IQ0i is fitted as a B-spline with that number of knots, see
+# PDSPFitter.fit_spline. uncertainty is one of uncertainty_modes, pore_model 
+# the name of a pore model (see pore_models)
+def fit_PDSP_model(QQ, IQ, dIQ, pts_per_dec, lambda_, contrast, density_solid, 
+                   r_SSA_extrapolate, num_pts_SSA_extrapolate, major_phase,
+                   dQ = None, slit_length = None, multigrid_levels = 0,
+                   uncertainty = 'heuristic', pore_model = 'sphere', spline_knots = None):
+    check_uncertainty_mode(uncertainty)
+    check_spline_knots(spline_knots)
+    if multigrid_levels and spline_knots is not None:
+        raise ValueError('Multigrid fits are not available with a spline distribution')
+    fitter = PDSPFitter(QQ, pts_per_dec, dQ, slit_length, pore_model)
+    if spline_knots is not None:
+        IQ0_fitted, IQ_fitted = fitter.fit_spline(IQ, dIQ, lambda_, spline_knots)
+    elif multigrid_levels:
+        IQ0_fitted, IQ_fitted = fitter.fit_multigrid(IQ, dIQ, lambda_, multigrid_levels)
+    else:
+        IQ0_fitted, IQ_fitted = fitter.fit(IQ, dIQ, lambda_)
+    log_IQ0_cov = (fitter.calc_log_IQ0_covariance(np.log10(IQ0_fitted), lambda_)
+                   if uncertainty == 'laplace' else None)
+    return fitter.calc_result(IQ, dIQ, IQ0_fitted, IQ_fitted, contrast, density_solid,
+                              r_SSA_extrapolate, num_pts_SSA_extrapolate, major_phase,
+                              log_IQ0_cov)
+
+
+# Function used to fit the PDSP model through the fit cache. A fit with the
+# same data and the same value of every input is returned from the cache
+# instead of being refitted; inputs as in fit_PDSP_model
+def fit_PDSP_model_cached(QQ, IQ, dIQ, pts_per_dec, lambda_, contrast, density_solid,
+                          r_SSA_extrapolate, num_pts_SSA_extrapolate, major_phase,
+                          dQ = None, slit_length = None, multigrid_levels = 0,
+                          uncertainty = 'heuristic', pore_model = 'sphere',
+                          spline_knots = None):
+    key = fit_key(QQ, IQ, dIQ, pts_per_dec, lambda_, contrast, density_solid,
+                  r_SSA_extrapolate, num_pts_SSA_extrapolate, major_phase, dQ, slit_length,
+                  multigrid_levels, uncertainty, pore_model, spline_knots)
+    PDSP_result = get_cached_fit(key)
+    if PDSP_result is None:
+        PDSP_result = fit_PDSP_model(QQ, IQ, dIQ, pts_per_dec, lambda_, contrast,
+                                     density_solid, r_SSA_extrapolate,
+                                     num_pts_SSA_extrapolate, major_phase, dQ, slit_length,
+                                     multigrid_levels, uncertainty, pore_model, spline_knots)
+        cache_fit(key, PDSP_result)
+    return PDSP_result
+
+
+# Return the hash identifying a PDSP fit by its data and all of its inputs
+def fit_key(QQ, IQ, dIQ, pts_per_dec, lambda_, contrast, density_solid,
+            r_SSA_extrapolate, num_pts_SSA_extrapolate, major_phase,
+            dQ = None, slit_length = None, multigrid_levels = 0,
+            uncertainty = 'heuristic', pore_model = 'sphere', spline_knots = None):
+    inputs = [pts_per_dec, lambda_, contrast, density_solid,
+              r_SSA_extrapolate, num_pts_SSA_extrapolate]
+    if multigrid_levels:
+        inputs.append(multigrid_levels)
+    key = hash_arrays(QQ, IQ, dIQ, dQ, slit_length, inputs) + '_' + major_phase
+    if pore_model != 'sphere':
+        key += '_' + pm.get_pore_model(pore_model).name.replace(':', '-')
+    if spline_knots is not None:
+        check_spline_knots(spline_knots)
+        key += '_spline{:d}'.format(int(spline_knots))
+    return key if uncertainty == 'heuristic' else key + '_' + uncertainty
+
+
+# Return the cached PDSP result of the given fit key, looking in memory first
+# and then in the fit cache folder, or None if the fit has not been cached.
+# Files written without the pore model of the result are not used
+def get_cached_fit(key):
+    if key in fit_cache:
+        fit_cache.move_to_end(key)
+        return fit_cache[key]
+    if fit_cache_dir is None:
+        return None
+    cache_file = os.path.join(fit_cache_dir, key + '.npz')
+    try:
+        with np.load(cache_file) as cached:
+            PDSP_result = PDSPResult(cached['block'], *cached['shape'],
+                                     cached['log_IQ0_cov'] if 'log_IQ0_cov' in cached.files
+                                     else None, str(cached['pore_model']))
+        os.utime(cache_file)    # mark as recently used
+    except (OSError, KeyError, ValueError):
+        return None
+    cache_fit(key, PDSP_result, write_file = False)
+    return PDSP_result
+
+
+# Add a PDSP result to the fit cache, dropping the least recently used results
+# beyond fit_cache_size, and write it into the fit cache folder if set
+def cache_fit(key, PDSP_result, write_file = True):
+    fit_cache[key] = PDSP_result
+    fit_cache.move_to_end(key)
+    if len(fit_cache) > fit_cache_size:
+        fit_cache.popitem(last = False)
+    if fit_cache_dir is None or not write_file:
+        return
+
+    # Written under a temporary name and renamed, so other sessions sharing
+    # the folder never read a partially written result. The least recently
+    # used results beyond fit_cache_disk_size are removed. The pore model and
+    # the covariance of log IQ0i of 'laplace' results are kept, so the result
+    # is read back with its pore shape and errors. A result that cannot be
+    # written is only kept in memory, like a miss of the fit cache folder
+    cache_file = os.path.join(fit_cache_dir, key + '.npz')
+    tmp_file = cache_file + '.{:d}.tmp.npz'.format(os.getpid())
+    arrays = {'block': PDSP_result.block,
+              'shape': [len(PDSP_result.rr), len(PDSP_result.IQ_fitted)],
+              'pore_model': PDSP_result.pore_model}
+    if PDSP_result.log_IQ0_cov is not None:
+        arrays['log_IQ0_cov'] = PDSP_result.log_IQ0_cov
+    try:
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, cache_file)
+        cache_files = [entry for entry in os.scandir(fit_cache_dir)
+                       if entry.name.endswith('.npz') and '.tmp' not in entry.name]
+        if len(cache_files) > fit_cache_disk_size:
+            cache_files.sort(key = lambda entry: entry.stat().st_mtime)
+            for entry in cache_files[:len(cache_files) - fit_cache_disk_size]:
+                os.remove(entry.path)
+    except OSError:
+        pass
+
+
+# Set the folder in which PDSP fit results are kept between sessions, or None
+# to keep them in memory only
+def set_fit_cache_dir(cache_dir):
+    global fit_cache_dir
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok = True)
+    fit_cache_dir = cache_dir
+
+
+# Class holding the r grid, the kernel, the fit weights and the workspace of
+# the PDSP fit for one Q grid. Data sets measured on the same Q grid can be
+# fitted repeatedly with the same PDSPFitter without recalculating the kernel.
+# The workspace is reused between objective evaluations, so each PDSPFitter
+# should only be used by one thread at a time.
+class PDSPFitter:
+    def __init__(self, QQ, pts_per_dec, dQ = None, slit_length = None,
+                 pore_model = 'sphere'):
+        # Check the input Q range, if it is shorter than 1 decade, return error
+        if len(QQ) < 5 or np.log10(np.max(QQ)/np.min(QQ)) < 1:
+            raise ValueError('Input Q range must span at least 1 decade and contain at least 5 data points')
+        self.QQ = np.asarray(QQ, dtype = float)
+        self.pts_per_dec = pts_per_dec
+        self.dQ = dQ
+        self.slit_length = slit_length
+        self.pore_model = pore_model
+        
+        # Determining the log distance between each r value based on the number
+        # of values per decade required for the result
+        self.logR_del = 1/pts_per_dec
+        logR_del = self.logR_del
+        
+        # Determining the r range of the result
+        self.logR_1D, self.non_extplted_pos = calc_r_grid(self.QQ, logR_del)
+        self.R_1D = 10**self.logR_1D
+    
+        # Determine the fraction value in Equation (2) for each pair of Q and r_i,
+        # smeared by the instrument resolution if dQ or slit_length is given,
+        # with the form factor of the pore model
+        self.eq4_fraction_2D = get_eq4_fraction(self.logR_1D, logR_del, self.QQ,
+                                                dQ, slit_length, pore_model)
+        self.kernel_key = kernel_key(self.logR_1D, logR_del, self.QQ, dQ, slit_length,
+                                     pore_model)
+        self.init_workspace()
+        
+    # Set up the starting value positions, the roughness weights and the 
+    # workspace from the r grid and the Q grid
+    def init_workspace(self):
+        # Position of the Q value corresponding to r_i = 2.5/Q, used for the
+        # starting values of IQ0i
+        R_Q_pair_diff = np.abs(self.R_1D[:,np.newaxis] - 2.5/self.QQ[:, np.newaxis].T)
+        self.R_Q_corr_pos = np.argmin(R_Q_pair_diff, axis = 1)
+        
+        # Weights giving the least square slope of log IQ0 vs. log r, used to 
+        # normalise log IQ0 in the roughness term of the optimise function Ξ
+        self.slope_weights = calc_slope_weights(self.logR_1D)
+        
+        # Workspace reused between evaluations of the optimise function Ξ
+        self.IQ0_work = np.empty(len(self.logR_1D))
+        self.IQ_calc_work = np.empty(len(self.QQ))
+        self.log_IQ = None
+        self.chi2_weights = None
+        self.spline_basis = None
+        
+    # Return a PDSPFitter for the Q values at the positions Q_pos of this 
+    # fitter's Q grid (e.g. a narrower Q range of the same data), with the
+    # kernel sliced from this fitter's kernel instead of being recalculated. 
+    # The r grids of both fitters lie on the same lattice of log r, so the
+    # rows of the kernel are sliced exactly; for smeared kernels, the smearing
+    # across the ends of the narrower Q range is kept. The kernel is not
+    # cached or shared, so kernel_key is None
+    def sub_fitter(self, Q_pos):
+        QQ = self.QQ[Q_pos]
+        if len(QQ) < 5 or np.log10(np.max(QQ)/np.min(QQ)) < 1:
+            raise ValueError('Input Q range must span at least 1 decade and contain at least 5 data points')
+        fitter = PDSPFitter.__new__(PDSPFitter)
+        fitter.QQ = QQ
+        fitter.pts_per_dec = self.pts_per_dec
+        fitter.dQ = None if self.dQ is None else self.dQ[Q_pos]
+        fitter.slit_length = self.slit_length
+        fitter.pore_model = self.pore_model
+        fitter.logR_del = self.logR_del
+        fitter.logR_1D, fitter.non_extplted_pos = calc_r_grid(QQ, self.logR_del)
+        fitter.R_1D = 10**fitter.logR_1D
+        r_pos = np.searchsorted(np.round(self.logR_1D/self.logR_del),
+                                np.round(fitter.logR_1D/self.logR_del))
+        fitter.eq4_fraction_2D = self.eq4_fraction_2D[np.ix_(r_pos, Q_pos)]
+        fitter.kernel_key = None
+        fitter.init_workspace()
+        return fitter
+    
+    # Set the data to be fitted. log I(Q) and the χ² weights (I(Q)/dI(Q))^2/N
+    # are calculated once here rather than for every evaluation of Ξ. The 
+    # spline basis of the previous fit, if any, is cleared
+    def set_data(self, IQ, dIQ):
+        self.log_IQ = np.log10(IQ)
+        self.chi2_weights = (IQ/dIQ)**2/len(self.QQ)
+        self.spline_basis = None
+        
+    # Determination of the starting value of IQ0i by assuming that the 
+    # intensity contribution to a particular Q value consist solely of the 
+    # intensity from r_i = 2.5/Q. Other values of the factor R_Q_factor in
+    # r_i = R_Q_factor/Q give alternative starting values
+    def guess_log_IQ0(self, IQ, R_Q_factor = 2.5):
+        if R_Q_factor == 2.5:
+            pos = self.R_Q_corr_pos
+        else:
+            R_Q_pair_diff = np.abs(self.R_1D[:,np.newaxis] - R_Q_factor/self.QQ[np.newaxis,:])
+            pos = np.argmin(R_Q_pair_diff, axis = 1)
+        IQ0_guessed = IQ[pos]/self.eq4_fraction_2D[range(len(pos)), pos]
+        
+        # Bring IQ0_guessed closer to result prior to fit
+        return self.rescale_log_IQ0(np.log10(IQ0_guessed), IQ)
+    
+    # Shift log IQ0i so that the I(Q) calculated from it matches the given I(Q)
+    # in terms of their median ratio
+    def rescale_log_IQ0(self, log_IQ0, IQ):
+        IQ_guessed = 10**log_IQ0 @ self.eq4_fraction_2D
+        div_factor = np.median(IQ_guessed/IQ)
+        return log_IQ0 - np.log10(div_factor)
+    
+    # Starting value of log IQ0i from the fit result of a related data set 
+    # (e.g. the previous step of a series), given over the r grid logR_1D.
+    # The result is interpolated onto the r grid of this fitter and rescaled
+    # to the given I(Q)
+    def warm_start_log_IQ0(self, logR_1D, log_IQ0, IQ):
+        return self.rescale_log_IQ0(np.interp(self.logR_1D, logR_1D, log_IQ0), IQ)
+    
+    # This function calculate the optimise function Ξ in eqn 9, identical to 
+    # calc_Xi but using the precomputed weights and workspace, and its gradient
+    # with respect to log IQ0i
+    def calc_Xi(self, log_IQ0, lambda_):
+        roughness, grad_roughness = calc_roughness(log_IQ0, self.logR_1D, self.slope_weights)
+        np.power(10, log_IQ0, out = self.IQ0_work)
+        np.dot(self.IQ0_work, self.eq4_fraction_2D, out = self.IQ_calc_work)
+        resid = self.log_IQ - np.log10(self.IQ_calc_work)
+        chi2 = np.sum(resid**2*self.chi2_weights)
+        
+        # d χ² / d log IQ0i, the factors ln(10) of the log10 residual and of
+        # d IQ0i / d log IQ0i cancel
+        grad_chi2 = -2*self.IQ0_work*(self.eq4_fraction_2D @ 
+                                      (self.chi2_weights*resid/self.IQ_calc_work))
+        return chi2 + lambda_*roughness, grad_chi2 + lambda_*grad_roughness
+    
+    # Return the weighted residual sqrt(w)(log I(Q) - log I_calc(Q)) of χ² and
+    # the Jacobian of sqrt(w) log I_calc(Q) with respect to log IQ0i, so that
+    # χ² = ||residual||². The factors ln(10) of the log10 and of 
+    # d IQ0i / d log IQ0i cancel
+    def calc_jacobian(self, log_IQ0):
+        IQ0 = 10**log_IQ0
+        IQ_calc = IQ0 @ self.eq4_fraction_2D
+        sqrt_weights = np.sqrt(self.chi2_weights)
+        residual = sqrt_weights*(self.log_IQ - np.log10(IQ_calc))
+        jacobian = (sqrt_weights/IQ_calc)[:, np.newaxis]*self.eq4_fraction_2D.T*IQ0
+        return residual, jacobian
+    
+    # Setting arbitrary ranges for result, required for the least square fit.
+    # Return the (lower, upper) bounds of each log IQ0i around the given guess
+    def fit_bounds(self, log_IQ0_guessed):
+        log_IQ0_range = np.max(log_IQ0_guessed) - np.min(log_IQ0_guessed)
+        log_IQ0_upper_bound = log_IQ0_guessed + log_IQ0_range
+        log_IQ0_lower_bound = log_IQ0_guessed - log_IQ0_range
+        return list(zip(log_IQ0_lower_bound, log_IQ0_upper_bound))
+    
+    # Fit IQ0i to the given data, starting from log_IQ0_guessed if provided.
+    # The bounds of the fit are set around the starting value unless given
+    # as log_IQ0_bounds. Return IQ0i over the extended r grid and the fitted I(Q)
+    def fit(self, IQ, dIQ, lambda_, log_IQ0_guessed = None, log_IQ0_bounds = None):
+        self.set_data(IQ, dIQ)
+        if log_IQ0_guessed is None:
+            log_IQ0_guessed = self.guess_log_IQ0(IQ)
+        if log_IQ0_bounds is None:
+            log_IQ0_bounds = self.fit_bounds(log_IQ0_guessed)
+        
+        # Start the fitting procedure
+        self.optimize_result = sci_opt.minimize(self.calc_Xi, log_IQ0_guessed,
+                                                jac = True, method = 'L-BFGS-B',
+                                                bounds = log_IQ0_bounds,
+                                                args = (lambda_,))
+        IQ0_fitted = 10**self.optimize_result.x
+        
+        # Calculate I(Q) from the fitted data using Equation (2)
+        IQ_fitted = IQ0_fitted @ self.eq4_fraction_2D
+        return IQ0_fitted, IQ_fitted
+    
+    # Fit log IQ0i as a cubic B-spline over log r with num_knots knots, 
+    # equally spaced over the extended r grid, so that L-BFGS-B optimises
+    # num_knots + 2 coefficients instead of one value per r_i. The spline 
+    # basis is evaluated once on the r grid; Ξ is evaluated for log IQ0i = B c
+    # and its gradient is projected onto the coefficients c by Bᵀ. The 
+    # starting value and bounds are those of fit, least-squares fitted by
+    # the spline and taken at the Greville abscissae of the coefficients.
+    # The basis and the coefficients are kept in self.spline_basis and 
+    # self.spline_coeffs, and self.optimize_result.x is log IQ0i over the r grid
+    # as for fit. Return as in fit
+    def fit_spline(self, IQ, dIQ, lambda_, num_knots, log_IQ0_guessed = None,
+                   log_IQ0_bounds = None):
+        self.set_data(IQ, dIQ)
+        if log_IQ0_guessed is None:
+            log_IQ0_guessed = self.guess_log_IQ0(IQ)
+        if log_IQ0_bounds is None:
+            log_IQ0_bounds = self.fit_bounds(log_IQ0_guessed)
+        basis, greville = calc_spline_basis(self.logR_1D, int(num_knots))
+        lower_bound, upper_bound = np.array(log_IQ0_bounds).T
+        coeffs_bounds = list(zip(np.interp(greville, self.logR_1D, lower_bound),
+                                 np.interp(greville, self.logR_1D, upper_bound)))
+        coeffs_guessed = np.clip(np.linalg.lstsq(basis, log_IQ0_guessed, rcond = None)[0],
+                                 *np.array(coeffs_bounds).T)
+        
+        def calc_Xi_spline(coeffs):
+            Xi, grad = self.calc_Xi(basis @ coeffs, lambda_)
+            return Xi, basis.T @ grad
+        
+        self.optimize_result = sci_opt.minimize(calc_Xi_spline, coeffs_guessed,
+                                                jac = True, method = 'L-BFGS-B',
+                                                bounds = coeffs_bounds)
+        self.spline_basis, self.spline_coeffs = basis, self.optimize_result.x
+        self.optimize_result.x = basis @ self.spline_coeffs
+        IQ0_fitted = 10**self.optimize_result.x
+        IQ_fitted = IQ0_fitted @ self.eq4_fraction_2D
+        return IQ0_fitted, IQ_fitted
+    
+    # Fit IQ0i with a damped Gauss-Newton (Levenberg-Marquardt) solver of Ξ,
+    # without bounds. Each iteration solves the problem linearised around the
+    # current log IQ0i, so a few iterations from a close starting value are
+    # enough, e.g. for an interactive preview. The result is kept in
+    # self.optimize_result as for fit. Return as in fit
+    def fit_gauss_newton(self, IQ, dIQ, lambda_, log_IQ0_guessed = None, max_iter = 30,
+                         tol = 1e-6):
+        self.set_data(IQ, dIQ)
+        log_IQ0 = self.guess_log_IQ0(IQ) if log_IQ0_guessed is None else log_IQ0_guessed
+        rough_op = calc_roughness_operator(self.logR_1D, self.slope_weights)
+        rough_matrix = lambda_*rough_op.T @ rough_op
+        
+        def calc_objective(log_IQ0):
+            residual, jacobian = self.calc_jacobian(log_IQ0)
+            return residual @ residual + log_IQ0 @ rough_matrix @ log_IQ0, residual, jacobian
+        
+        Xi, residual, jacobian = calc_objective(log_IQ0)
+        damping = None
+        for num_iter in range(1, max_iter + 1):
+            hessian = jacobian.T @ jacobian + rough_matrix
+            grad = jacobian.T @ residual - rough_matrix @ log_IQ0    # -1/2 dΞ/dx
+            if damping is None:
+                damping = 1e-3*np.mean(np.diag(hessian))
+            while True:
+                step = np.linalg.solve(hessian + damping*np.diag(np.diag(hessian)), grad)
+                Xi_new, residual_new, jacobian_new = calc_objective(log_IQ0 + step)
+                if Xi_new <= Xi or damping > 1e10:
+                    break
+                damping *= 4
+            if Xi_new > Xi:
+                break
+            damping /= 3
+            converged = Xi - Xi_new <= tol*Xi
+            log_IQ0 = log_IQ0 + step
+            Xi, residual, jacobian = Xi_new, residual_new, jacobian_new
+            if converged:
+                break
+        self.optimize_result = sci_opt.OptimizeResult(x = log_IQ0, fun = Xi, nit = num_iter)
+        IQ0_fitted = 10**log_IQ0
+        return IQ0_fitted, IQ0_fitted @ self.eq4_fraction_2D
+    
+    # Coarse-to-fine multigrid fit. The fit is first solved with pts_per_dec
+    # reduced by a factor 2**levels (coarse levels below min_pts_per_dec are
+    # skipped), and the result of each level is interpolated onto the r grid
+    # of the next finer level as its starting value. Every level keeps the
+    # bounds of its own heuristic guess, so the final fit solves the same
+    # problem as fit. The iterations of each level are kept in
+    # self.multigrid_iterations as (pts_per_dec, iterations), finest last.
+    # Return as in fit
+    def fit_multigrid(self, IQ, dIQ, lambda_, levels = 1, min_pts_per_dec = 2):
+        self.multigrid_iterations = []
+        logR_1D, log_IQ0 = None, None
+        for level in range(levels, -1, -1):
+            pts_per_dec = self.pts_per_dec/2**level
+            if level > 0 and pts_per_dec < min_pts_per_dec:
+                continue
+            fitter = self if level == 0 else PDSPFitter(self.QQ, pts_per_dec, self.dQ,
+                                                        self.slit_length, self.pore_model)
+            log_IQ0_bounds = fitter.fit_bounds(fitter.guess_log_IQ0(IQ))
+            log_IQ0_start = None
+            if log_IQ0 is not None:
+                log_IQ0_start = np.clip(fitter.warm_start_log_IQ0(logR_1D, log_IQ0, IQ),
+                                        *np.array(log_IQ0_bounds).T)
+            IQ0_fitted, IQ_fitted = fitter.fit(IQ, dIQ, lambda_, log_IQ0_start, log_IQ0_bounds)
+            self.multigrid_iterations.append((pts_per_dec, fitter.optimize_result.nit))
+            logR_1D, log_IQ0 = fitter.logR_1D, fitter.optimize_result.x
+        return IQ0_fitted, IQ_fitted
+    
+    # Return the posterior covariance of log IQ0i at the optimum log_IQ0 of Ξ
+    # with lambda_ (Laplace approximation). Ξ is χ² of log I(Q) divided by
+    # N ln(10)², so -log posterior = N ln(10)² Ξ / 2, whose Gauss-Newton Hessian
+    # N ln(10)² (JᵀJ + λLᵀL) is inverted from one Cholesky factorisation. The
+    # data must have been set by the fit. After a spline fit, the Hessian of
+    # the spline coefficients BᵀHB is inverted and the covariance is mapped 
+    # back onto log IQ0i = B c
+    def calc_log_IQ0_covariance(self, log_IQ0, lambda_):
+        _, jacobian = self.calc_jacobian(log_IQ0)
+        rough_op = calc_roughness_operator(self.logR_1D, self.slope_weights)
+        hessian = (jacobian.T @ jacobian + lambda_*rough_op.T @ rough_op)*len(self.QQ)*np.log(10)**2
+        basis = self.spline_basis
+        if basis is not None:
+            hessian = basis.T @ hessian @ basis
+        try:
+            factor = sci_linalg.cho_factor(hessian)
+        except sci_linalg.LinAlgError:
+            raise ValueError('Hessian of the fit is singular, cannot estimate the covariance')
+        if basis is None:
+            return sci_linalg.cho_solve(factor, np.eye(len(log_IQ0)))
+        return basis @ sci_linalg.cho_solve(factor, basis.T)
+    
+    # Estimate the errors of the fit and calculate the sample properties enabled
+    # by the PDSP fit result. If the covariance of log IQ0i over the r grid of
+    # the fit is given (see calc_log_IQ0_covariance), the errors are propagated
+    # from it, otherwise they are estimated from the fit error of I(Q)
+    def calc_result(self, IQ, dIQ, IQ0_fitted, IQ_fitted, contrast, density_solid,
+                    r_SSA_extrapolate, num_pts_SSA_extrapolate, major_phase,
+                    log_IQ0_cov = None):
+        # Remove the result values at r_i < 2.5/Q_max
+        logR_1D = self.logR_1D[self.non_extplted_pos]
+        IQ0_fitted = IQ0_fitted[self.non_extplted_pos]
+        
+        # Estimate fit error, then profject to fit result        
+        if log_IQ0_cov is None:
+            dIQ0_percent = estimate_dIQ0_percent(self.QQ, IQ, dIQ, IQ_fitted,
+                                                 logR_1D, self.logR_del)
+        else:
+            log_IQ0_cov = log_IQ0_cov[np.ix_(self.non_extplted_pos, self.non_extplted_pos)]
+            dIQ0_percent = np.log(10)*np.sqrt(np.diag(log_IQ0_cov))
+        
+        # Calculate sample properties enabled by the PDSP fit result and return result
+        R_1D, IQ0_fitted, f_r, f_dash_r = calc_distribution(logR_1D, self.logR_del,
+                                                            IQ0_fitted, dIQ0_percent)
+        return PDSPResult.from_fit(R_1D, IQ_fitted, IQ0_fitted, f_r, f_dash_r,
+                                   contrast, density_solid, r_SSA_extrapolate,
+                                   num_pts_SSA_extrapolate, major_phase, log_IQ0_cov,
+                                   self.pore_model)
+
+
+# Class used for fast approximate PDSP fits of one data set while its
+# background and Q range are being changed, e.g. for a live preview in the GUI.
+# The kernel is calculated once for all Q values of the data on a coarse r
+# grid. Each preview fit slices it to the background-subtracted Q range
+# (a subset of the data Q values) and runs a few Gauss-Newton iterations,
+# starting from the previous preview
+class PDSPPreview:
+    def __init__(self, QQ, pts_per_dec = 5, dQ = None, slit_length = None, max_iter = 10,
+                 pore_model = 'sphere'):
+        self.fitter = PDSPFitter(QQ, pts_per_dec, dQ, slit_length, pore_model)
+        # The data Q values in ascending order, for looking up the Q values of
+        # the previews also in data files with descending Q
+        self.Q_order = np.argsort(self.fitter.QQ, kind = 'stable')
+        self.QQ_sorted = self.fitter.QQ[self.Q_order]
+        self.max_iter = max_iter
+        self.previous = None    # (log r, log IQ0i) of the previous preview
+
+    # Fit the background-subtracted data. Return the fitted I(Q), and the pore
+    # radius (nm) and f(r) without errors, as in PDSPResult
+    def fit(self, QQ_trim, IQ_trim, dIQ_trim, lambda_):
+        Q_pos = self.Q_order[np.minimum(np.searchsorted(self.QQ_sorted, QQ_trim),
+                                        len(self.QQ_sorted) - 1)]
+        if not np.array_equal(self.fitter.QQ[Q_pos], QQ_trim):
+            raise ValueError('Q values of the preview must be a subset of the data Q values')
+        fitter = self.fitter.sub_fitter(Q_pos)
+        log_IQ0_start = (None if self.previous is None else
+                         fitter.warm_start_log_IQ0(*self.previous, IQ_trim))
+        IQ0_fitted, IQ_fitted = fitter.fit_gauss_newton(IQ_trim, dIQ_trim, lambda_,
+                                                        log_IQ0_start, self.max_iter)
+        if np.all(np.isfinite(fitter.optimize_result.x)):
+            self.previous = (fitter.logR_1D, fitter.optimize_result.x)
+
+        IQ0_fitted = IQ0_fitted[fitter.non_extplted_pos]
+        R_1D, _, f_r, _ = calc_distribution(fitter.logR_1D[fitter.non_extplted_pos],
+                                            fitter.logR_del, IQ0_fitted,
+                                            np.zeros(len(IQ0_fitted)))
+        return IQ_fitted, R_1D/10, f_r
+
+
+# Determining the r range of the result based on the relationship r = 2.5/Q.
+# r_min is extended further to r_min = 0.5/Q_max to improve the smoothness 
+# of the final result, which is trimmed back to R_min_original once the fit
+# is completed. Return log r and the positions of the non-extended r values
+def calc_r_grid(QQ, logR_del):
+    R_max_original = 10**(np.ceil(np.log10(2.5/np.min(QQ))/logR_del)*logR_del)
+    R_min_original = 10**(np.floor(np.log10(2.5/np.max(QQ))/logR_del)*logR_del)
+    logR_min = np.floor(np.log10(0.5/np.max(QQ))/logR_del)*logR_del
+    logR_max = np.ceil(np.log10(2.5/np.min(QQ))/logR_del)*logR_del
+    logR_1D = np.arange(logR_min, logR_max+logR_del/2, logR_del)
+    R_1D = 10**logR_1D
+    non_extplted_pos = np.logical_and(R_1D - R_min_original >= -1e-10,
+                                      R_1D - R_max_original <= 1e-10)
+    return logR_1D, non_extplted_pos
+
+
+# Return the basis matrix B of the B-spline of the given degree with num_knots
+# knots equally spaced over logR_1D, so that the spline with coefficients c is
+# B c at logR_1D, together with the Greville abscissae of the coefficients 
+# (the average of their knots, where each coefficient acts most)
+def calc_spline_basis(logR_1D, num_knots, degree = spline_degree):
+    check_spline_knots(num_knots)
+    num_coeffs = num_knots + degree - 1
+    if num_coeffs > len(logR_1D):
+        raise ValueError('Too many spline knots for the r grid, at most {:d} knots allowed'
+                         .format(len(logR_1D) - degree + 1))
+    inner_knots = np.linspace(logR_1D[0], logR_1D[-1], num_knots)
+    knots = np.concatenate(([inner_knots[0]]*degree, inner_knots, [inner_knots[-1]]*degree))
+    basis = sci_interp.BSpline(knots, np.eye(num_coeffs), degree)(logR_1D)
+    greville = np.convolve(knots[1:-1], np.ones(degree)/degree, mode = 'valid')
+    return basis, greville
+
+
+# Weights giving the least square slope of log IQ0 vs. log r, as the dot
+# product with log IQ0
+def calc_slope_weights(logR_1D):
+    logR_centred = logR_1D - np.mean(logR_1D)
+    return logR_centred/np.sum(logR_centred**2)
+
+
+# This function calculate the roughness term of the optimise function Ξ in 
+# eqn 9 (with its sign reversed, i.e. -fancy_R) and its gradient with respect
+# to log IQ0. log IQ0 is normalised by its least square slope vs. log r
+def calc_roughness(log_IQ0, logR_1D, slope_weights):
+    diff = np.diff(log_IQ0 - logR_1D*(slope_weights @ log_IQ0))
+    grad = np.zeros(len(log_IQ0))
+    grad[:-1] -= 2*diff
+    grad[1:] += 2*diff
+    grad -= slope_weights*(logR_1D @ grad)
+    return np.sum(diff**2), grad
+
+
+# Return the roughness operator L, with ||L log IQ0||² equal to the roughness
+# term calculated by calc_roughness: the first differences of log IQ0
+# normalised by its least square slope
+def calc_roughness_operator(logR_1D, slope_weights):
+    num_r = len(logR_1D)
+    normalise = np.eye(num_r) - np.outer(logR_1D, slope_weights)
+    return np.diff(np.eye(num_r), axis = 0) @ normalise
+
+
+# Estimate the relative error of IQ0i by projecting the fit error of I(Q) at
+# each Q value onto r = 2.5/Q. logR_1D is the r grid without extension
+def estimate_dIQ0_percent(QQ, IQ, dIQ, IQ_fitted, logR_1D, logR_del):
+    fit_diff = np.abs(IQ_fitted - IQ)
+    sigma = np.where(fit_diff > dIQ, fit_diff, dIQ)
+    
+    rr_corres_QQ = 2.5/QQ[::-1]
+    dIQ_percent_data = sigma/IQ
+    dIQ_percent_fit = sigma/IQ_fitted
+    dIQ_percent = np.where(dIQ_percent_fit < dIQ_percent_data,
+                           dIQ_percent_fit, dIQ_percent_data)
+    R_min_1D = 10**(logR_1D - logR_del/2)
+    R_max_1D = 10**(logR_1D + logR_del/2)
+    R_2D = np.linspace(R_min_1D[1:-1], R_max_1D[1:-1], 51)
+    dIQ0_percent = np.median(np.interp(R_2D, rr_corres_QQ, dIQ_percent[::-1]), axis = 0)
+    return np.concatenate(([dIQ0_percent[0]], dIQ0_percent, [dIQ0_percent[-1]]))
+
+
+# Calculate the pore size distributions f'(r) and f(r) from the fitted IQ0i.
+# Return r (Angstrom), IQ0i, f(r) and f'(r), with the relative errors 
+# dIQ0_percent in their second column
+def calc_distribution(logR_1D, logR_del, IQ0_fitted, dIQ0_percent):
+    R_1D = 10**logR_1D
+    dR_1D = 10**(logR_1D + logR_del/2) - 10**(logR_1D - logR_del/2)
+    f_dash_r = np.array([IQ0_fitted/np.sum(IQ0_fitted), dIQ0_percent]).T
+    f_r = np.array([f_dash_r[:,0]/dR_1D, dIQ0_percent]).T
+    IQ0_fitted = np.array([IQ0_fitted, dIQ0_percent]).T
+    return R_1D, IQ0_fitted, f_r, f_dash_r
+
+
+# This function calculate the optimise function Ξ in eqn 9
+def calc_Xi(log_IQ0, logR_1D, integral_2D, QQ, IQ, dIQ, QQ_IQ_slope, lambda_):
+    IQ0_slope = np.polyfit(logR_1D, log_IQ0, 1)[0]
+    log_IQ0_normalised = log_IQ0 - logR_1D*IQ0_slope
+    fancy_R = -np.sum(np.diff(log_IQ0_normalised)**2)
+    IQ_calc = np.sum(10**log_IQ0[:,np.newaxis]*integral_2D,0)
+    
+    chi2 = (np.sum(((IQ*QQ**-QQ_IQ_slope)-(IQ_calc*QQ**-QQ_IQ_slope))**2/
+                   (dIQ*QQ**-QQ_IQ_slope)**2))/len(QQ)
+    
+    chi2 = np.sum((np.log10(IQ*QQ**-QQ_IQ_slope)
+                   -np.log10(IQ_calc*QQ**-QQ_IQ_slope))**2/
+                  (dIQ/IQ)**2)/len(QQ)
+
+    return chi2 - lambda_*fancy_R
+
+
+# This function returns the term following IQ0i in equation (2) for all pairs
+# of r_i and Q. Kernels are cached per pore model, Q grid, r grid and
+# resolution so that refitting the same data does not recalculate them. For
+# smeared data the smearing matrix is applied to the kernel once, so the 
+# smeared model costs nothing extra during the fit. pore_model is the name of
+# a pore model, see pore_models
+def get_eq4_fraction(logR_1D, logR_del, QQ, dQ = None, slit_length = None,
+                     pore_model = 'sphere'):
+    key = kernel_key(logR_1D, logR_del, QQ, dQ, slit_length, pore_model)
+    with kernel_cache_lock:
+        if key in kernel_cache:
+            kernel_cache.move_to_end(key)
+            return kernel_cache[key][0]
+    
+    # Use the kernel published by the parent process if this is a worker 
+    # process of a batch fit, otherwise calculate the kernel
+    shared_kernel = sk.attach_kernel(key)
+    if shared_kernel is not None:
+        eq4_fraction_2D = shared_kernel
+        smearing_matrix = None
+    elif dQ is None and not slit_length:
+        eq4_fraction_2D = calc_eq4_fraction(logR_1D, logR_del, QQ, pore_model)
+        smearing_matrix = None
+    else:
+        QQ_eval, smearing_matrix = calc_smearing_matrix(QQ, dQ, slit_length)
+        eq4_fraction_2D = (smearing_matrix @ 
+                           calc_eq4_fraction(logR_1D, logR_del, QQ_eval, pore_model).T).T
+    
+    cache_kernel(key, eq4_fraction_2D, smearing_matrix)
+    return eq4_fraction_2D
+
+
+# Store a kernel alongside its smearing matrix in the kernel cache, dropping
+# the least recently used kernel if the cache is full
+def cache_kernel(key, eq4_fraction_2D, smearing_matrix = None):
+    with kernel_cache_lock:
+        kernel_cache[key] = (eq4_fraction_2D, smearing_matrix)
+        kernel_cache.move_to_end(key)
+        if len(kernel_cache) > kernel_cache_size:
+            kernel_cache.popitem(last = False)
+
+
+# Return the hash identifying the kernel of the given r grid, Q grid, 
+# resolution and pore model, used as the key of the kernel cache and of shared
+# kernels. Kernels of the sphere model keep the keys of the r grid, Q grid and
+# resolution alone
+def kernel_key(logR_1D, logR_del, QQ, dQ = None, slit_length = None,
+               pore_model = 'sphere'):
+    key = hash_arrays(logR_1D, logR_del, QQ, dQ, slit_length)
+    if pore_model == 'sphere':
+        return key
+    return hashlib.sha1((key + pm.get_pore_model(pore_model).name).encode()).hexdigest()
+
+
+# Return a hash identifying the content of the given arrays or values
+def hash_arrays(*arrays):
+    hash_obj = hashlib.sha1()
+    for arr in arrays:
+        if arr is None:
+            hash_obj.update(b'None')
+        else:
+            arr = np.ascontiguousarray(arr, dtype = float)
+            hash_obj.update(str(arr.shape).encode())
+            hash_obj.update(arr.tobytes())
+    return hash_obj.hexdigest()
+
+
+# This function calculates the sparse smearing matrix W of the instrument 
+# resolution, so that I_smeared(Q) = W @ I(Q_eval). Q_eval extends the input
+# Q grid to cover the Q values probed by the resolution function, allowing
+# the kernel to be evaluated beyond the measured Q range.
+# dQ: standard deviation of the Gaussian (pinhole) resolution at each Q
+# slit_length: slit length of slit-smeared (e.g. Kookaburra USANS) data
+def calc_smearing_matrix(QQ, dQ = None, slit_length = None, num_sigma = 3,
+                         num_slit_pts = 400):
+    QQ = np.asarray(QQ, dtype = float)
+    logQ_step = np.median(np.diff(np.log10(QQ)))
+    
+    # Extend the Q grid with points at the same log spacing as the data
+    if slit_length:
+        QQ_eval_min = np.min(QQ)
+        QQ_eval_max = np.sqrt(np.max(QQ)**2 + slit_length**2)
+    else:
+        dQ = np.broadcast_to(np.asarray(dQ, dtype = float), QQ.shape)
+        dQ = np.where(dQ > 0, dQ, 1e-6*QQ) # guard against zero resolution
+        QQ_eval_min = np.max([np.min(QQ - num_sigma*dQ), np.min(QQ)/10])
+        QQ_eval_max = np.max(QQ + num_sigma*dQ)
+    num_low = int(np.ceil(np.log10(np.min(QQ)/QQ_eval_min)/logQ_step))
+    num_high = int(np.ceil(np.log10(QQ_eval_max/np.max(QQ))/logQ_step))
+    QQ_eval = np.concatenate((np.min(QQ)*10**(-logQ_step*np.arange(num_low, 0, -1)),
+                              QQ,
+                              np.max(QQ)*10**(logQ_step*np.arange(1, num_high+1))))
+    
+    if slit_length:
+        # I_smeared(Q) = 1/l * integral of I(sqrt(Q^2 + u^2)) du from 0 to l.
+        # The u values are geometrically spaced to resolve u << Q and u ~ l,
+        # then weighted by the trapezoidal rule
+        uu = np.concatenate(([0], np.geomspace(np.min(QQ)*1e-3, slit_length,
+                                               num_slit_pts - 1)))
+        du = np.gradient(uu)
+        du[[0, -1]] /= 2
+        Q_probed = np.sqrt(QQ[:,np.newaxis]**2 + uu**2)
+        weight = du/slit_length*np.ones(Q_probed.shape)
+        
+        # Linear interpolation of the probed Q values onto Q_eval
+        idx_high = np.clip(np.searchsorted(QQ_eval, Q_probed), 1, len(QQ_eval)-1)
+        Q_low, Q_high = QQ_eval[idx_high-1], QQ_eval[idx_high]
+        frac = np.clip((Q_probed - Q_low)/(Q_high - Q_low), 0, 1)
+        rows = np.repeat(np.arange(len(QQ)), Q_probed.shape[1])
+        row_idx = np.concatenate((rows, rows))
+        col_idx = np.concatenate(((idx_high-1).ravel(), idx_high.ravel()))
+        values = np.concatenate(((weight*(1-frac)).ravel(), (weight*frac).ravel()))
+    else:
+        # Gaussian resolution truncated at num_sigma standard deviations,
+        # integrated with the trapezoidal rule and normalised for each Q
+        dQ_eval = np.gradient(QQ_eval)
+        Q_diff = QQ_eval - QQ[:,np.newaxis]
+        within = np.abs(Q_diff) <= num_sigma*dQ[:,np.newaxis]
+        within[np.arange(len(QQ)), num_low + np.arange(len(QQ))] = True
+        row_idx, col_idx = np.nonzero(within)
+        values = (np.exp(-Q_diff[row_idx, col_idx]**2/(2*dQ[row_idx]**2)) * 
+                  dQ_eval[col_idx])
+        values /= np.bincount(row_idx, weights = values)[row_idx]
+        
+    smearing_matrix = sci_sparse.csr_matrix((values, (row_idx, col_idx)),
+                                            shape = (len(QQ), len(QQ_eval)))
+    return QQ_eval, smearing_matrix
+
+
+# This function calculate the term following IQ0i in equation (2) for all pairs
+# of r_i and Q, with the form factor and volume of the given pore model. The
+# r_i are split into blocks of kernel_block_size, calculated in parallel
+# threads (numpy releases the GIL in the array operations)
+def calc_eq4_fraction(logR_1D, logR_del, QQ, pore_model = 'sphere'):
+    model = pm.get_pore_model(pore_model)
+    blocks = [logR_1D[start:start+kernel_block_size]
+              for start in range(0, len(logR_1D), kernel_block_size)]
+    num_threads = min(len(blocks), os.cpu_count() or 1)
+    calc_block = lambda logR_block: calc_eq4_fraction_block(logR_block, logR_del, QQ, model)
+    if num_threads <= 1:
+        return np.vstack([calc_block(logR_block) for logR_block in blocks])
+    with concurrent.futures.ThreadPoolExecutor(max_workers = num_threads) as executor:
+        return np.vstack(list(executor.map(calc_block, blocks)))
+
+
+# Calculate the rows of the kernel for the r_i in logR_1D, with the PoreModel
+# model
+def calc_eq4_fraction_block(logR_1D, logR_del, QQ, model):
+    num_subintervals = 600 # number of intervals for integral calculation set to 600
+   
+    # Creating pairs of Rmin_i and Rmax_i corresponding to each value of r_i
+    logR_min_integral_1D = logR_1D - logR_del/2
+    logR_max_integral_1D = logR_1D + logR_del/2
+    R_min_integral_1D = 10**logR_min_integral_1D
+    R_max_integral_1D = 10**logR_max_integral_1D
+    
+    # Divide the each pair of Rmin_i and Rmax_i into 600 equal space for integral
+    # calculation
+    R_integral_2D = np.linspace(R_min_integral_1D, R_max_integral_1D, 
+                                  num_subintervals+1)
+    
+    # For each pair of Rmin_i and Rmax_i, calculate 
+    # (i) dr in the integral, 
+    # (ii) the mid point r value at each sub-interval dr, and
+    # (iii) Qr, Vr and F(Qr) for every sub-interval between Rmin_i and Rmax_i
+    dR_2D = np.diff(R_integral_2D, axis = 0)
+    R_mid_2D = R_integral_2D[:-1,:] + 1/2*dR_2D
+    Qr_3D = R_mid_2D[:,:,np.newaxis]*QQ
+    Vr_2D = model.volume(R_mid_2D)
+    F_3D = model.form_factor(Qr_3D)
+    
+    # Calculate 
+    # (i) the term inside the integral, 
+    # (ii) the integral, and
+    # (iii) the entire fraction following IQ0i in equation (2) for each
+    # pair of r_i and Q
+    subinterval_area_3D = (Vr_2D[:,:,np.newaxis]**2 * 
+                            F_3D * dR_2D[:,:,np.newaxis])
+    RHS_integral_2D = np.sum(subinterval_area_3D, axis = 0)
+    RHS_fraction_2D = (RHS_integral_2D/
+                    (R_max_integral_1D[:,np.newaxis] - 
+                      R_min_integral_1D[:,np.newaxis]))
+    
+    return RHS_fraction_2D
+
+
+# This function calculate the structural properties from the PDSP fit result.
+# The input arrays are not modified, so they can be shared between threads.
+# If the covariance of log IQ0i is given, the errors are propagated from it
+# (see propagate_log_IQ0_covariance) instead of being scaled from IQ_0[:,1].
+# The pore volume and surface area are those of the pore model of the fit
+def calc_PDSP_result(rr, f_r, f_dash_r, IQ_0, contrast, density_solid, 
+                     r_SSA_extrapolate, num_pts_SSA_extrapolate, major_phase,
+                     log_IQ0_cov = None, pore_model = 'sphere'):
+    
+    dIQ0_percent = IQ_0[:,1]
+    model = pm.get_pore_model(pore_model)
+    
+    # Average pore volume - Equation 
+    Vpore_avg = np.array([np.sum(model.volume(rr*1e-8)*f_dash_r[:,0]), 
+                          np.mean(dIQ0_percent)])
+    
+    # Porosity and pore concentration/density number - Equation 
+    phiTimes1minusPhi_on_Vavg = np.mean(IQ_0[:,0]/contrast**2/f_dash_r[:,0]*1e48)
+    roots = np.roots([1, -1, phiTimes1minusPhi_on_Vavg*Vpore_avg[0]])
+    if major_phase == 'solid':
+        phi = np.array([np.min(roots), np.mean(dIQ0_percent)*3])
+    elif major_phase == 'void':
+        phi = np.array([np.max(roots), np.mean(dIQ0_percent)*3])
+    phi_on_Vavg = np.array([phi[0]/Vpore_avg[0], np.mean(dIQ0_percent)*4])
+
+    # Specific surface area and differitial pore volume distribution - Equation
+    SSA = np.array([np.cumsum((model.surface(rr*1e-8) * 
+                               f_dash_r[:,0] * phi_on_Vavg[0])[::-1])[::-1],
+                    dIQ0_percent]).T
+    dV_dr = np.array([phi[0]/density_solid*f_r[:,0]*model.volume(rr*1e-8)/Vpore_avg[0],
+                      dIQ0_percent]).T
+    
+    # Convert pore radius from Angstrom to nm, without modifying the input
+    rr = rr/10
+    
+    # Extrapolate SSA to r_SSA_extrapolate
+    log_rr = np.log10(rr)
+    log_SSA = np.log10(SSA[:,0])
+    log_rr_4_extrapolate = log_rr[rr>=r_SSA_extrapolate][:num_pts_SSA_extrapolate]
+    log_SSA_4_extrapolate = log_SSA[rr>=r_SSA_extrapolate][:num_pts_SSA_extrapolate]
+    line_fit, err_fit_square = np.polyfit(log_rr_4_extrapolate, log_SSA_4_extrapolate, 1, full=True)[:2]
+    log_SSA_extrapolate = np.polyval(line_fit, np.log10(r_SSA_extrapolate))
+    SSA_extrapolate = np.array([10**log_SSA_extrapolate, np.mean(dIQ0_percent)*4])
+    # SSA_extrapolate = (10**log_SSA_extrapolate, 10**(err_fit_square/2))
+    
+    if log_IQ0_cov is not None:
+        errors = propagate_log_IQ0_covariance(rr*10, f_dash_r, phi[0], log_IQ0_cov,
+                                              r_SSA_extrapolate, num_pts_SSA_extrapolate)
+        SSA[:,1], dV_dr[:,1] = errors['SSA'], errors['dV_dr']
+        phi[1], Vpore_avg[1] = errors['phi'], errors['Vpore_avg']
+        phi_on_Vavg[1], SSA_extrapolate[1] = errors['phi_on_Vavg'], errors['SSA_extrapolate']
+    
+    return rr, SSA, dV_dr, phi, Vpore_avg, phi_on_Vavg, SSA_extrapolate
+
+
+# Return the derivatives of ln f'(r_i) with respect to ln IQ0j, as rows over i.
+# f'(r_i) = IQ0i/ΣIQ0j, so the derivatives are δij - f'(r_j)
+def calc_f_dash_r_derivatives(f_dash_r):
+    return np.eye(len(f_dash_r)) - f_dash_r[:,0]
+
+
+# Return the relative errors of a quantity from the rows of its derivatives 
+# with respect to ln IQ0i and the covariance of log10 IQ0i
+def calc_relative_error(derivatives, log_IQ0_cov):
+    variance = np.log(10)**2*np.einsum('...i,ij,...j->...', derivatives, log_IQ0_cov,
+                                       derivatives)
+    return np.sqrt(np.abs(variance))
+
+
+# Propagate the covariance of log10 IQ0i linearly into the relative errors of
+# the sample properties of calc_PDSP_result. rr is the pore radius in Angstrom
+# and phi the porosity. The shape of every pore model is fixed, so its volume
+# and surface area scale as r³ and r². All properties are products and sums of IQ0i, so their
+# derivatives with respect to ln IQ0i follow from those of ln f'(r):
+#   ln ϕ(1 - ϕ) = ln ΣIQ0i + ln Vpore_avg + const
+#   SSA(R_k) ∝ ϕ/Vpore_avg Σ_{i>=k} r_i² f'(r_i),  dV/dr ∝ ϕ/Vpore_avg r³ f'(r)
+# and the extrapolated SSA is linear in log SSA(R) of the extrapolated points.
+# Return a dict of the relative errors of f(r), SSA, dV_dr, phi, Vpore_avg,
+# phi_on_Vavg and SSA_extrapolate
+def propagate_log_IQ0_covariance(rr, f_dash_r, phi, log_IQ0_cov, r_SSA_extrapolate,
+                                 num_pts_SSA_extrapolate):
+    weights = f_dash_r[:,0]
+    d_f = calc_f_dash_r_derivatives(f_dash_r)
+    volume_terms = rr**3*weights
+    d_Vpore = volume_terms/np.sum(volume_terms) - weights
+    
+    # ϕ(1 - ϕ) = q, so d ln ϕ = q/(ϕ(1 - 2ϕ)) d ln q
+    d_phi = (1 - phi)/(1 - 2*phi)*(weights + d_Vpore)
+    d_phi_on_Vavg = d_phi - d_Vpore
+    
+    area_terms = rr**2*weights
+    upper_sums = np.triu(np.ones((len(rr), len(rr))))*area_terms
+    d_SSA = d_phi_on_Vavg + (upper_sums @ d_f)/np.sum(upper_sums, axis = 1)[:, np.newaxis]
+    d_dV_dr = d_phi_on_Vavg + d_f
+    
+    # Linear least squares fit of log SSA(R) against log R at the extrapolated points
+    rr_nm = rr/10
+    select = np.nonzero(rr_nm >= r_SSA_extrapolate)[0][:num_pts_SSA_extrapolate]
+    design = np.column_stack((np.log10(rr_nm[select]), np.ones(len(select))))
+    extrapolate = np.array([np.log10(r_SSA_extrapolate), 1]) @ np.linalg.pinv(design)
+    d_SSA_extrapolate = extrapolate @ d_SSA[select]
+    
+    return {'f_r': calc_relative_error(d_f, log_IQ0_cov),
+            'SSA': calc_relative_error(d_SSA, log_IQ0_cov),
+            'dV_dr': calc_relative_error(d_dV_dr, log_IQ0_cov),
+            'phi': calc_relative_error(d_phi, log_IQ0_cov),
+            'Vpore_avg': calc_relative_error(d_Vpore, log_IQ0_cov),
+            'phi_on_Vavg': calc_relative_error(d_phi_on_Vavg, log_IQ0_cov),
+            'SSA_extrapolate': calc_relative_error(d_SSA_extrapolate, log_IQ0_cov)}
+
+
+# Calculate the sample properties of calc_PDSP_result over whole grids of
+# contrasts, densities, radii r_SSA_extrapolate (nm) and numbers of points of
+# the SSA extrapolation from a single fit, without refitting and without a
+# loop over the grid points. rr is the pore radius in Angstrom. Only the
+# porosity depends on the contrast, only the specific values on the density
+# and only the extrapolated SSA on the extrapolation, so every property is
+# calculated on the axes it depends on and broadcast:
+#   ϕ(1 - ϕ) = q/contrast²          phi, phi_on_Vavg: (contrasts,)
+#   pore volume = ϕ/density          (contrasts, densities)
+#   SSA(R) = ϕ/Vpore_avg S(R)        SSA_extrapolate: (contrasts, radii, points)
+# log S(R) is fitted by a straight line through the selected points of each
+# (radius, number of points) pair from sums over masks of the points, which
+# gives the same line as the polyfit of calc_PDSP_result. Pairs with fewer
+# than 2 points are nan. Return a dict of the grids and the properties, with
+# the pore volume in cm3/g and the SSA per mass SSA_mass in m2/g
+def calc_PDSP_sensitivity(rr, f_dash_r, IQ_0, contrasts, densities, r_SSA_values,
+                          num_pts_values, major_phase, pore_model = 'sphere'):
+    contrasts, densities = np.asarray(contrasts, float), np.asarray(densities, float)
+    r_SSA_values = np.asarray(r_SSA_values, float)
+    num_pts_values = np.asarray(num_pts_values, int)
+    model = pm.get_pore_model(pore_model)
+
+    Vpore_avg = np.sum(model.volume(rr*1e-8)*f_dash_r[:,0])
+    phiTimes1minusPhi = np.mean(IQ_0[:,0]/f_dash_r[:,0]*1e48)*Vpore_avg/contrasts**2
+    discriminant = np.sqrt(1 - 4*phiTimes1minusPhi + 0j)
+    if major_phase == 'solid':
+        phi = (1 - discriminant)/2
+    elif major_phase == 'void':
+        phi = (1 + discriminant)/2
+    else:
+        raise ValueError("Major phase must be 'solid' or 'void'")
+    if not np.any(phi.imag):
+        phi = phi.real
+    phi_on_Vavg = phi/Vpore_avg
+
+    # Mask of the extrapolated points, shape (radii, points, r): the first
+    # num_pts of the radii >= r_SSA
+    rr_nm = rr/10
+    above = rr_nm >= r_SSA_values[:,np.newaxis]
+    rank = np.cumsum(above, axis = 1) - 1
+    mask = (above[:,np.newaxis,:] &
+            (rank[:,np.newaxis,:] < num_pts_values[:,np.newaxis])).astype(float)
+
+    log_rr = np.log10(rr_nm)
+    log_surface = np.log10(np.cumsum((model.surface(rr*1e-8)*f_dash_r[:,0])[::-1])[::-1])
+    num_fit = mask.sum(axis = -1)
+    sum_x, sum_y = mask @ log_rr, mask @ log_surface
+    sum_xx, sum_xy = mask @ log_rr**2, mask @ (log_rr*log_surface)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        slope = (num_fit*sum_xy - sum_x*sum_y)/(num_fit*sum_xx - sum_x**2)
+        intercept = (sum_y - slope*sum_x)/num_fit
+    log_surface_extrapolate = np.where(num_fit >= 2, slope*np.log10(r_SSA_values)[:,np.newaxis]
+                                       + intercept, np.nan)
+    SSA_extrapolate = phi_on_Vavg[:,np.newaxis,np.newaxis]*10**log_surface_extrapolate
+
+    pore_volume = phi[:,np.newaxis]/densities
+    SSA_mass = SSA_extrapolate[:,np.newaxis]/densities[:,np.newaxis,np.newaxis]*1e-4
+    return {'contrast': contrasts, 'density': densities, 'r_SSA_extrapolate': r_SSA_values,
+            'num_pts_SSA_extrapolate': num_pts_values, 'phi': phi, 'Vpore_avg': Vpore_avg,
+            'phi_on_Vavg': phi_on_Vavg, 'pore_volume': pore_volume,
+            'SSA_extrapolate': SSA_extrapolate, 'SSA_mass': SSA_mass}
+
+
+# Return the values of a parameter grid given as 'start:stop:num' (num values
+# evenly spaced from start to stop, inclusive) or as a comma separated list
+def parse_parameter_grid(text, dtype = float):
+    text = text.strip()
+    try:
+        if ':' in text:
+            start, stop, num = text.split(':')
+            values = np.linspace(float(start), float(stop), int(num))
+        else:
+            values = np.array([float(value) for value in text.split(',')])
+    except ValueError:
+        raise ValueError('Invalid parameter grid: ' + text +
+                         ". Use 'start:stop:num' or a comma separated list")
+    if len(values) == 0:
+        raise ValueError('Parameter grid is empty: ' + text)
+    if dtype is int:
+        if np.any(values != np.round(values)):
+            raise ValueError('Parameter grid must contain integers: ' + text)
+        values = np.round(values).astype(int)
+    return values
+
+
+# Column names of the table of a sensitivity grid
+sensitivity_table_columns = ('Contrast (cm-2)', 'Density (g/cm3)', 'r_SSA (nm)', 'SSA points',
+                             'Porosity', 'Pore Concentration (cm-3)', 'Pore Volume (cm3/g)',
+                             'SSA (cm2/cm3)', 'SSA (m2/g)')
+
+
+# Return the sensitivity grid of calc_PDSP_sensitivity as a table with one row
+# per grid point and the columns of sensitivity_table_columns, the last axis
+# (number of points) varying fastest. Complex values are given as their real part
+def calc_sensitivity_table(sensitivity):
+    grids = np.meshgrid(sensitivity['contrast'], sensitivity['density'],
+                        sensitivity['r_SSA_extrapolate'],
+                        sensitivity['num_pts_SSA_extrapolate'], indexing = 'ij')
+    shape = grids[0].shape
+    phi = np.broadcast_to(sensitivity['phi'][:,np.newaxis,np.newaxis,np.newaxis], shape)
+    phi_on_Vavg = np.broadcast_to(
+        sensitivity['phi_on_Vavg'][:,np.newaxis,np.newaxis,np.newaxis], shape)
+    pore_volume = np.broadcast_to(sensitivity['pore_volume'][:,:,np.newaxis,np.newaxis], shape)
+    SSA_extrapolate = np.broadcast_to(sensitivity['SSA_extrapolate'][:,np.newaxis], shape)
+    return np.column_stack([np.real(arr).ravel() for arr in
+                            list(grids) + [phi, phi_on_Vavg, pore_volume, SSA_extrapolate,
+                                           sensitivity['SSA_mass']]])
+
+
+# Write the sensitivity grid of calc_PDSP_sensitivity of the result of the data
+# file data_file_name into a text table with one line per grid point. Complex
+# porosities are written as their real part and marked in the header
+def write_PDSP_sensitivity(save_file_dir, data_file_name, sensitivity):
+    header = ('PDSP Sensitivity Grid for ' + data_file_name + '\n\n' +
+              'Average Pore Volume (cm3): {:.3e}\n'.format(sensitivity['Vpore_avg']))
+    if np.iscomplexobj(sensitivity['phi']):
+        header += 'Complex porosity at some contrasts, real parts written\n'
+    header += '\n' + '\t'.join(sensitivity_table_columns)
+    np.savetxt(save_file_dir, calc_sensitivity_table(sensitivity), delimiter = '\t',
+               header = header, comments = '',
+               fmt = ['%.4e', '%.4f', '%.4f', '%d', '%.5e', '%.4e', '%.4e', '%.4e', '%.4e'])
+
+
+# Read-only container of the PDSP fit result. All arrays are views into one
+# contiguous block, so a result is cheap to store, copy or send to another
+# process, and can be shared between threads without defensive copies.
+# Columns [:,1] (and element [1]) hold the relative errors of the values.
+# Iterating over a PDSPResult gives the fields in the order of the tuple
+# previously returned by fit_PDSP_model:
+# rr, IQ_fitted, IQ0_fitted, f_r, f_dash_r, SSA, dV_dr, phi, Vpore_avg,
+# phi_on_Vavg, SSA_extrapolate
+# Results with errors propagated from the covariance of log IQ0i also keep
+# the covariance, so recalc propagates it again. It is not part of the block,
+# and results read back from a stored block use the heuristic errors in recalc.
+# The name of the pore model of the fit is kept for recalc in the same way,
+# results read back from a stored block assume the sphere model unless it is
+# given
+class PDSPResult:
+    fields = ('rr', 'IQ_fitted', 'IQ0_fitted', 'f_r', 'f_dash_r', 'SSA', 'dV_dr',
+              'phi', 'Vpore_avg', 'phi_on_Vavg', 'SSA_extrapolate')
+    __slots__ = ('block', 'log_IQ0_cov', 'pore_model') + fields
+    
+    # Fields that are always real. If the porosity is complex (ϕ(1 - ϕ) > 0.25)
+    # the block is complex, and these fields are views of its real part
+    real_fields = ('rr', 'IQ_fitted', 'IQ0_fitted', 'f_r', 'f_dash_r', 'Vpore_avg')
+    
+    block: np.ndarray           # contiguous storage of all arrays below
+    rr: np.ndarray              # pore radius (nm), shape (N,)
+    IQ_fitted: np.ndarray       # fitted I(Q) (cm-1), shape (M,)
+    IQ0_fitted: np.ndarray      # fitted IQ0i, shape (N, 2)
+    f_r: np.ndarray             # f(r), shape (N, 2)
+    f_dash_r: np.ndarray        # f'(r), shape (N, 2)
+    SSA: np.ndarray             # SSA(R) (cm2/cm3), shape (N, 2)
+    dV_dr: np.ndarray           # dV/dr, shape (N, 2)
+    phi: np.ndarray             # porosity, shape (2,)
+    Vpore_avg: np.ndarray       # average pore volume (cm3), shape (2,)
+    phi_on_Vavg: np.ndarray     # pore concentration (cm-3), shape (2,)
+    SSA_extrapolate: np.ndarray # extrapolated SSA (cm2/cm3), shape (2,)
+    log_IQ0_cov: np.ndarray     # covariance of log10 IQ0i, shape (N, N), or None
+    pore_model: str             # name of the pore model of the fit
+    
+    def __init__(self, block: np.ndarray, num_r: int, num_Q: int,
+                 log_IQ0_cov: np.ndarray = None, pore_model: str = 'sphere'):
+        block = block.view()
+        block.flags.writeable = False
+        self.block = block
+        self.log_IQ0_cov = log_IQ0_cov
+        self.pore_model = pore_model
+        
+        # Shape of each field, the views are taken in the order of fields
+        shapes = ((num_r,), (num_Q,)) + ((num_r, 2),)*5 + ((2,),)*4
+        start = 0
+        for field, shape in zip(self.fields, shapes):
+            size = int(np.prod(shape))
+            view = block[start:start+size].reshape(shape)
+            if np.iscomplexobj(view) and field in self.real_fields:
+                view = view.real
+            setattr(self, field, view)
+            start += size
+        
+    # Return the length of the block required for num_r pore radii and num_Q
+    # Q values
+    @staticmethod
+    def block_size(num_r: int, num_Q: int) -> int:
+        return 11*num_r + num_Q + 8
+    
+    # Create a result by copying the given arrays, in the order of fields,
+    # into a new block. The block is complex if any of the arrays is complex
+    @classmethod
+    def from_arrays(cls, *arrays, log_IQ0_cov = None, pore_model = 'sphere') -> 'PDSPResult':
+        num_r, num_Q = len(arrays[0]), len(arrays[1])
+        block = np.empty(cls.block_size(num_r, num_Q), 
+                         dtype = np.result_type(float, *arrays))
+        start = 0
+        for arr in arrays:
+            block[start:start+np.size(arr)] = np.ravel(arr)
+            start += np.size(arr)
+        return cls(block, num_r, num_Q, log_IQ0_cov, pore_model)
+    
+    # Calculate the structural properties from the PDSP fit and return them
+    # as a new result. rr is the pore radius in Angstrom. If the covariance of
+    # log IQ0i is given, the errors of f(r) and f'(r) are also propagated from it
+    @classmethod
+    def from_fit(cls, rr, IQ_fitted, IQ0_fitted, f_r, f_dash_r, contrast, 
+                 density_solid, r_SSA_extrapolate, num_pts_SSA_extrapolate, 
+                 major_phase, log_IQ0_cov = None, pore_model = 'sphere') -> 'PDSPResult':
+        rr_nm, SSA, dV_dr, phi, Vpore_avg, phi_on_Vavg, SSA_extrapolate = \
+            calc_PDSP_result(rr, f_r, f_dash_r, IQ0_fitted, contrast, density_solid,
+                             r_SSA_extrapolate, num_pts_SSA_extrapolate, major_phase,
+                             log_IQ0_cov, pore_model)
+        if log_IQ0_cov is not None:
+            f_error = calc_relative_error(calc_f_dash_r_derivatives(f_dash_r), log_IQ0_cov)
+            f_r = np.column_stack((f_r[:,0], f_error))
+            f_dash_r = np.column_stack((f_dash_r[:,0], f_error))
+        return cls.from_arrays(rr_nm, IQ_fitted, IQ0_fitted, f_r, f_dash_r, SSA, 
+                               dV_dr, phi, Vpore_avg, phi_on_Vavg, SSA_extrapolate,
+                               log_IQ0_cov = log_IQ0_cov, pore_model = pore_model)
+    
+    # Recalculate the structural properties for new PDSP inputs without 
+    # refitting. A new result is returned and this result is left unchanged
+    def recalc(self, contrast, density_solid, r_SSA_extrapolate, 
+               num_pts_SSA_extrapolate, major_phase) -> 'PDSPResult':
+        return self.from_fit(self.rr*10, self.IQ_fitted, self.IQ0_fitted, self.f_r,
+                             self.f_dash_r, contrast, density_solid, r_SSA_extrapolate,
+                             num_pts_SSA_extrapolate, major_phase, self.log_IQ0_cov,
+                             self.pore_model)
+
+    # Calculate the sample properties over grids of the PDSP inputs without
+    # refitting, see calc_PDSP_sensitivity
+    def sensitivity(self, contrasts, densities, r_SSA_values, num_pts_values,
+                    major_phase) -> dict:
+        return calc_PDSP_sensitivity(self.rr*10, self.f_dash_r, self.IQ0_fitted, contrasts,
+                                     densities, r_SSA_values, num_pts_values, major_phase,
+                                     self.pore_model)
+
+    def __iter__(self):
+        return (getattr(self, field) for field in self.fields)
+    
+    # Pickle only the block (the covariance of log IQ0i, if any, and the pore
+    # model), so that results sent between processes stay compact
+    def __reduce__(self):
+        return (PDSPResult, (self.block, len(self.rr), len(self.IQ_fitted), self.log_IQ0_cov,
+                             self.pore_model))
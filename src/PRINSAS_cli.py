@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+"""
+Command line interface of PRINSAS 2.0, for fitting the PDSP model to SAS data
+files without the GUI. Run 'python PRINSAS_cli.py -h' for the list of commands.
+
+The fitting parameters are given as a JSON file with the same names as the GUI
+inputs; write a file with the default values using
+    python PRINSAS_cli.py parameters params.json
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+import PDSP_core as pc
+import pore_models as pm
+import batch_fitting as bfit
+import joint_fitting as jf
+import folder_watcher as fw
+import result_store as rs
+import fitting_service as fs
+import batch_runner as br
+import multi_start as ms
+import lambda_selection as lsel
+import data_catalog as dc
+
+
+# Image formats of --figures, as figure_export.figure_formats. figure_export
+# loads matplotlib and is only imported when figures are saved
+figure_formats = ('png', 'svg', 'pdf')
+
+
+# Write the default fitting parameters into a JSON file
+def run_parameters(args):
+    bfit.save_fit_parameters(args.params_file, pc.default_fit_parameters())
+    print(f"Default fitting parameters written to {args.params_file}")
+
+
+# Fit all given files, and the files of the catalog matching the query, in
+# parallel and print a summary of the results
+def run_batch(args):
+    args.files = select_files(args)
+    params = get_parameters(args)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok = True)
+    if args.server and params['lambda_auto'] is not None:
+        raise ValueError('Automatic lambda selection is not available on the fitting service')
+    if args.server and params['uncertainty'] != 'heuristic':
+        raise ValueError('Only heuristic errors are available on the fitting service')
+    if args.server and params['pore_model'] != 'sphere':
+        raise ValueError('Only the sphere pore model is available on the fitting service')
+    if args.server and params['spline_knots'] is not None:
+        raise ValueError('Spline distributions are not available on the fitting service')
+    if args.server:
+        results = fs.fit_files_remote(args.server, args.files, params,
+                                      output_dir = args.output_dir, priority = args.priority)
+    else:
+        results = bfit.fit_files(args.files, params, processes = args.processes,
+                                 output_dir = args.output_dir)
+    print_summary(args.files, results)
+    store_results(args, results, params)
+    export_figures(args, results, params)
+
+
+# Fit the files in the given order, warm-starting each fit from the previous
+# result, and write the trend table of the series
+def run_series(args):
+    params = get_parameters(args)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok = True)
+    results = bfit.fit_series(args.files, params, output_dir = args.output_dir)
+    trend_file_dir = args.trend_file or os.path.join(args.output_dir or '', 
+                                                     'PDSP Series Trend.txt')
+    bfit.write_series_trend(trend_file_dir, args.files, results, params)
+    print_summary(args.files, results)
+    print(f"Series trend written to {trend_file_dir}")
+    store_results(args, results, params)
+    export_figures(args, results, params)
+
+
+# Jointly fit files of the same sample measured at different contrasts, with
+# one shared pore size distribution and an own distribution for the files
+# listed as independent. Results are given at the contrast of the first file
+def run_joint(args):
+    params = get_parameters(args)
+    if params['lambda_auto'] is not None:
+        raise ValueError('Automatic lambda selection is not available for joint fits')
+    if params['uncertainty'] != 'heuristic':
+        raise ValueError('Only heuristic errors are available for joint fits')
+    if params['pore_model'] != 'sphere':
+        raise ValueError('Only the sphere pore model is available for joint fits')
+    if params['spline_knots'] is not None:
+        raise ValueError('Spline distributions are not available for joint fits')
+    contrasts = args.contrasts or [params['contrast']/1e10]*len(args.files)
+    backgrounds = args.backgrounds or [params['bkgrd']]*len(args.files)
+    if len(contrasts) != len(args.files) or len(backgrounds) != len(args.files):
+        raise ValueError('One contrast and one background must be given per file')
+    if any(i < 0 or i >= len(args.files) for i in args.independent):
+        raise ValueError('Independent file index out of range')
+
+    datasets = []
+    for i, file_dir in enumerate(args.files):
+        file_params = dict(params, bkgrd = backgrounds[i])
+        QQ_trim, IQ_trim, dIQ_trim, dQ_trim, slit_length = bfit.load_SANS_file(file_dir,
+                                                                               file_params)
+        datasets.append({'QQ': QQ_trim, 'IQ': IQ_trim, 'dIQ': dIQ_trim,
+                         'contrast': contrasts[i]*1e10, 'dQ': dQ_trim,
+                         'slit_length': slit_length,
+                         'independent': i in args.independent})
+    params['contrast'] = datasets[0]['contrast']
+    joint_result = jf.fit_PDSP_joint(datasets, params['pts_per_dec'], params['lambda_'],
+                                     *bfit.result_parameters(params)[1:])
+
+    file_names = ['shared'] + [os.path.basename(file_dir) + ' (independent)'
+                               for i, file_dir in enumerate(args.files)
+                               if i in args.independent]
+    results = [joint_result.shared] + [joint_result.independent[i]
+                                       for i in range(len(args.files))
+                                       if i in args.independent]
+    print_summary(file_names, results)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok = True)
+        data_file_name = ' + '.join(os.path.basename(file_dir) for file_dir in args.files)
+        for file_name, PDSP_result in zip(file_names, results):
+            save_file_dir = os.path.join(args.output_dir,
+                                         'PDSP Joint Result ' + file_name + '.txt')
+            pc.write_PDSP_result(save_file_dir, data_file_name, params, PDSP_result)
+
+
+# Watch a folder and fit new data files as they are written
+def run_watch(args):
+    watcher = fw.FolderWatcher(args.folder, get_parameters(args), args.output_dir,
+                               args.processes, args.max_queue, args.settle_time,
+                               args.poll_interval, args.patterns, args.skip_existing)
+    watcher.run(once = args.once)
+
+
+# Run the fitting service until interrupted
+def run_serve(args):
+    service = fs.FittingService(args.host, args.port, args.processes)
+    print(f"Fitting service running at {service.url} with {service.processes} workers, "
+          "Ctrl+C to stop")
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.shutdown()
+
+
+# Fit all files with every parameter set, skipping the work units finished
+# by a previous run into the same output folder
+def run_checkpointed(args):
+    if args.parameters:
+        param_sets = [(os.path.splitext(os.path.basename(params_file_dir))[0],
+                       bfit.load_fit_parameters(params_file_dir))
+                      for params_file_dir in args.parameters]
+    else:
+        param_sets = [('default', pc.default_fit_parameters())]
+    runner = br.BatchRunner(args.files, param_sets, args.output_dir, args.processes)
+    results = runner.run()
+    print(f"{sum(result is not None for result in results)} of {len(results)} work units "
+          f"finished. Summary written to {os.path.join(args.output_dir, br.summary_file_name)}")
+
+
+# Fit each file from several starting values in parallel, keep the best fit
+# and print the spread over the starts
+def run_multi_start(args):
+    params = get_parameters(args)
+    if params['spline_knots'] is not None:
+        raise ValueError('Spline distributions are not available for multi-start fits')
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok = True)
+    results = []
+    for file_dir in args.files:
+        QQ_trim, IQ_trim, dIQ_trim, dQ_trim, slit_length = bfit.load_SANS_file(file_dir, params)
+        fitter = bfit.create_fitter(QQ_trim, dQ_trim, slit_length, params)
+        file_params = bfit.resolve_lambda(params, fitter, IQ_trim, dIQ_trim)
+        PDSP_result, spread = ms.fit_PDSP_model_multi_start(
+            QQ_trim, IQ_trim, dIQ_trim, file_params['pts_per_dec'], file_params['lambda_'],
+            *bfit.result_parameters(file_params), dQ_trim, slit_length,
+            num_starts = args.starts, processes = args.processes,
+            uncertainty = file_params['uncertainty'], pore_model = file_params['pore_model'])
+        print(os.path.basename(file_dir))
+        print('\n'.join(ms.format_spread(spread)) + '\n')
+        if args.output_dir:
+            pc.write_PDSP_result(os.path.join(args.output_dir, pc.result_file_name(file_dir)),
+                                 os.path.basename(file_dir), file_params, PDSP_result)
+        results.append(PDSP_result)
+    print_summary(args.files, results)
+
+
+# Fit each file once and calculate its porosity, pore volume and SSA over
+# grids of contrast, density and SSA extrapolation without refitting. The
+# grids are 'start:stop:num' or comma separated lists, by default the values
+# of the fitting parameters
+def run_sensitivity(args):
+    params = get_parameters(args)
+    grids = [pc.parse_parameter_grid(args.contrasts)*1e10 if args.contrasts
+             else [params['contrast']],
+             pc.parse_parameter_grid(args.densities) if args.densities
+             else [params['density']],
+             pc.parse_parameter_grid(args.r_SSA) if args.r_SSA
+             else [params['r_SSA_extrapolate']],
+             pc.parse_parameter_grid(args.num_pts_SSA, int) if args.num_pts_SSA
+             else [params['num_pts_SSA_extrapolate']]]
+    if any(np.any(np.asarray(values) <= 0) for values in grids):
+        raise ValueError('All sensitivity grid values must be > 0')
+    output_dir = args.output_dir or ''
+    if output_dir:
+        os.makedirs(output_dir, exist_ok = True)
+    for file_dir in args.files:
+        PDSP_result = bfit.fit_SANS_file(file_dir, params, args.output_dir)
+        sensitivity = PDSP_result.sensitivity(*grids, params['major_phase'])
+        save_file_dir = os.path.join(output_dir, pc.sensitivity_file_name(file_dir))
+        pc.write_PDSP_sensitivity(save_file_dir, os.path.basename(file_dir), sensitivity)
+        phi, SSA = np.real(sensitivity['phi']), np.real(sensitivity['SSA_extrapolate'])
+        print('{:s}: porosity {:.4g} to {:.4g}, SSA {:.4e} to {:.4e} cm2/cm3 over {:d} '
+              'grid points, written to {:s}'.format(os.path.basename(file_dir), np.min(phi),
+                                                    np.max(phi), np.nanmin(SSA),
+                                                    np.nanmax(SSA),
+                                                    sensitivity['SSA_mass'].size,
+                                                    save_file_dir))
+
+
+# Index the data files of the folders into the catalog. Only new and changed
+# files are parsed, files no longer in the folders are removed
+def run_index(args):
+    num_indexed, num_unchanged, num_removed = dc.index_folders(args.catalog, args.folders,
+                                                               not args.no_recursive,
+                                                               args.processes)
+    print(f"{num_indexed} files indexed, {num_unchanged} unchanged and {num_removed} "
+          f"removed in {args.catalog}")
+
+
+# Print the data files of the catalog matching the query, with their Q range,
+# number of points, delimiter and header entries
+def run_find(args):
+    entries = query_catalog(args, include_errors = args.errors)
+    for entry in entries:
+        print(entry['path'] + '\t' + dc.describe_entry(entry))
+    print(f"{len(entries)} files found")
+
+
+# Return the catalog entries matching the query options
+def query_catalog(args, include_errors = False):
+    return dc.query_catalog(args.catalog, name = args.name, text = args.text,
+                            folder = args.folder, Q_from = args.Q_from, Q_to = args.Q_to,
+                            min_points = args.min_points, include_errors = include_errors)
+
+
+# Return the given files followed by the files of the catalog matching the
+# query options, if a catalog is given
+def select_files(args):
+    files = list(args.files)
+    if args.catalog:
+        files += [entry['path'] for entry in query_catalog(args) if entry['path'] not in files]
+    if not files:
+        raise ValueError('No data files given or found in the catalog')
+    return files
+
+
+# Return the fitting parameters from the parameter file, if given, with the
+# λ selection method of --lambda-auto, the error estimate of --uncertainty,
+# the pore model of --pore-model and the spline knots of --spline-knots
+def get_parameters(args):
+    if args.parameters:
+        params = bfit.load_fit_parameters(args.parameters)
+    else:
+        params = pc.default_fit_parameters()
+    if args.lambda_auto:
+        params['lambda_auto'] = args.lambda_auto
+    if args.uncertainty:
+        params['uncertainty'] = args.uncertainty
+    if args.pore_model:
+        pm.check_pore_model(args.pore_model)
+        params['pore_model'] = args.pore_model
+    if args.spline_knots is not None:
+        pc.check_spline_knots(args.spline_knots)
+        params['spline_knots'] = args.spline_knots
+    return params
+
+
+# Append the results to the HDF5 result store, if given
+def store_results(args, results, params):
+    if args.store:
+        num_stored = rs.store_fit_results(args.store, args.files, results, params)
+        print(f"{num_stored} results appended to {args.store}")
+
+
+# Save the plots of the results in the formats of --figures, if given
+def export_figures(args, results, params):
+    if args.figures:
+        import figure_export as fe
+        output_dir = args.output_dir or ''
+        num_exported = fe.export_figures(args.files, params, output_dir, args.figures,
+                                         results, args.processes)
+        print(f"Figures of {num_exported} files written to {os.path.abspath(output_dir)}")
+
+
+# Print porosity, average pore volume and extrapolated SSA of each file
+def print_summary(file_list, results):
+    print('\t'.join(['File', 'Porosity', 'Vpore_avg (cm3)', 'SSA (cm2/cm3)']))
+    for file_dir, PDSP_result in zip(file_list, results):
+        if PDSP_result is None:
+            print(os.path.basename(file_dir) + '\tfailed')
+            continue
+        print('{:s}\t{:.5g}\t{:.4e}\t{:.4e}'.format(os.path.basename(file_dir),
+                                                   np.real(PDSP_result.phi[0]),
+                                                   np.real(PDSP_result.Vpore_avg[0]),
+                                                   np.real(PDSP_result.SSA_extrapolate[0])))
+
+
+# Add the options shared by all fitting commands
+def add_fit_arguments(parser):
+    parser.add_argument('-p', '--parameters',
+                        help = 'JSON file of fitting parameters (default values if omitted)')
+    parser.add_argument('-j', '--processes', type = int, default = None,
+                        help = 'number of worker processes (default: number of CPUs)')
+    parser.add_argument('-o', '--output-dir', default = None,
+                        help = 'folder for the PDSP result files')
+    parser.add_argument('--lambda-auto', choices = lsel.lambda_methods, default = None,
+                        help = ('choose lambda for each file by generalised cross-validation, '
+                                'the L-curve corner or the discrepancy principle'))
+    parser.add_argument('--uncertainty', choices = pc.uncertainty_modes, default = None,
+                        help = ('estimate the errors heuristically from the fit error of I(Q), '
+                                'or propagate them from the Hessian of the fit (laplace)'))
+    parser.add_argument('--pore-model', default = None,
+                        help = ('pore model of the kernel: ' + ', '.join(pm.pore_model_factories) +
+                                ', optionally with a shape parameter, e.g. cylinder:10 '
+                                '(default: sphere)'))
+    parser.add_argument('--spline-knots', type = int, default = None,
+                        help = ('fit log IQ0 as a cubic B-spline with this number of knots '
+                                'instead of one value per r bin'))
+
+
+# Add the option saving the plots of the results
+def add_figure_argument(parser):
+    parser.add_argument('--figures', nargs = '+', choices = figure_formats, default = None,
+                        help = ('save the SAS data, fit, dV/dr and f(r)/SSA plots of each file '
+                                'in these formats, rendered in parallel without the GUI'))
+
+
+# Add the options selecting data files from the catalog
+def add_query_arguments(parser):
+    parser.add_argument('--name', default = None,
+                        help = "file name pattern, e.g. '*.ABS' (case-insensitive)")
+    parser.add_argument('--text', default = None,
+                        help = 'text in the file name or the header, e.g. a DATAFILE= value')
+    parser.add_argument('--folder', default = None,
+                        help = 'only files in this folder and its subfolders')
+    parser.add_argument('--q-from', dest = 'Q_from', type = float, default = None,
+                        help = 'only files with data from this Q or lower (A-1)')
+    parser.add_argument('--q-to', dest = 'Q_to', type = float, default = None,
+                        help = 'only files with data up to this Q or higher (A-1)')
+    parser.add_argument('--min-points', type = int, default = None,
+                        help = 'only files with at least this number of data points')
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog = 'PRINSAS_cli',
+                                     description = 'Fit the PDSP model to SAS data files.')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    parser_params = subparsers.add_parser('parameters',
+                                          help = 'write the default fitting parameters')
+    parser_params.add_argument('params_file')
+    parser_params.set_defaults(func = run_parameters)
+
+    parser_batch = subparsers.add_parser('batch',
+                                         help = 'fit many files in parallel')
+    parser_batch.add_argument('files', nargs = '*')
+    add_fit_arguments(parser_batch)
+    parser_batch.add_argument('-c', '--catalog', default = None,
+                              help = ('also fit the files of this catalog matching '
+                                      '--name, --text, --folder, --q-from, --q-to '
+                                      'and --min-points'))
+    add_query_arguments(parser_batch)
+    parser_batch.add_argument('-s', '--store', default = None,
+                              help = 'HDF5 result store to append the results to')
+    parser_batch.add_argument('--server', default = None,
+                              help = ('fit on the fitting service at this address, '
+                                      f'e.g. {fs.default_service_url}'))
+    parser_batch.add_argument('--priority', type = int, default = 0,
+                              help = 'job priority on the fitting service (higher first)')
+    add_figure_argument(parser_batch)
+    parser_batch.set_defaults(func = run_batch)
+
+    parser_series = subparsers.add_parser('series', 
+                                          help = ('fit an ordered series of files, '
+                                                  'warm-starting from the previous fit'))
+    parser_series.add_argument('files', nargs = '+', help = 'data files in series order')
+    add_fit_arguments(parser_series)
+    parser_series.add_argument('-t', '--trend-file', default = None,
+                               help = 'trend table file (default: PDSP Series Trend.txt)')
+    parser_series.add_argument('-s', '--store', default = None,
+                               help = 'HDF5 result store to append the results to')
+    add_figure_argument(parser_series)
+    parser_series.set_defaults(func = run_series)
+
+    parser_joint = subparsers.add_parser('joint',
+                                         help = ('jointly fit files measured at different '
+                                                 'contrasts with a shared distribution'))
+    parser_joint.add_argument('files', nargs = '+', help = 'data files, reference first')
+    add_fit_arguments(parser_joint)
+    parser_joint.add_argument('-c', '--contrasts', type = float, nargs = '+', default = None,
+                              help = ('contrast of each file for the shared distribution '
+                                      '(1e10 cm-2, default: contrast parameter)'))
+    parser_joint.add_argument('-b', '--backgrounds', type = float, nargs = '+', default = None,
+                              help = 'background of each file (cm-1, default: bkgrd parameter)')
+    parser_joint.add_argument('-i', '--independent', type = int, nargs = '+', default = [],
+                              help = ('indices (from 0) of the files with an additional '
+                                      'distribution of their own'))
+    parser_joint.set_defaults(func = run_joint)
+
+    parser_multi = subparsers.add_parser('multistart',
+                                         help = ('fit each file from several starting values '
+                                                 'in parallel and keep the best fit'))
+    parser_multi.add_argument('files', nargs = '+')
+    add_fit_arguments(parser_multi)
+    parser_multi.add_argument('-n', '--starts', type = int, default = 8,
+                              help = 'number of starting values per file (default: 8)')
+    parser_multi.set_defaults(func = run_multi_start)
+
+    parser_sens = subparsers.add_parser('sensitivity',
+                                        help = ('fit each file once and tabulate porosity and '
+                                                'SSA over grids of contrast, density and SSA '
+                                                'extrapolation'))
+    parser_sens.add_argument('files', nargs = '+')
+    add_fit_arguments(parser_sens)
+    grid_help = " grid, 'start:stop:num' or a comma separated list (default: parameter value)"
+    parser_sens.add_argument('--contrasts', default = None,
+                             help = 'contrast (1e10 cm-2)' + grid_help)
+    parser_sens.add_argument('--densities', default = None,
+                             help = 'sample bulk density (g/cm3)' + grid_help)
+    parser_sens.add_argument('--r-ssa', dest = 'r_SSA', default = None,
+                             help = 'pore radius of the SSA extrapolation (nm)' + grid_help)
+    parser_sens.add_argument('--num-pts-ssa', dest = 'num_pts_SSA', default = None,
+                             help = 'number of points of the SSA extrapolation' + grid_help)
+    parser_sens.set_defaults(func = run_sensitivity)
+
+    parser_run = subparsers.add_parser('run',
+                                       help = ('fit files with one or more parameter sets, '
+                                               'checkpointed; rerun to resume'))
+    parser_run.add_argument('files', nargs = '+')
+    parser_run.add_argument('-p', '--parameters', nargs = '+', default = None,
+                            help = 'JSON files of the parameter sets (default values if omitted)')
+    parser_run.add_argument('-j', '--processes', type = int, default = None,
+                            help = 'number of worker processes (default: number of CPUs)')
+    parser_run.add_argument('-o', '--output-dir', required = True,
+                            help = 'folder for the results and the journal of the run')
+    parser_run.set_defaults(func = run_checkpointed)
+
+    parser_watch = subparsers.add_parser('watch',
+                                         help = 'fit new data files as they appear in a folder')
+    parser_watch.add_argument('folder')
+    add_fit_arguments(parser_watch)
+    parser_watch.add_argument('--patterns', nargs = '+', default = ['*'],
+                              help = "file name patterns to fit, e.g. '*.ABS' (default: all)")
+    parser_watch.add_argument('--settle-time', type = float, default = 2,
+                              help = 'seconds a file must stay unchanged before fitting (default: 2)')
+    parser_watch.add_argument('--poll-interval', type = float, default = 1,
+                              help = 'seconds between folder scans (default: 1)')
+    parser_watch.add_argument('--max-queue', type = int, default = None,
+                              help = 'maximum number of files queued for the workers '
+                                     '(default: twice the number of workers)')
+    parser_watch.add_argument('--skip-existing', action = 'store_true',
+                              help = 'only fit files written after the start')
+    parser_watch.add_argument('--once', action = 'store_true',
+                              help = 'exit once all files in the folder are fitted')
+    parser_watch.set_defaults(func = run_watch)
+
+    parser_index = subparsers.add_parser('index',
+                                         help = ('index the data files of folders into a '
+                                                 'catalog; rerun to update'))
+    parser_index.add_argument('catalog', help = f'catalog file, e.g. {dc.default_catalog_name!r}')
+    parser_index.add_argument('folders', nargs = '+')
+    parser_index.add_argument('-j', '--processes', type = int, default = None,
+                              help = 'number of worker processes (default: number of CPUs)')
+    parser_index.add_argument('--no-recursive', action = 'store_true',
+                              help = 'do not index the subfolders')
+    parser_index.set_defaults(func = run_index)
+
+    parser_find = subparsers.add_parser('find',
+                                        help = 'list the data files of a catalog')
+    parser_find.add_argument('catalog')
+    add_query_arguments(parser_find)
+    parser_find.add_argument('--errors', action = 'store_true',
+                             help = 'also list the files that cannot be read')
+    parser_find.set_defaults(func = run_find)
+
+    parser_serve = subparsers.add_parser('serve', 
+                                         help = 'run the local fitting service')
+    parser_serve.add_argument('--host', default = '127.0.0.1',
+                              help = 'address to listen on (default: localhost only)')
+    parser_serve.add_argument('--port', type = int, default = 8765)
+    parser_serve.add_argument('-j', '--processes', type = int, default = None,
+                              help = 'number of worker processes (default: number of CPUs)')
+    parser_serve.set_defaults(func = run_serve)
+    return parser
+
+
+def main(argv = None):
+    args = create_parser().parse_args(argv)
+    try:
+        args.func(args)
+    except (ValueError, OSError) as e:
+        print('Error: ' + str(e), file = sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Fitting of many SAS data files with the same fitting parameters in parallel
+worker processes. Kernels of Q grids shared by several files are calculated
+once and published to the workers through shared_kernels.
+"""
+
+import os
+import json
+import functools
+import collections
+import concurrent.futures
+import numpy as np
+import PDSP_core as pc
+import pore_models as pm
+import shared_kernels as sk
+import lambda_selection as lsel
+
+
+# Read the fitting parameters from a JSON file, using the default value for
+# any parameter not given in the file
+def load_fit_parameters(params_file_dir):
+    params = pc.default_fit_parameters()
+    with open(params_file_dir) as file:
+        params_read = json.load(file)
+    unknown_params = set(params_read) - set(params)
+    if unknown_params:
+        raise ValueError('Unknown fitting parameters: ' + ', '.join(sorted(unknown_params)))
+    params.update(params_read)
+    if params['lambda_auto'] is not None:
+        lsel.check_lambda_method(params['lambda_auto'])
+    pc.check_uncertainty_mode(params['uncertainty'])
+    pm.check_pore_model(params['pore_model'])
+    pc.check_spline_knots(params['spline_knots'])
+    return params
+
+
+# Write the fitting parameters into a JSON file
+def save_fit_parameters(params_file_dir, params):
+    with open(params_file_dir, 'w') as file:
+        json.dump(params, file, indent = 4)
+
+
+# Return the measurement error chosen in the same way as the GUI: dI(Q) read
+# from the data file, or a percentage of I(Q)
+def choose_dIQ(QQ, IQ, dIQ_data, params):
+    if params['dIQ_percent'] is None and pc.has_valid_dIQ(QQ, IQ, dIQ_data):
+        return dIQ_data
+    return IQ*(params['dIQ_percent'] or 2)/100
+
+
+# Read a SAS data file with the measurement error chosen in the same way as
+# the GUI: dI(Q) from the file, or a percentage of I(Q). Return QQ, IQ, dIQ
+def load_SANS_data(file_dir, params):
+    QQ, IQ, dIQ_data = pc.read_SANS_data(file_dir)
+    return QQ, IQ, choose_dIQ(QQ, IQ, dIQ_data, params)
+
+
+# Read a SAS data file and prepare it for the PDSP fit in the same way as the
+# GUI: choose the measurement error, subtract the background, trim the Q range
+# and obtain the instrument resolution.
+# Return QQ_trim, IQ_trim, dIQ_trim, dQ_trim, slit_length
+def load_SANS_file(file_dir, params):
+    QQ, IQ, dIQ_data = pc.read_SANS_data(file_dir)
+    return prepare_SANS_data(QQ, IQ, dIQ_data, params,
+                             functools.partial(pc.read_SANS_resolution, file_dir),
+                             os.path.basename(file_dir))
+
+
+# Prepare data read from a SAS data file for the PDSP fit as load_SANS_file.
+# read_resolution returns the instrument resolution of the file as 
+# pc.read_SANS_resolution, it is only called if the resolution is used.
+# Return QQ_trim, IQ_trim, dIQ_trim, dQ_trim, slit_length
+def prepare_SANS_data(QQ, IQ, dIQ_data, params, read_resolution, file_name):
+    dIQ = choose_dIQ(QQ, IQ, dIQ_data, params)
+    QQ_trim, IQ_trim, dIQ_trim = pc.subtract_background(QQ, IQ, dIQ, params['bkgrd'],
+                                                        params['Qmin'], params['Qmax'])
+
+    dQ_trim, slit_length = None, None
+    if params['resolution'] == 'dQ from data':
+        QQ_resolution, dQ_resolution, _ = read_resolution()
+        if dQ_resolution is None:
+            raise ValueError('No dQ column found in ' + file_name)
+        dQ_trim = np.interp(QQ_trim, QQ_resolution, dQ_resolution)
+    elif params['resolution'] == 'Slit length':
+        slit_length = params['slit_length'] or read_resolution()[2]
+        if not slit_length:
+            raise ValueError('No slit length given for ' + file_name)
+    return QQ_trim, IQ_trim, dIQ_trim, dQ_trim, slit_length
+
+
+# Return the PDSPFitter of the trimmed data for the fitting parameters
+def create_fitter(QQ_trim, dQ_trim, slit_length, params):
+    return pc.PDSPFitter(QQ_trim, params['pts_per_dec'], dQ_trim, slit_length,
+                         params['pore_model'])
+
+
+# Fit the data with the fitter, per r_i or as a B-spline of log IQ0i as chosen
+# by params['spline_knots'], starting from log_IQ0_guessed if given. Return as
+# in pc.PDSPFitter.fit
+def fit_data(fitter, IQ, dIQ, params, log_IQ0_guessed = None):
+    if params['spline_knots'] is None:
+        return fitter.fit(IQ, dIQ, params['lambda_'], log_IQ0_guessed)
+    return fitter.fit_spline(IQ, dIQ, params['lambda_'], params['spline_knots'],
+                             log_IQ0_guessed)
+
+
+# Return the fitting parameters of the data, with lambda_ replaced by the
+# value chosen by the method params['lambda_auto'] if set. The given lambda_
+# is used as the reference λ of the selection
+def resolve_lambda(params, fitter, IQ, dIQ):
+    if params['lambda_auto'] is None:
+        return params
+    lambda_, _ = lsel.select_lambda(fitter, IQ, dIQ, params['lambda_auto'],
+                                    lambda_ref = params['lambda_'])
+    return dict(params, lambda_ = lambda_)
+
+
+# Load and fit a SAS data file. Return the fitting parameters with the λ used
+# for the fit, the trimmed data as load_SANS_file and the PDSP result
+def load_and_fit_SANS_file(file_dir, params):
+    QQ_trim, IQ_trim, dIQ_trim, dQ_trim, slit_length = load_SANS_file(file_dir, params)
+    fitter = create_fitter(QQ_trim, dQ_trim, slit_length, params)
+    params = resolve_lambda(params, fitter, IQ_trim, dIQ_trim)
+    IQ0_fitted, IQ_fitted = fit_data(fitter, IQ_trim, dIQ_trim, params)
+    PDSP_result = calc_fit_result(fitter, IQ_trim, dIQ_trim, IQ0_fitted, IQ_fitted, params)
+    return params, (QQ_trim, IQ_trim, dIQ_trim, dQ_trim, slit_length), PDSP_result
+
+
+# Fit the PDSP model to a SAS data file. If output_dir is given, the result is
+# also written into the PDSP result file of the data file in output_dir, with
+# the λ used for the fit
+def fit_SANS_file(file_dir, params, output_dir = None):
+    params, _, PDSP_result = load_and_fit_SANS_file(file_dir, params)
+    if output_dir is not None:
+        pc.write_PDSP_result(os.path.join(output_dir, pc.result_file_name(file_dir)),
+                             os.path.basename(file_dir), params, PDSP_result)
+    return PDSP_result
+
+
+# Fit a SAS data file as fit_SANS_file, for a program keeping its own fit
+# cache (e.g. the GUI fitting its workspace in worker processes). Return the
+# fit cache key of the fit (see pc.fit_key), the trimmed QQ and IQ, and the
+# PDSP result
+def fit_SANS_file_keyed(file_dir, params):
+    params, (QQ_trim, IQ_trim, dIQ_trim, dQ_trim, slit_length), PDSP_result = \
+        load_and_fit_SANS_file(file_dir, params)
+    key = pc.fit_key(QQ_trim, IQ_trim, dIQ_trim, params['pts_per_dec'], params['lambda_'],
+                     *result_parameters(params), dQ_trim, slit_length,
+                     uncertainty = params['uncertainty'], pore_model = params['pore_model'],
+                     spline_knots = params['spline_knots'])
+    return key, QQ_trim, IQ_trim, PDSP_result
+
+
+# Return the parameters required for calculating the sample properties from
+# the PDSP fit, in the order of the arguments of pc.calc_PDSP_result
+def result_parameters(params):
+    return (params['contrast'], params['density'], params['r_SSA_extrapolate'],
+            params['num_pts_SSA_extrapolate'], params['major_phase'])
+
+
+# Estimate the errors and calculate the sample properties of the last fit of
+# the fitter, with the error estimate chosen by params['uncertainty']
+def calc_fit_result(fitter, IQ, dIQ, IQ0_fitted, IQ_fitted, params):
+    log_IQ0_cov = (fitter.calc_log_IQ0_covariance(np.log10(IQ0_fitted), params['lambda_'])
+                   if params['uncertainty'] == 'laplace' else None)
+    return fitter.calc_result(IQ, dIQ, IQ0_fitted, IQ_fitted, *result_parameters(params),
+                              log_IQ0_cov)
+
+
+# Calculate the kernels of the Q grids shared by more than one of the data
+# files and publish them into kernel_store. Kernels used by a single file are
+# left to be calculated by the worker fitting that file
+def publish_shared_kernels(file_list, params, kernel_store):
+    fitter_inputs = collections.defaultdict(list)
+    for file_dir in file_list:
+        try:
+            QQ_trim, _, _, dQ_trim, slit_length = load_SANS_file(file_dir, params)
+        except (ValueError, OSError):
+            continue    # reported when the file is fitted
+        key = pc.hash_arrays(QQ_trim, dQ_trim, slit_length)
+        fitter_inputs[key].append((QQ_trim, dQ_trim, slit_length))
+
+    for inputs in fitter_inputs.values():
+        if len(inputs) > 1:
+            QQ_trim, dQ_trim, slit_length = inputs[0]
+            try:
+                fitter = create_fitter(QQ_trim, dQ_trim, slit_length, params)
+            except ValueError:
+                continue
+            kernel_store.publish(fitter.kernel_key, fitter.eq4_fraction_2D)
+
+
+# Fit the PDSP model to all files in file_list with the same parameters in
+# parallel worker processes. Results are written into output_dir if given.
+# Return the list of PDSP results in the order of file_list, with None for
+# files that could not be fitted
+def fit_files(file_list, params, processes = None, output_dir = None):
+    results = [None]*len(file_list)
+    with sk.SharedKernelStore() as kernel_store:
+        publish_shared_kernels(file_list, params, kernel_store)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers = processes, initializer = sk.set_shared_kernel_dir,
+                initargs = (kernel_store.kernel_dir,)) as executor:
+            fit_func = functools.partial(fit_SANS_file, params = params,
+                                         output_dir = output_dir)
+            futures = {executor.submit(fit_func, file_dir): i
+                       for i, file_dir in enumerate(file_list)}
+            # A file that cannot be read or fitted, or a failing worker, 
+            # leaves the result of the file None and the batch goes on
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    print('Cannot fit ' + os.path.basename(file_list[i]) + ': ' + 
+                          (str(e) or type(e).__name__))
+    return results
+
+
+# Fit an ordered series of SAS data files, e.g. pressure or contrast-matching
+# steps, starting the fit of each file from the result of the previous file
+# instead of the crude initial guess. The PDSPFitter, and hence its kernel, is
+# reused while the Q grid and resolution stay the same.
+# Return the list of PDSP results in the order of file_list, with None for 
+# files that could not be fitted
+def fit_series(file_list, params, output_dir = None):
+    results = [None]*len(file_list)
+    fitter, fitter_key = None, None
+    logR_prev, log_IQ0_prev = None, None
+    for i, file_dir in enumerate(file_list):
+        try:
+            QQ_trim, IQ_trim, dIQ_trim, dQ_trim, slit_length = load_SANS_file(file_dir, params)
+            key = pc.hash_arrays(QQ_trim, dQ_trim, slit_length)
+            if key != fitter_key:
+                fitter = create_fitter(QQ_trim, dQ_trim, slit_length, params)
+                fitter_key = key
+            file_params = resolve_lambda(params, fitter, IQ_trim, dIQ_trim)
+            log_IQ0_guessed = (None if log_IQ0_prev is None else
+                               fitter.warm_start_log_IQ0(logR_prev, log_IQ0_prev, IQ_trim))
+            IQ0_fitted, IQ_fitted = fit_data(fitter, IQ_trim, dIQ_trim, file_params,
+                                             log_IQ0_guessed)
+            results[i] = calc_fit_result(fitter, IQ_trim, dIQ_trim, IQ0_fitted, IQ_fitted,
+                                         file_params)
+        except (ValueError, OSError) as e:
+            fitter, fitter_key = None, None
+            print('Cannot fit ' + os.path.basename(file_dir) + ': ' + str(e))
+            continue
+        logR_prev, log_IQ0_prev = fitter.logR_1D, np.log10(IQ0_fitted)
+        print('Fitted {:s} ({:d} iterations)'.format(os.path.basename(file_dir),
+                                                     fitter.optimize_result.nit))
+        
+        if output_dir is not None:
+            pc.write_PDSP_result(os.path.join(output_dir, pc.result_file_name(file_dir)),
+                                 os.path.basename(file_dir), file_params, results[i])
+    return results
+
+
+# Write the trend of porosity, average pore volume and extrapolated SSA across
+# a series of fits into a tab-separated text file
+def write_series_trend(save_file_dir, file_list, results, params):
+    with open(save_file_dir, 'w') as file:
+        file.write('PDSP Series Trend\n\n')
+        file.write('SSA interpolated to r = {:.2f} nm\n\n'.format(params['r_SSA_extrapolate']))
+        file.write('\t'.join(['Step', 'File', 'Porosity', 'dPorosity', 
+                              'Vpore_avg (cm3)', 'dVpore_avg (cm3)', 
+                              'SSA (cm2/cm3)', 'dSSA (cm2/cm3)']) + '\n')
+        for step, (file_dir, PDSP_result) in enumerate(zip(file_list, results)):
+            line = [str(step), os.path.basename(file_dir)]
+            if PDSP_result is None:
+                line += ['nan']*6
+            else:
+                for val in (PDSP_result.phi, PDSP_result.Vpore_avg, 
+                            PDSP_result.SSA_extrapolate):
+                    line += ['{:.5e}'.format(np.real(val[0])),
+                             '{:.5e}'.format(np.real(val[1]*val[0]))]
+            file.write('\t'.join(line) + '\n')
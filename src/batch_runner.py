@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpointed batch fitting for long runs. Every combination of a data file
+and a parameter set is a work unit. Units are fitted in parallel worker
+processes, each unit's results are written atomically (under a temporary name,
+then renamed), and every completed unit is recorded in an append-only journal
+in the output folder. Rerunning the same command after a crash or pre-emption
+skips the finished units, recovers units whose results were written but not
+yet journaled, and refits the units that were interrupted.
+
+Output folder layout:
+    PDSP Batch Journal.jsonl    journal of started, finished and failed units
+    PDSP Batch Summary.txt      porosity, average pore volume and SSA per unit
+    <parameter set>/            PDSP result files of the units of a parameter set
+    units/<unit id>.npz         PDSP result block of each finished unit
+"""
+
+import os
+import json
+import time
+import hashlib
+import datetime
+import concurrent.futures
+import numpy as np
+import PDSP_core as pc
+import batch_fitting as bfit
+import shared_kernels as sk
+
+
+journal_file_name = 'PDSP Batch Journal.jsonl'
+summary_file_name = 'PDSP Batch Summary.txt'
+
+
+# Return the id of the work unit fitting the data file with the parameters.
+# The id depends on the content of the file, so a changed file is refitted
+def unit_id(file_dir, params):
+    hash_obj = hashlib.sha1()
+    with open(file_dir, 'rb') as file:
+        hash_obj.update(file.read())
+    hash_obj.update(json.dumps(params, sort_keys = True).encode())
+    return hash_obj.hexdigest()
+
+
+# Write a file atomically: write_func writes into a temporary file in the same
+# folder, which then replaces the target
+def write_atomic(file_dir, write_func):
+    tmp_file = file_dir + '.{:d}.tmp'.format(os.getpid())
+    write_func(tmp_file)
+    os.replace(tmp_file, file_dir)
+
+
+# Fit a work unit in a worker process and write its result file and result
+# block. The kernel is published for the other workers
+def fit_unit(file_dir, params, result_file_dir, block_file_dir):
+    start_time = time.monotonic()
+    QQ_trim, IQ_trim, dIQ_trim, dQ_trim, slit_length = bfit.load_SANS_file(file_dir, params)
+    fitter = bfit.create_fitter(QQ_trim, dQ_trim, slit_length, params)
+    sk.publish_kernel(fitter.kernel_key, fitter.eq4_fraction_2D)
+    params = bfit.resolve_lambda(params, fitter, IQ_trim, dIQ_trim)
+    IQ0_fitted, IQ_fitted = bfit.fit_data(fitter, IQ_trim, dIQ_trim, params)
+    PDSP_result = bfit.calc_fit_result(fitter, IQ_trim, dIQ_trim, IQ0_fitted, IQ_fitted,
+                                       params)
+
+    write_atomic(result_file_dir,
+                 lambda tmp_file: pc.write_PDSP_result(tmp_file, os.path.basename(file_dir),
+                                                       params, PDSP_result))
+    # The block is written last, its presence marks a completed unit
+    def write_block(tmp_file):
+        with open(tmp_file, 'wb') as file:
+            np.savez(file, block = PDSP_result.block,
+                     shape = [len(PDSP_result.rr), len(PDSP_result.IQ_fitted)])
+    write_atomic(block_file_dir, write_block)
+    return PDSP_result, time.monotonic() - start_time
+
+
+# Return the PDSP result stored in a result block file
+def load_unit_result(block_file_dir):
+    with np.load(block_file_dir) as stored:
+        return pc.PDSPResult(stored['block'], *stored['shape'])
+
+
+# Class running a checkpointed batch fit of all files with all parameter sets.
+# param_sets is a list of (name, params), the name is used as the folder of
+# the result files of the parameter set
+class BatchRunner:
+    def __init__(self, file_list, param_sets, output_dir, processes = None):
+        if len(set(name for name, _ in param_sets)) != len(param_sets):
+            raise ValueError('Parameter set names must be unique')
+        self.output_dir = output_dir
+        self.processes = processes
+        self.journal_file_dir = os.path.join(output_dir, journal_file_name)
+        os.makedirs(os.path.join(output_dir, 'units'), exist_ok = True)
+
+        self.units = []
+        for name, params in param_sets:
+            os.makedirs(os.path.join(output_dir, name), exist_ok = True)
+            for file_dir in file_list:
+                unit = unit_id(file_dir, params)
+                self.units.append({
+                    'unit': unit, 'file': file_dir, 'param_set': name, 'params': params,
+                    'result_file': os.path.join(output_dir, name, pc.result_file_name(file_dir)),
+                    'block_file': os.path.join(output_dir, 'units', unit + '.npz')})
+
+    # Return the last journaled event of each unit
+    def read_journal(self):
+        last_events = {}
+        if not os.path.exists(self.journal_file_dir):
+            return last_events
+        with open(self.journal_file_dir) as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue    # line cut off by a crash
+                last_events[entry['unit']] = entry['event']
+        return last_events
+
+    # Append an event of a unit to the journal and flush it to disk
+    def write_journal(self, unit, event, **info):
+        entry = {'unit': unit['unit'], 'event': event, 'file': os.path.basename(unit['file']),
+                 'param_set': unit['param_set'], 'time': time.time()}
+        entry.update(info)
+        with open(self.journal_file_dir, 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    # Fit all units that have not been finished in a previous run. Return the
+    # list of PDSP results in the order of self.units, with None for failed
+    # units. Failed units are retried when the run is repeated
+    def run(self):
+        last_events = self.read_journal()
+        results = [None]*len(self.units)
+        pending = []
+        for i, unit in enumerate(self.units):
+            if last_events.get(unit['unit']) == 'done' or os.path.exists(unit['block_file']):
+                try:
+                    results[i] = load_unit_result(unit['block_file'])
+                except (OSError, KeyError, ValueError):
+                    pending.append(i)   # block lost, refit
+                    continue
+                if last_events.get(unit['unit']) != 'done':
+                    self.write_journal(unit, 'done', recovered = True)
+            else:
+                pending.append(i)
+        num_skipped = len(self.units) - len(pending)
+        print(f"{len(self.units)} work units, {num_skipped} already finished, "
+              f"{len(pending)} to fit")
+
+        start_time = time.monotonic()
+        num_finished = 0
+        with sk.SharedKernelStore() as kernel_store:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers = self.processes, initializer = sk.set_shared_kernel_dir,
+                    initargs = (kernel_store.kernel_dir,)) as executor:
+                futures = {}
+                for i in pending:
+                    unit = self.units[i]
+                    self.write_journal(unit, 'start')
+                    futures[executor.submit(fit_unit, unit['file'], unit['params'],
+                                            unit['result_file'], unit['block_file'])] = i
+                for future in concurrent.futures.as_completed(futures):
+                    i = futures[future]
+                    unit = self.units[i]
+                    num_finished += 1
+                    try:
+                        results[i], fit_time = future.result()
+                    except Exception as e:
+                        # Any failure of the worker fails the unit only, so the
+                        # summary is still written and the unit refitted next run
+                        error = str(e) or type(e).__name__
+                        self.write_journal(unit, 'failed', error = error)
+                        status = 'failed: ' + error
+                    else:
+                        self.write_journal(unit, 'done', fit_time = fit_time)
+                        status = 'done'
+                    self.print_progress(unit, status, num_skipped + num_finished,
+                                        num_finished, len(pending) - num_finished,
+                                        time.monotonic() - start_time)
+        self.write_summary(results)
+        return results
+
+    # Print the progress of the run with the throughput and estimated time
+    # remaining of this session
+    def print_progress(self, unit, status, num_done, num_finished, num_remaining, elapsed):
+        throughput = num_finished/elapsed if elapsed > 0 else 0
+        eta = num_remaining/throughput if throughput > 0 else 0
+        print('[{:d}/{:d}] {:s} ({:s}) {:s} | {:.2f} units/s, ETA {:s}'.format(
+            num_done, len(self.units), os.path.basename(unit['file']), unit['param_set'],
+            status, throughput, str(datetime.timedelta(seconds = round(eta)))))
+
+    # Write the porosity, average pore volume and extrapolated SSA of every
+    # unit into the summary file
+    def write_summary(self, results):
+        def write_lines(tmp_file):
+            with open(tmp_file, 'w') as file:
+                file.write('PDSP Batch Summary\n\n')
+                file.write('\t'.join(['File', 'Parameter set', 'Porosity', 'Vpore_avg (cm3)',
+                                      'SSA (cm2/cm3)']) + '\n')
+                for unit, PDSP_result in zip(self.units, results):
+                    line = [os.path.basename(unit['file']), unit['param_set']]
+                    if PDSP_result is None:
+                        line += ['failed']
+                    else:
+                        line += ['{:.5g}'.format(np.real(PDSP_result.phi[0])),
+                                 '{:.4e}'.format(np.real(PDSP_result.Vpore_avg[0])),
+                                 '{:.4e}'.format(np.real(PDSP_result.SSA_extrapolate[0]))]
+                    file.write('\t'.join(line) + '\n')
+        write_atomic(os.path.join(self.output_dir, summary_file_name), write_lines)
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog of SAS data files in a local SQLite database, for finding data files
+in large archives without opening them one at a time.
+
+Indexing a folder parses every data file (see file_prefetch.data_file_extensions)
+in parallel worker processes with the delimiter detection and parsing of
+pc.read_SANS_data, and records per file
+    - path, folder, file name, modification time and size,
+    - delimiter, number of data points, Q range and whether dI(Q) is given,
+    - the header entries, 'KEY=value' (e.g. DATAFILE=, EPOCH=, SCAN_N=,
+      DATE= of ABS files) and 'Key: value' lines, of which DATAFILE, EPOCH,
+      SCAN_N and DATE are kept as columns of their own.
+Files that cannot be read are recorded with the error. Indexing again only
+parses the files whose modification time or size has changed, and removes
+the files no longer in the folders.
+"""
+
+import os
+import re
+import json
+import sqlite3
+import concurrent.futures
+import PDSP_core as pc
+import file_prefetch as fp
+
+
+# Default file name of the catalog
+default_catalog_name = 'PRINSAS Catalog.sqlite'
+
+# Columns of the catalog, as (name, SQLite type)
+catalog_columns = (('path', 'TEXT PRIMARY KEY'), ('folder', 'TEXT'), ('file_name', 'TEXT'),
+                   ('mtime_ns', 'INTEGER'), ('size', 'INTEGER'), ('delimiter', 'TEXT'),
+                   ('num_points', 'INTEGER'), ('Qmin', 'REAL'), ('Qmax', 'REAL'),
+                   ('has_dIQ', 'INTEGER'), ('datafile', 'TEXT'), ('epoch', 'NUMERIC'),
+                   ('scan_n', 'INTEGER'), ('date', 'TEXT'), ('header', 'TEXT'),
+                   ('error', 'TEXT'))
+column_names = tuple(name for name, _ in catalog_columns)
+
+# Header entries kept as columns of their own, as column: header key
+header_columns = {'datafile': 'DATAFILE', 'epoch': 'EPOCH', 'scan_n': 'SCAN_N', 'date': 'DATE'}
+
+# Names of the delimiters that are not printable
+delimiter_names = {'\t': 'tab', ' ': 'space'}
+
+# Header lines of 'KEY=value' entries, several of them separated by ';', and
+# of 'Key: value'. The space after ':' keeps times and paths in one value
+header_assignment = re.compile(r'^\s*([A-Za-z_][\w.]*)\s*=\s*(.*?)\s*$')
+header_label = re.compile(r'^\s*([A-Za-z][\w .()/-]{0,39}?)\s*:\s+(.*?)\s*$')
+
+# Number of parsed files written to the catalog per transaction
+commit_interval = 200
+
+# Maximum number of files listed by the GUI
+query_limit = 1000
+
+
+# Return the path of a file or folder as stored in the catalog
+def catalog_path(file_dir):
+    return os.path.abspath(file_dir).replace(os.sep, '/')
+
+
+# Return the header entries of the lines of a SAS data file as a dict of
+# key: value. The first entry of a key is kept
+def read_SANS_header(data_raw):
+    header = {}
+    for line in data_raw:
+        entries = [match.groups() for match in map(header_assignment.match, line.split(';'))
+                   if match]
+        if not entries:
+            match = header_label.match(line)
+            entries = [match.groups()] if match else []
+        for key, value in entries:
+            header.setdefault(key, value)
+    return header
+
+
+# Convert a header value to a number, or return None if it is not one
+def header_number(value, number_type):
+    try:
+        return number_type(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Parse a data file and return its catalog row as a dict of column: value.
+# The error column holds the reason a file cannot be read
+def read_catalog_entry(file_dir):
+    stat = os.stat(file_dir)
+    folder, file_name = file_dir.rsplit('/', 1)
+    entry = dict.fromkeys(column_names)
+    entry.update(path = file_dir, folder = folder, file_name = file_name,
+                 mtime_ns = stat.st_mtime_ns, size = stat.st_size)
+    try:
+        with open(file_dir) as file:
+            data_raw = file.readlines()
+        header = read_SANS_header(data_raw)
+        entry['header'] = json.dumps(header)
+        upper_header = {key.upper(): value for key, value in reversed(list(header.items()))}
+        entry['datafile'] = upper_header.get(header_columns['datafile'])
+        epoch = upper_header.get(header_columns['epoch'])
+        entry['epoch'] = header_number(epoch, int) or header_number(epoch, float)
+        entry['scan_n'] = header_number(upper_header.get(header_columns['scan_n']), int)
+        entry['date'] = upper_header.get(header_columns['date'])
+
+        entry['delimiter'] = str(pc.find_delimiter(data_raw))
+        QQ, IQ, dIQ = pc.parse_SANS_data(data_raw, entry['delimiter'])
+        entry['num_points'] = len(QQ)
+        entry['Qmin'], entry['Qmax'] = float(QQ.min()), float(QQ.max())
+        entry['has_dIQ'] = int(pc.has_valid_dIQ(QQ, IQ, dIQ))
+    except (ValueError, OSError) as e:
+        entry['error'] = str(e) or 'Cannot read file content'
+    return entry
+
+
+# Return the data files of a folder, and of its subfolders if recursive is set
+def find_data_files(folder_dir, recursive = True):
+    if not recursive:
+        return fp.list_data_files(folder_dir)
+    file_list = []
+    for root, dir_names, file_names in os.walk(folder_dir):
+        dir_names.sort(key = str.lower)
+        root = root.replace(os.sep, '/')
+        file_list += [root + '/' + file_name for file_name in sorted(file_names, key = str.lower)
+                      if file_name.lower().endswith(fp.data_file_extensions)]
+    return file_list
+
+
+# Class for indexing SAS data files into and querying a SQLite catalog
+class DataCatalog:
+    def __init__(self, catalog_file_dir):
+        try:
+            self.connection = sqlite3.connect(catalog_file_dir)
+            self.connection.row_factory = sqlite3.Row
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS files (' +
+                                        ', '.join(name + ' ' + sql_type
+                                                  for name, sql_type in catalog_columns) + ')')
+                for column in ('folder', 'Qmin', 'Qmax', 'epoch'):
+                    self.connection.execute(f'CREATE INDEX IF NOT EXISTS files_{column} '
+                                            f'ON files ({column})')
+        except sqlite3.Error as e:
+            raise ValueError(f'Cannot open the catalog {catalog_file_dir}: {e}')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    # Write catalog rows, replacing the rows of the same files
+    def write_entries(self, entries):
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO files (' + ', '.join(column_names) + ') VALUES (' +
+                ', '.join('?'*len(column_names)) + ')',
+                [tuple(entry[name] for name in column_names) for entry in entries])
+
+    # Index the data files of the folders, parsing the new and changed files
+    # in parallel worker processes and removing the files that no longer
+    # exist. Return the numbers of files indexed, unchanged and removed
+    def update(self, folders, recursive = True, processes = None):
+        indexed = {row['path']: (row['mtime_ns'], row['size']) for row in
+                   self.connection.execute('SELECT path, mtime_ns, size FROM files')}
+        found, changed = set(), []
+        for folder_dir in folders:
+            if not os.path.isdir(folder_dir):
+                raise ValueError(f'{folder_dir} is not a folder')
+            for file_dir in find_data_files(catalog_path(folder_dir), recursive):
+                try:
+                    stat = os.stat(file_dir)
+                except OSError:
+                    continue
+                found.add(file_dir)
+                if indexed.get(file_dir) != (stat.st_mtime_ns, stat.st_size):
+                    changed.append(file_dir)
+
+        removed = []
+        for folder_dir in folders:
+            folder_dir = catalog_path(folder_dir)
+            removed += [file_dir for file_dir in indexed if file_dir not in found and
+                        (file_dir.startswith(folder_dir + '/') if recursive
+                         else file_dir.rsplit('/', 1)[0] == folder_dir)]
+        if removed:
+            with self.connection:
+                self.connection.executemany('DELETE FROM files WHERE path = ?',
+                                            [(file_dir,) for file_dir in set(removed)])
+
+        num_indexed = 0
+        if changed:
+            # Files removed while indexing are skipped
+            def write_parsed(entries):
+                self.write_entries([entry for entry in entries if entry is not None])
+                print(f'{num_indexed} of {len(changed)} files indexed')
+
+            with concurrent.futures.ProcessPoolExecutor(max_workers = processes) as executor:
+                entries = []
+                for entry in executor.map(try_read_catalog_entry, changed,
+                                          chunksize = max(1, min(64, len(changed)//16))):
+                    entries.append(entry)
+                    num_indexed += entry is not None
+                    if len(entries) == commit_interval:
+                        write_parsed(entries)
+                        entries = []
+                write_parsed(entries)
+        return num_indexed, len(found) - len(changed), len(set(removed))
+
+    # Return the catalog rows as dicts matching all given conditions, ordered
+    # by folder and file name:
+    #   name: file name pattern with * and ? wildcards, case-insensitive
+    #   text: text contained in the file name or the header entries
+    #   folder: folder of the files, including its subfolders
+    #   Q_from, Q_to: Q range (A-1) the data must cover
+    #   min_points: minimum number of data points
+    # Files that cannot be read are only returned if include_errors is set
+    def query(self, name = None, text = None, folder = None, Q_from = None, Q_to = None,
+              min_points = None, include_errors = False, limit = None):
+        conditions, values = [], []
+        if name:
+            conditions.append("file_name LIKE ? ESCAPE '\\'")
+            values.append(like_pattern(name, wildcards = True))
+        if text:
+            conditions.append("(file_name LIKE ? ESCAPE '\\' OR header LIKE ? ESCAPE '\\')")
+            values += ['%' + like_pattern(text) + '%']*2
+        if folder:
+            folder = catalog_path(folder)
+            conditions.append("(folder = ? OR folder LIKE ? ESCAPE '\\')")
+            values += [folder, like_pattern(folder) + '/%']
+        if Q_from is not None:
+            conditions.append('Qmin <= ?')
+            values.append(Q_from)
+        if Q_to is not None:
+            conditions.append('Qmax >= ?')
+            values.append(Q_to)
+        if min_points is not None:
+            conditions.append('num_points >= ?')
+            values.append(min_points)
+        if not include_errors:
+            conditions.append('error IS NULL')
+        sql = 'SELECT * FROM files'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY folder, file_name COLLATE NOCASE'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        return [dict(row) for row in self.connection.execute(sql, values)]
+
+
+# Parse a data file for the catalog, or return None if it no longer exists
+def try_read_catalog_entry(file_dir):
+    try:
+        return read_catalog_entry(file_dir)
+    except FileNotFoundError:
+        return None
+
+
+# Return a text as SQL LIKE pattern, converting the * and ? wildcards if set
+def like_pattern(text, wildcards = False):
+    pattern = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    if wildcards:
+        pattern = pattern.replace('*', '%').replace('?', '_')
+    return pattern
+
+
+# Index the data files of the folders into the catalog file, see DataCatalog.update
+def index_folders(catalog_file_dir, folders, recursive = True, processes = None):
+    with DataCatalog(catalog_file_dir) as catalog:
+        return catalog.update(folders, recursive, processes)
+
+
+# Return the catalog rows matching the conditions, see DataCatalog.query
+def query_catalog(catalog_file_dir, **conditions):
+    if not os.path.isfile(catalog_file_dir):
+        raise ValueError(f'Catalog {catalog_file_dir} does not exist, index a folder first')
+    with DataCatalog(catalog_file_dir) as catalog:
+        return catalog.query(**conditions)
+
+
+# Return the text of a catalog row shown in lists of files: Q range, number
+# of points, delimiter and the header columns that are set
+def describe_entry(entry):
+    if entry['error'] is not None:
+        return 'error: ' + entry['error']
+    description = ['Q {:.4g} to {:.4g} A-1'.format(entry['Qmin'], entry['Qmax']),
+                   '{:d} points'.format(entry['num_points']),
+                   'delimiter ' + delimiter_names.get(entry['delimiter'],
+                                                      repr(entry['delimiter']))]
+    for column, key in header_columns.items():
+        if entry[column] is not None:
+            description.append(key + '=' + str(entry[column]))
+    return ', '.join(description)
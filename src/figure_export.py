@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Headless export of the four PRINSAS plots (SAS data, SAS data vs. fitted
+result, dV/dr and f(r) || SSA(R)) of fitted data files as image files, without
+Qt. The figures are drawn with the same plot_formating styles and
+backend_functions plotting routines as the GUI on Agg canvases.
+
+Each worker process builds the four figures once and reuses them for every
+file: the plotting routines replace only the plotted data, so the axes,
+labels and styles are not rebuilt per image. Intermediate draws of the
+plotting routines are skipped, and each figure is rendered once per format
+when it is saved.
+
+Files written per data file into the output folder:
+    <file> PDSP SAS Data.<format>
+    <file> PDSP SAS Fit.<format>
+    <file> PDSP dVdr.<format>
+    <file> PDSP fr SSA.<format>
+"""
+
+import os
+import warnings
+import concurrent.futures
+import matplotlib.figure as mpl_figure
+import matplotlib.backends.backend_agg as mpl_agg
+import PDSP_core as pc
+import batch_fitting as bfit
+import backend_functions as bf
+import plot_formating as pf
+
+
+# Ignore UserWarning of the tick labels of the inverted Q axis, as in the GUI
+warnings.filterwarnings("ignore", category=UserWarning)
+
+# Image formats that can be exported
+figure_formats = ('png', 'svg', 'pdf')
+
+# Names of the exported figures, used in the file names, and the plot_formating
+# function setting up each of them
+figure_layouts = (('SAS Data', pf.set_SAS_plot), ('SAS Fit', pf.set_SAS_plot),
+                  ('dVdr', pf.set_dVdr_plot), ('fr SSA', pf.set_fr_SSA_plot))
+
+# Figures of this process, created on first use
+figure_templates = None
+
+
+# Agg canvas whose draw does nothing. The plotting routines draw the canvas
+# after every change, headless figures are only rendered when they are saved
+class DeferredCanvas(mpl_agg.FigureCanvasAgg):
+    def draw(self):
+        pass
+
+
+# Return the figures of this process as a dict of name: (figure, canvas),
+# creating them on the first call
+def get_figure_templates():
+    global figure_templates
+    if figure_templates is None:
+        figure_templates = {}
+        for name, set_plot in figure_layouts:
+            fig = mpl_figure.Figure()
+            canvas = DeferredCanvas(fig)
+            set_plot(fig, 1)
+            figure_templates[name] = (fig, canvas)
+    return figure_templates
+
+
+# Raise an error if a format cannot be exported
+def check_figure_formats(formats):
+    unknown_formats = set(formats) - set(figure_formats)
+    if unknown_formats:
+        raise ValueError('Unknown figure formats: ' + ', '.join(sorted(unknown_formats)) +
+                         '. Must be one of ' + ', '.join(figure_formats))
+
+
+# Return the name of the file of an exported figure of a data file
+def figure_file_name(data_file_dir, name, fmt):
+    return pc.result_file_name(data_file_dir).replace(' Result.txt', ' ' + name + '.' + fmt)
+
+
+# Plot the data file and its PDSP result into the figures, in the same way as
+# the GUI after a fit
+def plot_result(figures, QQ, IQ, dIQ, QQ_trim, IQ_trim, params, PDSP_result):
+    (fig_SAS, canvas_SAS), (fig_fit, canvas_fit) = figures['SAS Data'], figures['SAS Fit']
+    bf.clear_plot(fig_SAS, canvas_SAS)
+    bf.clear_plot(fig_fit, canvas_fit)
+    bf.clear_plot(*figures['dVdr'])
+    bf.clear_plot(*figures['fr SSA'])
+    bf.plot_SANS_data(QQ, IQ, dIQ, fig_SAS, canvas_SAS, max_pts = None)
+    bf.plot_SANS_subtract(QQ_trim, IQ_trim, QQ, params['bkgrd'], fig_SAS, canvas_SAS)
+    bf.plot_SANS_fit(QQ_trim, IQ_trim, fig_fit, canvas_fit, which = 'input')
+    bf.plot_SANS_fit(QQ_trim, PDSP_result.IQ_fitted, fig_fit, canvas_fit, which = 'result')
+    bf.plot_dVdr(PDSP_result.rr, PDSP_result.dV_dr, *figures['dVdr'])
+    bf.plot_fr_SSA(PDSP_result.rr, PDSP_result.f_r, PDSP_result.SSA,
+                   params['num_pts_SSA_extrapolate'], params['r_SSA_extrapolate'],
+                   *figures['fr SSA'])
+
+
+# Plot the PDSP result of a data file and save the figures in every format
+# into output_dir. The file is fitted first if no result is given.
+# Return the list of files written
+def export_file_figures(file_dir, params, output_dir, formats, PDSP_result = None):
+    if PDSP_result is None:
+        PDSP_result = bfit.fit_SANS_file(file_dir, params)
+    QQ, IQ, dIQ = bfit.load_SANS_data(file_dir, params)
+    QQ_trim, IQ_trim, _ = pc.subtract_background(QQ, IQ, dIQ, params['bkgrd'],
+                                                 params['Qmin'], params['Qmax'])
+    figures = get_figure_templates()
+    plot_result(figures, QQ, IQ, dIQ, QQ_trim, IQ_trim, params, PDSP_result)
+
+    saved_files = []
+    for name, (fig, _) in figures.items():
+        for fmt in formats:
+            save_file_dir = os.path.join(output_dir, figure_file_name(file_dir, name, fmt))
+            fig.savefig(save_file_dir, format = fmt)
+            saved_files.append(save_file_dir)
+    return saved_files
+
+
+# Export the figures of all files in file_list in parallel worker processes.
+# results are the PDSP results of the files (e.g. from bfit.fit_files), files
+# whose result is None are skipped; without results the files are fitted in
+# the workers. Return the number of files exported
+def export_figures(file_list, params, output_dir, formats = ('png',), results = None,
+                   processes = None):
+    check_figure_formats(formats)
+    if results is None:
+        results = [None]*len(file_list)
+        jobs = list(range(len(file_list)))
+    else:
+        jobs = [i for i, PDSP_result in enumerate(results) if PDSP_result is not None]
+
+    num_exported = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers = processes) as executor:
+        futures = {executor.submit(export_file_figures, file_list[i], params, output_dir,
+                                   formats, results[i]): i for i in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            try:
+                future.result()
+            except (ValueError, OSError) as e:
+                print('Cannot export figures of ' + os.path.basename(file_list[i]) +
+                      ': ' + str(e))
+                continue
+            num_exported += 1
+    return num_exported
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Reading ahead of the SAS data files in the folder of the chosen data file, so
+stepping through a data folder does not wait for the files to be parsed.
+
+The files next to the chosen file are parsed (pc.read_SANS_data and
+pc.read_SANS_resolution) in a worker thread and kept in a bounded cache,
+which is checked against the modification time of the files. If fitting
+parameters are given, the kernel of the PDSP fit of each file is calculated
+as well and kept in the kernel cache of PDSP_core, so fitting the file does
+not calculate it again.
+"""
+
+import os
+import threading
+import collections
+import concurrent.futures
+import PDSP_core as pc
+import batch_fitting as bfit
+
+
+# Extensions of the SAS data files, as listed by the file dialog of the GUI
+data_file_extensions = ('.txt', '.dat', '.csv', '.abs')
+
+# Number of files read ahead of the chosen file and behind it
+prefetch_ahead = 2
+prefetch_behind = 1
+
+# Number of parsed data files kept in memory
+data_cache_size = 8
+
+
+# Return the SAS data files of a folder in the order they are stepped through
+def list_data_files(folder_dir):
+    file_names = [file_name for file_name in os.listdir(folder_dir)
+                  if file_name.lower().endswith(data_file_extensions) and
+                  os.path.isfile(folder_dir + '/' + file_name)]
+    return [folder_dir + '/' + file_name for file_name in sorted(file_names, key = str.lower)]
+
+
+# Return the data file step files after data_file_dir in its folder (before it
+# if step is negative), or None if there is no such file
+def neighbour_file(data_file_dir, step):
+    file_list = list_data_files(data_file_dir.rsplit('/', 1)[0])
+    if data_file_dir not in file_list:
+        return None
+    index = file_list.index(data_file_dir) + step
+    return file_list[index] if 0 <= index < len(file_list) else None
+
+
+# Return the data files read ahead of and behind data_file_dir in its folder,
+# the nearest first
+def neighbour_files(data_file_dir):
+    file_list = list_data_files(data_file_dir.rsplit('/', 1)[0])
+    if data_file_dir not in file_list:
+        return []
+    index = file_list.index(data_file_dir)
+    steps = sorted(list(range(1, prefetch_ahead + 1)) + list(range(-prefetch_behind, 0)),
+                   key = abs)
+    return [file_list[index + step] for step in steps if 0 <= index + step < len(file_list)]
+
+
+# Read a SAS data file. Return QQ, IQ and dIQ as pc.read_SANS_data, followed by
+# QQ, dQ and slit length of the instrument resolution as pc.read_SANS_resolution
+def read_data_file(file_dir):
+    return pc.read_SANS_data(file_dir) + pc.read_SANS_resolution(file_dir)
+
+
+# Calculate the kernel of the PDSP fit of the data read by read_data_file with
+# the fitting parameters, prepared as by batch_fitting.load_SANS_file, and keep
+# it in the kernel cache
+def prefetch_kernel(data, params, file_name):
+    QQ_trim, _, _, dQ_trim, slit_length = bfit.prepare_SANS_data(*data[:3], params,
+                                                                 lambda: data[3:], file_name)
+    bfit.create_fitter(QQ_trim, dQ_trim, slit_length, params)
+
+
+# Cache of parsed SAS data files, filled by reading the files in a worker
+# thread before they are needed
+class DataFilePrefetcher:
+    def __init__(self, cache_size = data_cache_size):
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()     # file: (modification time, data)
+        self.pending = {}                          # file: future of reading it
+        self.pending_kernels = {}                  # file: future of calculating its kernel
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+
+    # Return the data of a file as read_data_file, from the cache if the file
+    # has not changed since it was read, waiting for it if it is being read.
+    # Calculating the kernel of a prefetched file is not waited for
+    def read(self, file_dir):
+        data = self.get_cached(file_dir)
+        if data is not None:
+            return data
+        with self.lock:
+            future = self.pending.get(file_dir)
+        if future is not None:
+            concurrent.futures.wait([future])
+        data = self.get_cached(file_dir)
+        if data is None:
+            data = self.load(file_dir)
+        return data
+
+    # Return the cached data of a file, or None if it is not cached or the
+    # file has changed since it was read
+    def get_cached(self, file_dir):
+        mtime = os.stat(file_dir).st_mtime_ns
+        with self.lock:
+            if file_dir in self.cache and self.cache[file_dir][0] == mtime:
+                self.cache.move_to_end(file_dir)
+                return self.cache[file_dir][1]
+        return None
+
+    # Read a file and keep its data in the cache, dropping the least recently
+    # used file if the cache is full. Return the data
+    def load(self, file_dir):
+        mtime = os.stat(file_dir).st_mtime_ns
+        data = read_data_file(file_dir)
+        with self.lock:
+            self.cache[file_dir] = (mtime, data)
+            self.cache.move_to_end(file_dir)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last = False)
+        return data
+
+    # Read the files in the worker thread, unless they are cached or being
+    # read. If params are given, the kernels of the files for these fitting
+    # parameters are calculated as well, after all files are read
+    def prefetch(self, file_dirs, params = None):
+        for file_dir in file_dirs:
+            try:
+                if self.get_cached(file_dir) is not None:
+                    continue
+            except OSError:
+                continue
+            with self.lock:
+                if file_dir not in self.pending:
+                    self.pending[file_dir] = self.executor.submit(self.prefetch_file, 
+                                                                  file_dir)
+        if params is None:
+            return
+        for file_dir in file_dirs:
+            with self.lock:
+                if file_dir not in self.pending_kernels:
+                    self.pending_kernels[file_dir] = self.executor.submit(
+                        self.prefetch_file_kernel, file_dir, params)
+
+    # Read a file in the worker thread. Files that cannot be read are skipped,
+    # the error is raised when they are read
+    def prefetch_file(self, file_dir):
+        try:
+            if self.get_cached(file_dir) is None:
+                self.load(file_dir)
+        except (ValueError, OSError):
+            pass
+        finally:
+            with self.lock:
+                del self.pending[file_dir]
+
+    # Calculate the kernel of a read file in the worker thread. Files that
+    # cannot be read or fitted are skipped
+    def prefetch_file_kernel(self, file_dir, params):
+        try:
+            data = self.get_cached(file_dir)
+            if data is not None:
+                prefetch_kernel(data, params, os.path.basename(file_dir))
+        except (ValueError, OSError):
+            pass
+        finally:
+            with self.lock:
+                del self.pending_kernels[file_dir]
+
+    # Stop reading files, dropping the files not read yet
+    def shutdown(self):
+        self.executor.shutdown(wait = False, cancel_futures = True)
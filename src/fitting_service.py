@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+Local fitting service, so that several users of one analysis server share a
+single pool of worker processes instead of each running their own fits.
+
+The service accepts PDSP fits over HTTP as JSON jobs, queues them by
+priority and fits them in a pool of worker processes. Kernels calculated by
+any worker are published through shared_kernels, so later jobs on the same
+Q grid reuse them regardless of the worker they run on, and identical jobs
+are answered from the fit cache. The service only listens on localhost by
+default. Endpoints:
+    POST   /jobs              submit a fit, returns the job id
+    GET    /jobs              status of all jobs
+    GET    /jobs/<id>         status of a job
+    GET    /jobs/<id>/result  PDSP result of a finished job
+    DELETE /jobs/<id>         cancel a queued job
+    GET    /status            number of workers and of jobs per status
+
+A job is a JSON object with the data arrays QQ, IQ, dIQ (and optionally dQ
+and slit_length), the fitting inputs pts_per_dec, lambda_, contrast, density,
+r_SSA_extrapolate, num_pts_SSA_extrapolate and major_phase as named in
+pc.default_fit_parameters, an optional integer priority (higher first,
+default 0) and an optional name. submit_fit, get_result and fit_PDSP_remote
+implement the client side.
+"""
+
+import os
+import json
+import time
+import uuid
+import queue
+import itertools
+import threading
+import functools
+import collections
+import urllib.error
+import urllib.request
+import http.server
+import concurrent.futures
+import numpy as np
+import PDSP_core as pc
+import batch_fitting as bfit
+import shared_kernels as sk
+
+
+# Default address of the fitting service
+default_service_url = 'http://127.0.0.1:8765'
+
+# Fitting inputs of a job, in the order of the arguments of pc.fit_PDSP_model
+job_parameters = ('pts_per_dec', 'lambda_', 'contrast', 'density', 'r_SSA_extrapolate',
+                  'num_pts_SSA_extrapolate', 'major_phase')
+
+
+# Fit a job in a worker process. The kernel is published for the other
+# workers if it was calculated by this worker
+def run_fit_job(QQ, IQ, dIQ, params, dQ, slit_length):
+    fitter = pc.PDSPFitter(QQ, params['pts_per_dec'], dQ, slit_length)
+    sk.publish_kernel(fitter.kernel_key, fitter.eq4_fraction_2D)
+    IQ0_fitted, IQ_fitted = fitter.fit(IQ, dIQ, params['lambda_'])
+    return fitter.calc_result(IQ, dIQ, IQ0_fitted, IQ_fitted, *bfit.result_parameters(params))
+
+
+# Return the PDSP result as a JSON-serialisable dict. Floats are written with
+# full precision, so the result is transferred exactly
+def result_to_json(PDSP_result):
+    block = PDSP_result.block
+    result = {'num_r': len(PDSP_result.rr), 'num_Q': len(PDSP_result.IQ_fitted),
+              'real': block.real.tolist()}
+    if np.iscomplexobj(block):
+        result['imag'] = block.imag.tolist()
+    return result
+
+
+# Return the PDSP result of a dict written by result_to_json
+def result_from_json(result):
+    block = np.array(result['real'])
+    if 'imag' in result:
+        block = block + 1j*np.array(result['imag'])
+    return pc.PDSPResult(block, result['num_r'], result['num_Q'])
+
+
+# Class of the fitting service. Jobs are taken from the priority queue by a
+# dispatcher thread, which keeps at most one job per worker in the process
+# pool, so a job of higher priority submitted later still overtakes queued
+# jobs of lower priority
+class FittingService:
+    def __init__(self, host = '127.0.0.1', port = 8765, processes = None,
+                 max_finished_jobs = 1000):
+        self.processes = processes or os.cpu_count() or 1
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.job_queue = queue.PriorityQueue()
+        self.job_counter = itertools.count()
+        self.free_workers = threading.Semaphore(self.processes)
+        self.kernel_store = sk.SharedKernelStore()
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers = self.processes, initializer = sk.set_shared_kernel_dir,
+            initargs = (self.kernel_store.kernel_dir,))
+        self.http_server = http.server.ThreadingHTTPServer((host, port),
+                                                           make_request_handler(self))
+        self.dispatcher = threading.Thread(target = self.dispatch_jobs, daemon = True)
+        self.dispatcher.start()
+
+    # Address of the service, with the actual port if port 0 was given
+    @property
+    def url(self):
+        host, port = self.http_server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    # Serve requests until shutdown is called
+    def serve_forever(self):
+        self.http_server.serve_forever()
+
+    # Serve requests in a background thread, e.g. for testing on localhost
+    def start(self):
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+        return self
+
+    def shutdown(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        self.job_queue.put((-np.inf, -1, None))     # stop the dispatcher
+        self.executor.shutdown(cancel_futures = True)
+        self.kernel_store.close()
+
+    # Validate a submitted job and add it to the queue. Return its status
+    def submit(self, request):
+        try:
+            QQ, IQ, dIQ = (np.asarray(request[name], dtype = float)
+                           for name in ('QQ', 'IQ', 'dIQ'))
+            params = pc.default_fit_parameters()
+            params.update({name: request[name] for name in job_parameters if name in request})
+            params['pts_per_dec'] = int(params['pts_per_dec'])
+            params['num_pts_SSA_extrapolate'] = int(params['num_pts_SSA_extrapolate'])
+            dQ = None if request.get('dQ') is None else np.asarray(request['dQ'], dtype = float)
+            slit_length = request.get('slit_length') or None
+            priority = int(request.get('priority', 0))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f'Invalid job: {e}')
+        if not (len(QQ) == len(IQ) == len(dIQ)) or (dQ is not None and len(dQ) != len(QQ)):
+            raise ValueError('Invalid job: QQ, IQ, dIQ and dQ must have the same length')
+
+        job_id = uuid.uuid4().hex
+        job = {'job_id': job_id, 'name': str(request.get('name', '')),
+               'priority': priority, 'status': 'queued', 'error': None,
+               'submitted': time.time(), 'started': None, 'finished': None,
+               'inputs': (QQ, IQ, dIQ, params, dQ, slit_length), 'result': None}
+        with self.lock:
+            self.jobs[job_id] = job
+        self.job_queue.put((-priority, next(self.job_counter), job_id))
+        return self.job_status(job_id)
+
+    # Take jobs from the queue in order of priority and submission, whenever
+    # a worker is free
+    def dispatch_jobs(self):
+        while True:
+            self.free_workers.acquire()
+            _, _, job_id = self.job_queue.get()
+            if job_id is None:
+                return
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if job is None or job['status'] != 'queued':
+                    self.free_workers.release()     # cancelled
+                    continue
+                job['status'], job['started'] = 'running', time.time()
+            QQ, IQ, dIQ, params, dQ, slit_length = job['inputs']
+
+            # Identical jobs are answered from the fit cache
+            key = pc.fit_key(QQ, IQ, dIQ, *[params[name] for name in job_parameters],
+                             dQ, slit_length)
+            with self.lock:
+                PDSP_result = pc.get_cached_fit(key)
+            if PDSP_result is not None:
+                self.finish_job(job_id, key, result = PDSP_result)
+                continue
+            try:
+                future = self.executor.submit(run_fit_job, *job['inputs'])
+            except RuntimeError:
+                return      # executor shut down
+            future.add_done_callback(functools.partial(self.finish_job, job_id, key))
+
+    # Store the result or error of a job and free its worker
+    def finish_job(self, job_id, key, future = None, result = None):
+        error = None
+        if future is not None:
+            try:
+                result = future.result()
+            except concurrent.futures.CancelledError:
+                error = 'Cancelled by shutdown'
+            except Exception as e:
+                error = str(e)
+        with self.lock:
+            job = self.jobs[job_id]
+            job['finished'] = time.time()
+            job['inputs'] = None
+            if error is None:
+                job['status'], job['result'] = 'done', result
+                pc.cache_fit(key, result, write_file = False)
+            else:
+                job['status'], job['error'] = 'failed', error
+            self.drop_finished_jobs()
+        self.free_workers.release()
+
+    # Forget the oldest finished jobs beyond max_finished_jobs
+    def drop_finished_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items()
+                    if job['status'] in ('done', 'failed', 'cancelled')]
+        for job_id in finished[:max(len(finished) - self.max_finished_jobs, 0)]:
+            del self.jobs[job_id]
+
+    # Cancel a queued job. Running and finished jobs cannot be cancelled
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs[job_id]
+            if job['status'] != 'queued':
+                raise ValueError(f"Job {job_id} is {job['status']} and cannot be cancelled")
+            job['status'], job['finished'], job['inputs'] = 'cancelled', time.time(), None
+        return self.job_status(job_id)
+
+    # Return the status of a job as a JSON-serialisable dict
+    def job_status(self, job_id):
+        with self.lock:
+            job = self.jobs[job_id]
+            return {name: job[name] for name in ('job_id', 'name', 'priority', 'status',
+                                                 'error', 'submitted', 'started', 'finished')}
+
+    # Return the number of workers and of jobs in each status
+    def service_status(self):
+        with self.lock:
+            counts = collections.Counter(job['status'] for job in self.jobs.values())
+        return {'workers': self.processes, 'jobs': dict(counts)}
+
+    # Return the PDSP result of a finished job
+    def job_result(self, job_id):
+        with self.lock:
+            job = self.jobs[job_id]
+            if job['status'] != 'done':
+                raise ValueError(f"Job {job_id} is {job['status']}" +
+                                 (f": {job['error']}" if job['error'] else ''))
+            return job['result']
+
+
+# Return the HTTP request handler class of the given service
+def make_request_handler(service):
+    class FittingRequestHandler(http.server.BaseHTTPRequestHandler):
+        def send_json(self, code, content):
+            body = json.dumps(content).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Call func with the job id of the path, answering 404 for unknown
+        # jobs and 409 for jobs in the wrong status
+        def handle_job(self, func):
+            job_id = self.path.strip('/').split('/')[1]
+            try:
+                self.send_json(200, func(job_id))
+            except KeyError:
+                self.send_json(404, {'error': f'Unknown job {job_id}'})
+            except ValueError as e:
+                self.send_json(409, {'error': str(e)})
+
+        def do_GET(self):
+            parts = self.path.strip('/').split('/')
+            if parts == ['status']:
+                self.send_json(200, service.service_status())
+            elif parts == ['jobs']:
+                with service.lock:
+                    job_ids = list(service.jobs)
+                self.send_json(200, [service.job_status(job_id) for job_id in job_ids])
+            elif len(parts) == 2 and parts[0] == 'jobs':
+                self.handle_job(service.job_status)
+            elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'result':
+                self.handle_job(lambda job_id: result_to_json(service.job_result(job_id)))
+            else:
+                self.send_json(404, {'error': 'Unknown endpoint'})
+
+        def do_POST(self):
+            if self.path.strip('/') != 'jobs':
+                self.send_json(404, {'error': 'Unknown endpoint'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length))
+                self.send_json(202, service.submit(request))
+            except (ValueError, AttributeError) as e:
+                self.send_json(400, {'error': str(e)})
+
+        def do_DELETE(self):
+            parts = self.path.strip('/').split('/')
+            if len(parts) == 2 and parts[0] == 'jobs':
+                self.handle_job(service.cancel)
+            else:
+                self.send_json(404, {'error': 'Unknown endpoint'})
+
+        def log_message(self, format, *args):
+            pass    # jobs are reported by the status endpoints instead
+    return FittingRequestHandler
+
+
+# Send a request to the service and return the decoded JSON answer. Errors
+# of the service and connection errors are raised as ValueError
+def request_service(service_url, path, method = 'GET', content = None):
+    data = None if content is None else json.dumps(content).encode()
+    request = urllib.request.Request(service_url.rstrip('/') + path, data = data,
+                                     method = method,
+                                     headers = {'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as answer:
+            return json.loads(answer.read())
+    except urllib.error.HTTPError as e:
+        raise ValueError(json.loads(e.read()).get('error', str(e)))
+    except urllib.error.URLError as e:
+        raise ValueError(f'Cannot reach fitting service at {service_url}: {e.reason}')
+
+
+# Submit a fit to the service and return its job id. Inputs as in
+# pc.fit_PDSP_model
+def submit_fit(service_url, QQ, IQ, dIQ, pts_per_dec, lambda_, contrast, density_solid,
+               r_SSA_extrapolate, num_pts_SSA_extrapolate, major_phase,
+               dQ = None, slit_length = None, priority = 0, name = ''):
+    content = {'QQ': np.asarray(QQ).tolist(), 'IQ': np.asarray(IQ).tolist(),
+               'dIQ': np.asarray(dIQ).tolist(),
+               'dQ': None if dQ is None else np.asarray(dQ).tolist(),
+               'slit_length': slit_length, 'priority': priority, 'name': name}
+    content.update(zip(job_parameters, (pts_per_dec, lambda_, contrast, density_solid,
+                                        r_SSA_extrapolate, num_pts_SSA_extrapolate,
+                                        major_phase)))
+    return request_service(service_url, '/jobs', 'POST', content)['job_id']
+
+
+# Return the status of a job as a dict, see FittingService.job_status
+def get_status(service_url, job_id):
+    return request_service(service_url, '/jobs/' + job_id)
+
+
+# Wait for a job to finish and return its PDSP result. A failed job raises
+# ValueError with the error of the fit
+def get_result(service_url, job_id, poll_interval = 0.1):
+    while get_status(service_url, job_id)['status'] in ('queued', 'running'):
+        time.sleep(poll_interval)
+    return result_from_json(request_service(service_url, f'/jobs/{job_id}/result'))
+
+
+# Fit the PDSP model on the fitting service and wait for the result. Inputs
+# and result as in pc.fit_PDSP_model
+def fit_PDSP_remote(service_url, QQ, IQ, dIQ, pts_per_dec, lambda_, contrast, density_solid,
+                    r_SSA_extrapolate, num_pts_SSA_extrapolate, major_phase,
+                    dQ = None, slit_length = None, priority = 0, name = ''):
+    job_id = submit_fit(service_url, QQ, IQ, dIQ, pts_per_dec, lambda_, contrast,
+                        density_solid, r_SSA_extrapolate, num_pts_SSA_extrapolate,
+                        major_phase, dQ, slit_length, priority, name)
+    return get_result(service_url, job_id)
+
+
+# Fit data files on the fitting service, as batch_fitting.fit_files. All
+# files are submitted before waiting for the first result
+def fit_files_remote(service_url, file_list, params, output_dir = None, priority = 0):
+    job_ids = [None]*len(file_list)
+    for i, file_dir in enumerate(file_list):
+        try:
+            QQ_trim, IQ_trim, dIQ_trim, dQ_trim, slit_length = bfit.load_SANS_file(file_dir,
+                                                                                   params)
+            job_ids[i] = submit_fit(service_url, QQ_trim, IQ_trim, dIQ_trim,
+                                    params['pts_per_dec'], params['lambda_'],
+                                    *bfit.result_parameters(params), dQ_trim, slit_length,
+                                    priority, os.path.basename(file_dir))
+        except ValueError as e:
+            print('Cannot fit ' + os.path.basename(file_dir) + ': ' + str(e))
+
+    results = [None]*len(file_list)
+    for i, file_dir in enumerate(file_list):
+        if job_ids[i] is None:
+            continue
+        try:
+            results[i] = get_result(service_url, job_ids[i])
+        except ValueError as e:
+            print('Cannot fit ' + os.path.basename(file_dir) + ': ' + str(e))
+            continue
+        if output_dir is not None:
+            pc.write_PDSP_result(os.path.join(output_dir, pc.result_file_name(file_dir)),
+                                 os.path.basename(file_dir), params, results[i])
+    return results
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming mode for beamtime: a folder is polled for new or changed SAS data
+files, which are fitted with fixed fitting parameters in a pool of worker
+processes as they appear. Each result is written into its PDSP result file
+and appended to a running summary, so the fit quality can be followed while
+the instrument is measuring.
+
+A file is only fitted once its size and modification time have stopped
+changing for settle_time seconds, so partially written files are not read.
+At most max_queue files are submitted to the workers at a time; further
+ready files wait in the folder (and are picked up in order of arrival) until
+a worker becomes free.
+"""
+
+import os
+import time
+import fnmatch
+import datetime
+import concurrent.futures
+import numpy as np
+import PDSP_core as pc
+import batch_fitting as bfit
+
+
+# Name of the running summary file written into the output folder
+summary_file_name = 'PDSP Watch Summary.txt'
+
+
+# Fit a watched file and write its PDSP result file. Return the PDSP result
+# and the reduced χ² of the fit, used in the summary as the fit quality
+def fit_watched_file(file_dir, params, output_dir):
+    QQ_trim, IQ_trim, dIQ_trim, dQ_trim, slit_length = bfit.load_SANS_file(file_dir, params)
+    fitter = bfit.create_fitter(QQ_trim, dQ_trim, slit_length, params)
+    params = bfit.resolve_lambda(params, fitter, IQ_trim, dIQ_trim)
+    IQ0_fitted, IQ_fitted = bfit.fit_data(fitter, IQ_trim, dIQ_trim, params)
+    PDSP_result = bfit.calc_fit_result(fitter, IQ_trim, dIQ_trim, IQ0_fitted, IQ_fitted,
+                                       params)
+    pc.write_PDSP_result(os.path.join(output_dir, pc.result_file_name(file_dir)),
+                         os.path.basename(file_dir), params, PDSP_result)
+    chi2 = np.mean(((PDSP_result.IQ_fitted - IQ_trim)/dIQ_trim)**2)
+    return PDSP_result, chi2
+
+
+# Class watching a folder for SAS data files and fitting them as they land
+class FolderWatcher:
+    def __init__(self, watch_dir, params, output_dir = None, processes = None,
+                 max_queue = None, settle_time = 2, poll_interval = 1,
+                 patterns = ('*',), skip_existing = False):
+        if not os.path.isdir(watch_dir):
+            raise ValueError('Watched folder does not exist: ' + watch_dir)
+        self.watch_dir = watch_dir
+        self.params = params
+        self.output_dir = output_dir or watch_dir
+        self.processes = processes or os.cpu_count() or 1
+        self.max_queue = max_queue or 2*self.processes
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.patterns = patterns
+        os.makedirs(self.output_dir, exist_ok = True)
+        self.summary_file_dir = os.path.join(self.output_dir, summary_file_name)
+
+        # Last seen (size, mtime) of each file and the time it was first seen
+        # with that state, and the state each file was last submitted with
+        self.file_states = {}
+        self.submitted_states = {}
+        self.running = {}       # future: (file_dir, state, submit time)
+        self.num_fitted, self.num_failed = 0, 0
+        self.executor_broken = False
+        if skip_existing:
+            for file_dir, state in self.scan_folder().items():
+                self.submitted_states[file_dir] = state
+
+    # Return the (size, mtime) of every candidate data file in the folder.
+    # Result and summary files written by PRINSAS are ignored
+    def scan_folder(self):
+        states = {}
+        with os.scandir(self.watch_dir) as entries:
+            for entry in entries:
+                if (not entry.is_file() or entry.name.startswith('PDSP ') or
+                        entry.name.endswith(' PDSP Result.txt') or
+                        not any(fnmatch.fnmatch(entry.name, pattern)
+                                for pattern in self.patterns)):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue    # removed since listed
+                states[entry.path] = (stat.st_size, stat.st_mtime)
+        return states
+
+    # Return the files that have not changed for settle_time seconds and have
+    # not been submitted in their current state, oldest first
+    def find_ready_files(self):
+        now = time.monotonic()
+        states = self.scan_folder()
+        ready = []
+        for file_dir, state in states.items():
+            if self.file_states.get(file_dir, (None,))[0] != state:
+                self.file_states[file_dir] = (state, now)
+            elif (now - self.file_states[file_dir][1] >= self.settle_time and
+                  self.submitted_states.get(file_dir) != state):
+                ready.append((state[1], file_dir))
+        for file_dir in set(self.file_states) - set(states):
+            del self.file_states[file_dir]
+        return [file_dir for _, file_dir in sorted(ready)]
+
+    # Write the header of the summary file if it does not exist yet
+    def start_summary(self):
+        if os.path.exists(self.summary_file_dir):
+            return
+        with open(self.summary_file_dir, 'w') as file:
+            file.write('PDSP Watch Summary for ' + self.watch_dir + '\n\n')
+            file.write('\t'.join(['Time', 'File', 'Reduced chi2', 'Porosity',
+                                  'Vpore_avg (cm3)', 'SSA (cm2/cm3)',
+                                  'Fit time (s)', 'Queue']) + '\n')
+
+    # Append the result of a finished fit to the summary file and the console
+    def record_result(self, future):
+        file_dir, state, submit_time = self.running.pop(future)
+        line = [datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                os.path.basename(file_dir)]
+        try:
+            PDSP_result, chi2 = future.result()
+        except Exception as e:
+            # Any failure of the worker is recorded as the result of the file.
+            # A worker process that died breaks the executor, which is then
+            # replaced before further files are submitted
+            if isinstance(e, concurrent.futures.BrokenExecutor):
+                self.executor_broken = True
+            self.num_failed += 1
+            line += ['failed: ' + (str(e) or type(e).__name__)]
+        else:
+            self.num_fitted += 1
+            line += ['{:.4g}'.format(chi2), '{:.5g}'.format(np.real(PDSP_result.phi[0])),
+                     '{:.4e}'.format(np.real(PDSP_result.Vpore_avg[0])),
+                     '{:.4e}'.format(np.real(PDSP_result.SSA_extrapolate[0])),
+                     '{:.1f}'.format(time.monotonic() - submit_time),
+                     str(len(self.running))]
+        with open(self.summary_file_dir, 'a') as file:
+            file.write('\t'.join(line) + '\n')
+        print('\t'.join(line[1:]))
+
+    # Submit the ready files to the executor while the queue has room. Files
+    # not submitted stay ready and are submitted on a later poll
+    def submit_ready_files(self, executor):
+        for file_dir in self.find_ready_files():
+            if len(self.running) >= self.max_queue:
+                break
+            if file_dir in (running[0] for running in self.running.values()):
+                continue    # changed while being fitted, refit once finished
+            state = self.file_states[file_dir][0]
+            try:
+                future = executor.submit(fit_watched_file, file_dir, self.params,
+                                         self.output_dir)
+            except concurrent.futures.BrokenExecutor:
+                self.executor_broken = True
+                break
+            self.submitted_states[file_dir] = state
+            self.running[future] = (file_dir, state, time.monotonic())
+
+    # Collect finished fits, waiting up to timeout seconds for one to finish
+    def collect_results(self, timeout):
+        if not self.running:
+            time.sleep(timeout)
+            return
+        done, _ = concurrent.futures.wait(self.running, timeout = timeout,
+                                          return_when = concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            self.record_result(future)
+
+    # Watch the folder until interrupted. If once is True, return as soon as
+    # all files present in the folder have been fitted
+    def run(self, once = False):
+        self.start_summary()
+        print(f"Watching {self.watch_dir} with {self.processes} workers "
+              f"(queue depth {self.max_queue}), Ctrl+C to stop")
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers = self.processes)
+        try:
+            while True:
+                if self.executor_broken:
+                    print('A worker process stopped, restarting the workers')
+                    executor.shutdown(wait = False)
+                    executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers = self.processes)
+                    self.executor_broken = False
+                self.submit_ready_files(executor)
+                if (once and not self.running and
+                        all(self.submitted_states.get(file_dir) == state
+                            for file_dir, state in self.scan_folder().items())):
+                    break
+                self.collect_results(self.poll_interval)
+        except KeyboardInterrupt:
+            print('Stopping, waiting for running fits to finish')
+            for future in list(self.running):
+                if future.cancel():
+                    del self.running[future]
+            for future in concurrent.futures.as_completed(list(self.running)):
+                self.record_result(future)
+        finally:
+            executor.shutdown()
+        print(f"{self.num_fitted} files fitted, {self.num_failed} failed. "
+              f"Summary written to {self.summary_file_dir}")
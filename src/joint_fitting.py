@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Joint PDSP fit of several SAS data sets of the same sample measured at
+different contrasts, e.g. contrast-matching pairs where the accessible pores
+are filled with a contrast-matched fluid. All data sets share one pore size
+distribution, and selected data sets have an additional distribution of their
+own (e.g. the accessible pores, which only scatter in the unmatched data set).
+All distributions are solved for in a single optimisation.
+"""
+
+import numpy as np
+import scipy.optimize as sci_opt
+import PDSP_core as pc
+
+
+# Class for the joint PDSP fit. Each data set is a dict with the keys
+#   QQ, IQ, dIQ: background-subtracted data trimmed to the Q range of the fit
+#   contrast: contrast between the 2 phases (cm-2) of the shared distribution
+#   independent: True if the data set has a distribution of its own
+#   dQ, slit_length (optional): instrument resolution, see pc.get_eq4_fraction
+# The r grid spans the Q range of all data sets. Kernels are obtained from the
+# kernel cache, so data sets on the same Q grid share their kernel.
+# All IQ0i are expressed at the contrast of the first data set (reference).
+class JointPDSPFitter:
+    def __init__(self, datasets, pts_per_dec):
+        for dataset in datasets:
+            if len(dataset['QQ']) < 5:
+                raise ValueError('Each data set must contain at least 5 data points')
+        QQ_all = np.concatenate([dataset['QQ'] for dataset in datasets])
+        if np.log10(np.max(QQ_all)/np.min(QQ_all)) < 1:
+            raise ValueError('Input Q range must span at least 1 decade')
+        self.datasets = datasets
+        self.logR_del = 1/pts_per_dec
+        self.logR_1D, self.non_extplted_pos = pc.calc_r_grid(QQ_all, self.logR_del)
+        self.slope_weights = pc.calc_slope_weights(self.logR_1D)
+
+        self.kernels = [pc.get_eq4_fraction(self.logR_1D, self.logR_del, dataset['QQ'],
+                                            dataset.get('dQ'), dataset.get('slit_length'))
+                        for dataset in datasets]
+
+        # Intensity scale of each data set relative to the reference contrast
+        contrast_ref = datasets[0]['contrast']
+        self.scales = [(dataset['contrast']/contrast_ref)**2 for dataset in datasets]
+
+        # Block of the parameter vector holding the distribution of each data
+        # set; block 0 is the shared distribution
+        self.own_block = {}
+        for i, dataset in enumerate(datasets):
+            if dataset.get('independent', False):
+                self.own_block[i] = len(self.own_block) + 1
+        self.num_blocks = len(self.own_block) + 1
+
+        self.log_IQ = [np.log10(dataset['IQ']) for dataset in datasets]
+        self.chi2_weights = [(dataset['IQ']/dataset['dIQ'])**2/len(dataset['QQ'])
+                             for dataset in datasets]
+
+    # Return the calculated I(Q) of every data set for the given IQ0i blocks
+    def calc_IQ(self, IQ0_blocks):
+        IQ_calc = []
+        for i, kernel in enumerate(self.kernels):
+            IQ0 = IQ0_blocks[0] + (IQ0_blocks[self.own_block[i]]
+                                   if i in self.own_block else 0)
+            IQ_calc.append(self.scales[i]*(IQ0 @ kernel))
+        return IQ_calc
+
+    # Optimise function Ξ of the joint fit, i.e. the sum of χ² of all data
+    # sets plus λ times the roughness of every distribution, and its gradient
+    def calc_Xi(self, log_IQ0, lambda_):
+        log_IQ0_blocks = log_IQ0.reshape(self.num_blocks, -1)
+        IQ0_blocks = 10**log_IQ0_blocks
+        Xi = 0
+        grad = np.zeros(log_IQ0_blocks.shape)
+        for i, IQ_calc in enumerate(self.calc_IQ(IQ0_blocks)):
+            resid = self.log_IQ[i] - np.log10(IQ_calc)
+            Xi += np.sum(self.chi2_weights[i]*resid**2)
+            # d χ² / d IQ0i, the chain rule to log IQ0i is applied below
+            grad_IQ0 = -2*self.scales[i]*(self.kernels[i] @
+                                          (self.chi2_weights[i]*resid/IQ_calc))
+            grad[0] += grad_IQ0*IQ0_blocks[0]
+            if i in self.own_block:
+                j = self.own_block[i]
+                grad[j] += grad_IQ0*IQ0_blocks[j]
+
+        for j in range(self.num_blocks):
+            roughness, grad_roughness = pc.calc_roughness(log_IQ0_blocks[j], self.logR_1D,
+                                                          self.slope_weights)
+            Xi += lambda_*roughness
+            grad[j] += lambda_*grad_roughness
+        return Xi, grad.ravel()
+
+    # Starting value of each distribution. Each data set is first guessed on
+    # its own as in PDSPFitter. The shared distribution starts from the data
+    # sets without a distribution of their own (or all data sets if every one
+    # has its own), and data sets with both distributions split their
+    # intensity equally between them
+    def guess_log_IQ0(self):
+        R_1D = 10**self.logR_1D
+        log_IQ0_guessed = []
+        for i, dataset in enumerate(self.datasets):
+            QQ, IQ, kernel = dataset['QQ'], dataset['IQ'], self.kernels[i]
+            pos = np.argmin(np.abs(R_1D[:,np.newaxis] - 2.5/QQ), axis = 1)
+            IQ0_guessed = IQ[pos]/kernel[range(len(pos)), pos]
+            div_factor = np.median((IQ0_guessed @ kernel)/IQ)
+            log_IQ0_guessed.append(np.log10(IQ0_guessed/div_factor/self.scales[i]))
+
+        shared_from = [i for i in range(len(self.datasets)) if i not in self.own_block]
+        log_IQ0_blocks = np.empty((self.num_blocks, len(self.logR_1D)))
+        log_IQ0_blocks[0] = np.mean([log_IQ0_guessed[i]
+                                     for i in (shared_from or self.own_block)], axis = 0)
+        for i, j in self.own_block.items():
+            log_IQ0_blocks[j] = log_IQ0_guessed[i] - np.log10(2)
+        if not shared_from:
+            log_IQ0_blocks[0] -= np.log10(2)
+        return log_IQ0_blocks.ravel()
+
+    # Fit all distributions. Return the IQ0i blocks over the extended r grid
+    # (shared distribution first) and the fitted I(Q) of every data set
+    def fit(self, lambda_, log_IQ0_guessed = None):
+        if log_IQ0_guessed is None:
+            log_IQ0_guessed = self.guess_log_IQ0()
+
+        # Setting arbitrary ranges for result, as in PDSPFitter.fit
+        log_IQ0_range = np.max(log_IQ0_guessed) - np.min(log_IQ0_guessed)
+        self.optimize_result = sci_opt.minimize(self.calc_Xi, log_IQ0_guessed,
+                                                jac = True, args = (lambda_,),
+                                                method = 'L-BFGS-B',
+                                                bounds = list(zip(log_IQ0_guessed - log_IQ0_range,
+                                                                  log_IQ0_guessed + log_IQ0_range)))
+        IQ0_blocks = 10**self.optimize_result.x.reshape(self.num_blocks, -1)
+        return IQ0_blocks, self.calc_IQ(IQ0_blocks)
+
+    # Calculate the PDSP result of each distribution. All results use the
+    # reference contrast. The fitted I(Q) stored with the shared result is
+    # that of the reference data set, and that stored with each independent
+    # result is that of its own data set
+    def calc_result(self, IQ0_blocks, IQ_fitted, density_solid, r_SSA_extrapolate,
+                    num_pts_SSA_extrapolate, major_phase):
+        logR_1D = self.logR_1D[self.non_extplted_pos]
+        dIQ0_percent = [pc.estimate_dIQ0_percent(dataset['QQ'], dataset['IQ'], dataset['dIQ'],
+                                                 IQ_fitted[i], logR_1D, self.logR_del)
+                        for i, dataset in enumerate(self.datasets)]
+        result_params = (self.datasets[0]['contrast'], density_solid, r_SSA_extrapolate,
+                         num_pts_SSA_extrapolate, major_phase)
+
+        # The error of the shared distribution is the largest error among the
+        # data sets
+        R_1D, IQ0_shared, f_r, f_dash_r = pc.calc_distribution(
+            logR_1D, self.logR_del, IQ0_blocks[0][self.non_extplted_pos],
+            np.max(dIQ0_percent, axis = 0))
+        shared_result = pc.PDSPResult.from_fit(R_1D, IQ_fitted[0], IQ0_shared,
+                                               f_r, f_dash_r, *result_params)
+
+        independent_results = [None]*len(self.datasets)
+        for i, j in self.own_block.items():
+            R_1D, IQ0_own, f_r, f_dash_r = pc.calc_distribution(
+                logR_1D, self.logR_del, IQ0_blocks[j][self.non_extplted_pos], dIQ0_percent[i])
+            independent_results[i] = pc.PDSPResult.from_fit(R_1D, IQ_fitted[i], IQ0_own,
+                                                            f_r, f_dash_r, *result_params)
+        return JointPDSPResult(shared_result, independent_results, IQ_fitted)
+
+
+# Result of the joint PDSP fit: the PDSP result of the shared distribution,
+# the PDSP results of the independent distributions (None for data sets
+# without one) and the fitted I(Q) of every data set
+class JointPDSPResult:
+    __slots__ = ('shared', 'independent', 'IQ_fitted')
+
+    def __init__(self, shared, independent, IQ_fitted):
+        self.shared = shared
+        self.independent = independent
+        self.IQ_fitted = IQ_fitted
+
+
+# Jointly fit the PDSP model to several data sets, see JointPDSPFitter
+def fit_PDSP_joint(datasets, pts_per_dec, lambda_, density_solid, r_SSA_extrapolate,
+                   num_pts_SSA_extrapolate, major_phase):
+    fitter = JointPDSPFitter(datasets, pts_per_dec)
+    IQ0_blocks, IQ_fitted = fitter.fit(lambda_)
+    return fitter.calc_result(IQ0_blocks, IQ_fitted, density_solid, r_SSA_extrapolate,
+                              num_pts_SSA_extrapolate, major_phase)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Automatic selection of the smoothing factor λ of the PDSP fit. The fit is
+linearised around one nonlinear fit: with the weighted residual
+r = sqrt(w)(log I(Q) - log I_calc(Q)), its Jacobian J with respect to log IQ0i
+and the roughness operator L (first differences of the slope-normalised
+log IQ0i), Ξ is approximated by the Tikhonov problem
+    ||d - J x||² + λ ||L x||²
+One generalised eigendecomposition of (JᵀJ, LᵀL) then gives the residual,
+the roughness and the effective number of parameters for any number of λ
+values without further fits, from which λ is chosen by one of
+    'gcv'           generalised cross-validation
+    'lcurve'        corner (largest curvature) of the L-curve
+    'discrepancy'   largest λ whose χ² does not exceed the noise level of dI(Q)
+"""
+
+import numpy as np
+import scipy.linalg as sci_linalg
+import PDSP_core as pc
+
+
+lambda_methods = ('gcv', 'lcurve', 'discrepancy')
+
+# Default λ values searched
+default_lambdas = np.logspace(-4, 4, 81)
+
+
+# Calculate the criteria of λ selection for all lambdas from the problem
+# linearised around log_IQ0. set_data must have been called on the fitter.
+# Return a dict of arrays over lambdas:
+#   chi2: χ² of the linearised fit, as in Ξ
+#   roughness: roughness term of the linearised fit
+#   effective_params: trace of the influence matrix
+#   gcv: generalised cross-validation function
+#   curvature: curvature of the L-curve (log residual norm vs. log roughness)
+def calc_lambda_criteria(fitter, log_IQ0, lambdas = default_lambdas):
+    lambdas = np.asarray(lambdas, dtype = float)
+
+    # Data of the linearised problem, the weights of the residual include the
+    # 1/N of χ²
+    residual, jac = fitter.calc_jacobian(log_IQ0)
+    data = residual + jac @ log_IQ0
+
+    # LᵀL is singular for distributions linear in log r, a small multiple of
+    # the identity makes it positive definite
+    rough_op = pc.calc_roughness_operator(fitter.logR_1D, fitter.slope_weights)
+    rough_matrix = rough_op.T @ rough_op
+    rough_matrix += 1e-8*np.trace(rough_matrix)/len(log_IQ0)*np.eye(len(log_IQ0))
+    eig_vals, eig_vecs = sci_linalg.eigh(jac.T @ jac, rough_matrix)
+    eig_vals = np.maximum(eig_vals, 0)
+
+    # Solution for every λ in the eigenbasis, x = V coeffs
+    filter_factors = 1/(eig_vals[:, np.newaxis] + lambdas)
+    coeffs = (eig_vecs.T @ (jac.T @ data))[:, np.newaxis]*filter_factors
+    chi2 = np.sum((data[:, np.newaxis] - (jac @ eig_vecs) @ coeffs)**2, axis = 0)
+    roughness = np.sum(((rough_op @ eig_vecs) @ coeffs)**2, axis = 0)
+    effective_params = np.sum(eig_vals[:, np.newaxis]*filter_factors, axis = 0)
+
+    # χ² is already divided by N, so GCV = N χ²/(N - trace)² becomes
+    num_Q = len(data)
+    gcv = chi2/(1 - effective_params/num_Q)**2/num_Q
+
+    log_lambdas = np.log(lambdas)
+    rho, eta = np.log(chi2)/2, np.log(roughness)/2
+    rho_1, eta_1 = np.gradient(rho, log_lambdas), np.gradient(eta, log_lambdas)
+    rho_2, eta_2 = np.gradient(rho_1, log_lambdas), np.gradient(eta_1, log_lambdas)
+    curvature = (rho_1*eta_2 - rho_2*eta_1)/(rho_1**2 + eta_1**2)**1.5
+    return {'lambdas': lambdas, 'chi2': chi2, 'roughness': roughness,
+            'effective_params': effective_params, 'gcv': gcv, 'curvature': curvature}
+
+
+# Return the λ chosen from the criteria by the given method. For 'discrepancy'
+# the noise level is the χ² expected from dI(Q) alone, 1/ln(10)² per point in
+# the log residual of Ξ; if no λ reaches it, the smallest λ is returned
+def choose_lambda(criteria, method = 'gcv'):
+    lambdas = criteria['lambdas']
+    if method == 'gcv':
+        return float(lambdas[np.argmin(criteria['gcv'])])
+    elif method == 'lcurve':
+        if len(lambdas) < 3:
+            raise ValueError('The L-curve requires at least 3 lambda values')
+        return float(lambdas[1 + np.argmax(criteria['curvature'][1:-1])])
+    elif method == 'discrepancy':
+        below_noise = np.nonzero(criteria['chi2'] <= 1/np.log(10)**2)[0]
+        return float(lambdas[below_noise[-1]] if len(below_noise) else np.min(lambdas))
+    check_lambda_method(method)
+
+
+# Raise an error if method is not a λ selection method
+def check_lambda_method(method):
+    if method not in lambda_methods:
+        raise ValueError('Unknown lambda selection method: ' + str(method) +
+                         '. Must be one of ' + ', '.join(lambda_methods))
+
+
+# Choose λ for the data with the given method. The problem is linearised
+# around a fit with lambda_ref, and relinearised around a fit with the chosen
+# λ up to refine times while the choice changes. Return the chosen λ and the
+# criteria of the last linearisation
+def select_lambda(fitter, IQ, dIQ, method = 'gcv', lambdas = default_lambdas,
+                  lambda_ref = 1, refine = 1):
+    check_lambda_method(method)
+    log_IQ0_bounds = fitter.fit_bounds(fitter.guess_log_IQ0(IQ))
+    lambda_, log_IQ0_start = lambda_ref, None
+    for _ in range(refine + 1):
+        fitter.fit(IQ, dIQ, lambda_, log_IQ0_start, log_IQ0_bounds)
+        log_IQ0_start = fitter.optimize_result.x
+        criteria = calc_lambda_criteria(fitter, log_IQ0_start, lambdas)
+        lambda_chosen = choose_lambda(criteria, method)
+        if np.isclose(lambda_chosen, lambda_):
+            break
+        lambda_ = lambda_chosen
+    return lambda_chosen, criteria
+
+
+# Function used to choose λ automatically for the data of a PDSP fit, inputs
+# as in pc.fit_PDSP_model. Return the chosen λ and the criteria
+def select_lambda_for_data(QQ, IQ, dIQ, pts_per_dec, method = 'gcv', dQ = None,
+                           slit_length = None, pore_model = 'sphere', **kwargs):
+    fitter = pc.PDSPFitter(QQ, pts_per_dec, dQ, slit_length, pore_model)
+    return select_lambda(fitter, IQ, dIQ, method, **kwargs)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-start PDSP fitting. The optimise function Ξ is not convex in log IQ0, so
+a single fit from the heuristic starting value can end in a poor local
+minimum, e.g. for bimodal distributions. Here the fit is started from several
+alternative and perturbed starting values at the same time in worker
+processes sharing one kernel, the start with the lowest Ξ is kept, and the
+spread of Ξ and of the sample properties over the starts is reported.
+
+All starts share the bounds set around the heuristic starting value, so they
+search the same region and their values of Ξ can be compared directly.
+"""
+
+import os
+import concurrent.futures
+import numpy as np
+import PDSP_core as pc
+import shared_kernels as sk
+
+
+# Factors c of the alternative starting values assigning the intensity at Q
+# to r_i = c/Q, besides the heuristic c = 2.5
+alternative_R_Q_factors = (1.5, 4.0)
+
+
+# Return the names and the starting values of log IQ0i of num_starts starts,
+# clipped into the bounds: the heuristic guess, the alternative r = c/Q
+# assignments, a flat distribution and smooth random perturbations of the
+# guess with a standard deviation of about perturbation decades
+def multi_start_values(fitter, IQ, num_starts, log_IQ0_bounds, perturbation = 0.3,
+                       seed = 0):
+    log_IQ0_guessed = fitter.guess_log_IQ0(IQ)
+    names = ['r = 2.5/Q']
+    starts = [log_IQ0_guessed]
+    for R_Q_factor in alternative_R_Q_factors:
+        names.append('r = {:g}/Q'.format(R_Q_factor))
+        starts.append(fitter.guess_log_IQ0(IQ, R_Q_factor))
+    names.append('flat')
+    starts.append(fitter.rescale_log_IQ0(np.zeros(len(fitter.logR_1D)), IQ))
+
+    # Random walks over r, so the perturbations are smooth like the fitted
+    # distributions rather than adding to the roughness term of Ξ
+    rng = np.random.default_rng(seed)
+    num_r = len(fitter.logR_1D)
+    for i in range(max(num_starts - len(starts), 0)):
+        walk = np.cumsum(rng.normal(0, 1, num_r))
+        walk = (walk - np.mean(walk))/(np.std(walk) or 1)*perturbation
+        names.append('perturbed {:d}'.format(i + 1))
+        starts.append(fitter.rescale_log_IQ0(log_IQ0_guessed + walk, IQ))
+
+    lower_bound, upper_bound = np.array(log_IQ0_bounds).T
+    starts = [np.clip(log_IQ0, lower_bound, upper_bound) for log_IQ0 in starts]
+    return names[:num_starts], starts[:num_starts]
+
+
+# Fit one start, in a worker process or in this process. The fitter is
+# rebuilt from the Q grid, which in a worker attaches the shared kernel.
+# Return Ξ, the fitted log IQ0i and the number of iterations
+def fit_start(QQ, pts_per_dec, dQ, slit_length, IQ, dIQ, lambda_, log_IQ0_start,
+              log_IQ0_bounds, pore_model = 'sphere'):
+    fitter = pc.PDSPFitter(QQ, pts_per_dec, dQ, slit_length, pore_model)
+    fitter.fit(IQ, dIQ, lambda_, log_IQ0_start, log_IQ0_bounds)
+    return (fitter.optimize_result.fun, fitter.optimize_result.x,
+            fitter.optimize_result.nit)
+
+
+# Function used to fit the PDSP model from num_starts starting values in
+# processes worker processes (default: one per start, up to the number of
+# CPUs). Inputs as in fit_PDSP_model. Return the PDSP result of the start with
+# the lowest Ξ and a dict of the spread over the starts:
+#   start: names of the starts, best: index of the start with the lowest Ξ
+#   Xi, iterations, phi, Vpore_avg, SSA_extrapolate: value of each start
+#   converged: starts ending within converged_rtol of the lowest Ξ
+#   log_IQ0_spread: largest standard deviation of log IQ0i over these starts
+# The errors of the best start are estimated as chosen by uncertainty
+def fit_PDSP_model_multi_start(QQ, IQ, dIQ, pts_per_dec, lambda_, contrast, density_solid,
+                               r_SSA_extrapolate, num_pts_SSA_extrapolate, major_phase,
+                               dQ = None, slit_length = None, num_starts = 8,
+                               processes = None, converged_rtol = 0.01,
+                               uncertainty = 'heuristic', pore_model = 'sphere'):
+    pc.check_uncertainty_mode(uncertainty)
+    if num_starts < 1:
+        raise ValueError('Number of starts must be at least 1')
+    fitter = pc.PDSPFitter(QQ, pts_per_dec, dQ, slit_length, pore_model)
+    log_IQ0_bounds = fitter.fit_bounds(fitter.guess_log_IQ0(IQ))
+    names, starts = multi_start_values(fitter, IQ, num_starts, log_IQ0_bounds)
+    if processes is None:
+        processes = min(len(starts), os.cpu_count() or 1)
+
+    start_args = [(QQ, pts_per_dec, dQ, slit_length, IQ, dIQ, lambda_, log_IQ0_start,
+                   log_IQ0_bounds, pore_model) for log_IQ0_start in starts]
+    if processes == 1:
+        fits = [fit_start(*args) for args in start_args]
+    else:
+        with sk.SharedKernelStore() as kernel_store:
+            kernel_store.publish(fitter.kernel_key, fitter.eq4_fraction_2D)
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers = processes, initializer = sk.set_shared_kernel_dir,
+                    initargs = (kernel_store.kernel_dir,)) as executor:
+                fits = list(executor.map(fit_start, *zip(*start_args)))
+
+    # Sample properties of every start, to show how much the choice of start
+    # matters for the reported result
+    results = []
+    for _, log_IQ0, _ in fits:
+        IQ0_fitted = 10**log_IQ0
+        IQ_fitted = IQ0_fitted @ fitter.eq4_fraction_2D
+        results.append(fitter.calc_result(IQ, dIQ, IQ0_fitted, IQ_fitted, contrast, density_solid, r_SSA_extrapolate,
+                                          num_pts_SSA_extrapolate, major_phase))
+    Xi = np.array([fit[0] for fit in fits])
+    best = int(np.argmin(Xi))
+    if uncertainty == 'laplace':
+        fitter.set_data(IQ, dIQ)
+        results[best] = fitter.calc_result(
+            IQ, dIQ, 10**fits[best][1], 10**fits[best][1] @ fitter.eq4_fraction_2D,
+            contrast, density_solid, r_SSA_extrapolate, num_pts_SSA_extrapolate, major_phase,
+            fitter.calc_log_IQ0_covariance(fits[best][1], lambda_))
+    converged = Xi <= Xi[best]*(1 + converged_rtol)
+    log_IQ0_fitted = np.array([fit[1] for fit in fits])[converged][:, fitter.non_extplted_pos]
+    spread = {'start': names, 'best': best, 'Xi': Xi, 'converged': converged,
+              'iterations': np.array([fit[2] for fit in fits]),
+              'phi': np.array([np.real(result.phi[0]) for result in results]),
+              'Vpore_avg': np.array([np.real(result.Vpore_avg[0]) for result in results]),
+              'SSA_extrapolate': np.array([np.real(result.SSA_extrapolate[0])
+                                           for result in results]),
+              'log_IQ0_spread': float(np.max(np.std(log_IQ0_fitted, axis = 0)))}
+    return results[best], spread
+
+
+# Return the spread of a multi-start fit as lines of a tab separated table,
+# with the best start marked by '*'
+def format_spread(spread):
+    lines = ['\t'.join(['Start', 'Xi', 'Iterations', 'Porosity', 'Vpore_avg (cm3)',
+                        'SSA (cm2/cm3)'])]
+    for i, name in enumerate(spread['start']):
+        lines.append('{:s}{:s}\t{:.6g}\t{:d}\t{:.5g}\t{:.4e}\t{:.4e}'.format(
+            name, ' *' if i == spread['best'] else '', spread['Xi'][i],
+            spread['iterations'][i], spread['phi'][i], spread['Vpore_avg'][i],
+            spread['SSA_extrapolate'][i]))
+    lines.append('{:d} of {:d} starts reached the lowest Xi, largest standard deviation '
+                 'of log IQ0 between them: {:.3g}'.format(
+                     int(np.sum(spread['converged'])), len(spread['start']),
+                     spread['log_IQ0_spread']))
+    return lines
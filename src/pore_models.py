@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Pore models of the PDSP kernel. A pore model gives the orientation-averaged
+form factor F(Qr) of a pore of radius r (normalised so that F(0) = 1), and
+the volume and surface area of the pore. The kernel integral of equation (2)
+is the same for every model, only F(Qr), V_r and the surface area used for
+the SSA change.
+
+A model is chosen by its name, optionally followed by ':' and its shape
+parameter, e.g. 'cylinder:10':
+    'sphere'                sphere of radius r (the PDSP model)
+    'cylinder[:aspect]'     cylinder of radius r and length 2·aspect·r (default 5)
+    'ellipsoid[:aspect]'    spheroid with equatorial semi-axis r and polar
+                            semi-axis aspect·r (default 2, < 1 for oblate)
+    'shell[:thickness]'     spherical shell of outer radius r and wall
+                            thickness thickness·r (default 0.2)
+Further models are added with register_pore_model.
+
+The shape of every model is fixed by its parameter, so F depends on Qr only.
+The sphere and the shell are evaluated in closed form. The orientation
+averages of the cylinder and the ellipsoid are tabulated once per model on a
+log grid of Qr by composite Gauss-Legendre quadrature and interpolated, with
+the Porod limit 2π S/(V² Q⁴) beyond the table.
+"""
+
+import functools
+import numpy as np
+import scipy.special as sci_special
+
+
+# Factories of the registered pore models, name: (factory, default parameter)
+pore_model_factories = {}
+
+# Number of Qr values per decade of the tables of orientation averages, the
+# smallest Qr of the tables (F = 1 below it) and the largest Qr of the tables
+# for shapes close to a sphere (Porod limit above it)
+table_pts_per_dec = 400
+table_Qr_min = 1e-3
+table_Qr_max = 100
+
+# Number of Gauss-Legendre nodes per panel of the orientation average, and
+# number of Qr values per block of its evaluation
+orientation_nodes = 8
+orientation_block_size = 64
+
+
+# Class holding the functions of one pore model.
+# form_factor(Qr): orientation-averaged form factor, F(0) = 1
+# volume(r), surface(r): volume and surface area of a pore of radius r
+class PoreModel:
+    def __init__(self, name, form_factor, volume, surface):
+        self.name = name
+        self.form_factor = form_factor
+        self.volume = volume
+        self.surface = surface
+
+
+# Register a pore model under name. factory(parameter) returns the PoreModel
+# of the given shape parameter, default_parameter is used if the name is
+# given without one (None for models without a parameter)
+def register_pore_model(name, factory, default_parameter = None):
+    pore_model_factories[name] = (factory, default_parameter)
+    get_pore_model.cache_clear()
+
+
+# Return the PoreModel of a model name such as 'sphere' or 'cylinder:10'.
+# Models are created once and kept, so tabulated form factors are calculated
+# once per process
+@functools.lru_cache(maxsize = None)
+def get_pore_model(pore_model):
+    name, _, parameter = str(pore_model).partition(':')
+    if name not in pore_model_factories:
+        raise ValueError('Unknown pore model: ' + name + '. Must be one of ' +
+                         ', '.join(pore_model_factories))
+    factory, default_parameter = pore_model_factories[name]
+    if not parameter:
+        return factory() if default_parameter is None else factory(default_parameter)
+    if default_parameter is None:
+        raise ValueError('Pore model ' + name + ' has no shape parameter')
+    try:
+        parameter = float(parameter)
+    except ValueError:
+        raise ValueError('Invalid shape parameter of pore model ' + name + ': ' + parameter)
+    if not np.isfinite(parameter) or parameter <= 0:
+        raise ValueError('Shape parameter of pore model ' + name + ' must be positive')
+    return factory(parameter)
+
+
+# Raise an error if pore_model is not a valid pore model name
+def check_pore_model(pore_model):
+    get_pore_model(pore_model)
+
+
+# This function calculate the spherical form factor, used in the integral
+# calculation of equation (2)
+def calc_Fsph(Qr):
+    return (3*(np.sin(Qr) - Qr*np.cos(Qr))/Qr**3)**2
+
+
+# This function calculate the spherical pore volume, used in the integral
+# calculation of equation (2)
+def calc_Vsph(radius):
+    return 4/3*np.pi*radius**3
+
+
+# Return the form factor amplitude of a sphere, 3(sin Qr - Qr cos Qr)/(Qr)³
+def calc_sphere_amplitude(Qr):
+    return 3*(np.sin(Qr) - Qr*np.cos(Qr))/Qr**3
+
+
+# Sphere of radius r, the pore of the PDSP model
+def sphere_model():
+    return PoreModel('sphere', calc_Fsph, calc_Vsph, lambda radius: 4*np.pi*radius**2)
+
+
+# Spherical shell of outer radius r and inner radius (1 - thickness) r. The
+# amplitude is that of the outer sphere minus that of the inner sphere,
+# weighted by their volumes
+def shell_model(thickness):
+    if thickness > 1:
+        raise ValueError('Shell thickness must not exceed 1 (a full sphere)')
+    ratio = 1 - thickness
+    def form_factor(Qr):
+        return ((calc_sphere_amplitude(Qr) - ratio**3*calc_sphere_amplitude(ratio*Qr))/
+                (1 - ratio**3))**2
+    return PoreModel('shell:{:g}'.format(thickness), form_factor,
+                     lambda radius: 4/3*np.pi*(1 - ratio**3)*radius**3,
+                     lambda radius: 4*np.pi*(1 + ratio**2)*radius**2)
+
+
+# Randomly oriented cylinder of radius r and length 2·aspect·r. μ is the
+# cosine of the angle between Q and the cylinder axis
+def cylinder_model(aspect):
+    def amplitude_squared(Qr, mu):
+        Qr_radial = Qr*np.sqrt(1 - mu**2)
+        return (2*sci_special.j1(Qr_radial)/Qr_radial*np.sinc(aspect*Qr*mu/np.pi))**2
+    volume_factor = 2*np.pi*aspect
+    surface_factor = 2*np.pi*(1 + 2*aspect)
+    return PoreModel('cylinder:{:g}'.format(aspect),
+                     tabulate_form_factor(amplitude_squared, aspect,
+                                          volume_factor, surface_factor),
+                     lambda radius: volume_factor*radius**3,
+                     lambda radius: surface_factor*radius**2)
+
+
+# Randomly oriented spheroid with equatorial semi-axis r and polar semi-axis
+# aspect·r. μ is the cosine of the angle between Q and the polar axis
+def ellipsoid_model(aspect):
+    def amplitude_squared(Qr, mu):
+        return calc_Fsph(Qr*np.sqrt(1 + (aspect**2 - 1)*mu**2))
+    if aspect == 1:
+        surface_factor = 4*np.pi
+    elif aspect < 1:
+        eccentricity = np.sqrt(1 - aspect**2)
+        surface_factor = 2*np.pi*(1 + aspect**2/eccentricity*np.arctanh(eccentricity))
+    else:
+        eccentricity = np.sqrt(1 - 1/aspect**2)
+        surface_factor = 2*np.pi*(1 + aspect/eccentricity*np.arcsin(eccentricity))
+    volume_factor = 4/3*np.pi*aspect
+    return PoreModel('ellipsoid:{:g}'.format(aspect),
+                     tabulate_form_factor(amplitude_squared, aspect,
+                                          volume_factor, surface_factor),
+                     lambda radius: volume_factor*radius**3,
+                     lambda radius: surface_factor*radius**2)
+
+
+# Return the orientation average over μ in [0, 1] of amplitude_squared(Qr, μ)
+# as a vectorised function of Qr, from a table over Qr. The average is
+# integrated over the angle θ = arccos μ, in which both the axial and the
+# radial oscillations are smooth. The table extends to table_Qr_max, times
+# 1/aspect for flat shapes, and the number of quadrature panels resolves the
+# oscillations at its largest Qr. Beyond the table, F(Qr) = 2π S/(V² Q⁴) with
+# V = volume_factor r³ and S = surface_factor r²
+def tabulate_form_factor(amplitude_squared, aspect, volume_factor, surface_factor):
+    Qr_max = table_Qr_max*max(1, 1/aspect)
+    num_pts = int(np.ceil(np.log10(Qr_max/table_Qr_min)*table_pts_per_dec)) + 1
+    log_Qr_table = np.linspace(np.log10(table_Qr_min), np.log10(Qr_max), num_pts)
+
+    # Composite Gauss-Legendre nodes and weights over θ in [0, π/2], with
+    # dμ = sin θ dθ
+    num_panels = int(np.ceil(max(1, aspect)*Qr_max/4)) + 1
+    nodes, weights = np.polynomial.legendre.leggauss(orientation_nodes)
+    theta = ((np.arange(num_panels)[:,np.newaxis] + (nodes + 1)/2)*np.pi/2/num_panels).ravel()
+    mu = np.cos(theta)
+    mu_weights = np.tile(weights*np.pi/4/num_panels, num_panels)*np.sin(theta)
+
+    Qr_table = 10**log_Qr_table
+    log_F_table = np.empty(num_pts)
+    for start in range(0, num_pts, orientation_block_size):
+        Qr_block = Qr_table[start:start+orientation_block_size, np.newaxis]
+        log_F_table[start:start+orientation_block_size] = np.log10(
+            amplitude_squared(Qr_block, mu) @ mu_weights)
+    porod_factor = 2*np.pi*surface_factor/volume_factor**2
+
+    def form_factor(Qr):
+        Qr = np.asarray(Qr, dtype = float)
+        log_Qr = np.log10(Qr)
+        return np.where(Qr <= Qr_max,
+                        10**np.interp(log_Qr, log_Qr_table, log_F_table),
+                        porod_factor/Qr**4)
+    return form_factor
+
+
+register_pore_model('sphere', sphere_model)
+register_pore_model('cylinder', cylinder_model, 5)
+register_pore_model('ellipsoid', ellipsoid_model, 2)
+register_pore_model('shell', shell_model, 0.2)
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar store of PDSP fit results in an HDF5 file, for aggregating many fits
+without parsing the text result files. Requires h5py.
+
+Each appended fit is a record consisting of
+    - the sample name, the time it was stored and the fitting parameters,
+    - the scalar results (porosity, average pore volume, pore concentration
+      and extrapolated SSA, each as value and relative error),
+    - the fitted data QQ, IQ, dIQ and the fitted I(Q),
+    - the pore size distribution rr, IQ0i, f(r), f'(r), SSA(r) and dV/dr.
+The file holds one dataset per column. Per-record columns are kept in the
+'index' group and can be queried without reading any curve. Curves are
+concatenated across records in the 'Q' and 'r' groups, and located through
+the Q_start/num_Q and r_start/num_r index columns. Records are appended in
+bulk, i.e. every dataset is resized and written once per append call.
+"""
+
+import os
+import time
+import numpy as np
+import PDSP_core as pc
+import batch_fitting as bfit
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+# Index columns holding the fitting parameters, in the format of
+# pc.default_fit_parameters. dIQ_percent is stored as nan when the measurement
+# error is taken from the data, lambda_ when λ was chosen for each file and
+# spline_knots when every r bin is fitted; lambda_auto is stored as '' when λ
+# was given
+param_columns = ('bkgrd', 'Qmin', 'Qmax', 'dIQ_percent', 'pts_per_dec', 'lambda_',
+                 'lambda_auto', 'resolution', 'slit_length', 'contrast', 'density',
+                 'r_SSA_extrapolate', 'num_pts_SSA_extrapolate', 'major_phase',
+                 'uncertainty', 'pore_model', 'spline_knots')
+str_param_columns = ('lambda_auto', 'resolution', 'major_phase', 'uncertainty', 'pore_model')
+int_param_columns = ('pts_per_dec', 'num_pts_SSA_extrapolate', 'spline_knots')
+
+# Values of the parameter columns added after the first version of the store,
+# for the records of stores written before
+column_defaults = {'lambda_auto': '', 'uncertainty': 'heuristic', 'pore_model': 'sphere',
+                   'spline_knots': np.nan}
+
+# Index columns holding the scalar results, as (value, relative error)
+scalar_columns = ('phi', 'Vpore_avg', 'phi_on_Vavg', 'SSA_extrapolate')
+
+# Curve columns stored against Q and against r
+Q_columns = ('QQ', 'IQ', 'dIQ', 'IQ_fitted')
+r_columns = ('rr', 'IQ0_fitted', 'f_r', 'f_dash_r', 'SSA', 'dV_dr')
+
+
+# Return the dtype used to store a result field. Fields that can be complex
+# (see PDSPResult.real_fields) are always stored as complex, so that records
+# of real and complex results can share a column
+def field_dtype(field):
+    if field in pc.PDSPResult.fields and field not in pc.PDSPResult.real_fields:
+        return np.complex128
+    return np.float64
+
+
+# Class for reading and appending PDSP results to an HDF5 result store
+class PDSPResultStore:
+    def __init__(self, store_file_dir, mode = 'a'):
+        if h5py is None:
+            raise ValueError('h5py is required for the HDF5 result store')
+        self.file = h5py.File(store_file_dir, mode)
+        self.index_cache = None
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.file['index/sample']) if 'index' in self.file else 0
+
+    # Append the given column values to a resizable dataset, creating it on
+    # first use
+    def append_column(self, name, values, dtype):
+        values = np.asarray(values, dtype = dtype)
+        if name not in self.file:
+            self.file.create_dataset(name, data = values, maxshape = (None,) + values.shape[1:],
+                                     chunks = True)
+            return
+        dataset = self.file[name]
+        start = len(dataset)
+        dataset.resize(start + len(values), axis = 0)
+        dataset[start:] = values
+
+    # Append fits to the store. records is a list of
+    # (sample, params, QQ, IQ, dIQ, PDSP_result), where QQ, IQ, dIQ are the
+    # fitted (background-subtracted and trimmed) data
+    def append(self, records):
+        if not records:
+            return
+        index = {column: [] for column in ('sample', 'time') + param_columns +
+                 scalar_columns + ('Q_start', 'num_Q', 'r_start', 'num_r')}
+        curves = {column: [] for column in Q_columns + r_columns}
+        Q_start = len(self.file['Q/QQ']) if 'Q' in self.file else 0
+        r_start = len(self.file['r/rr']) if 'r' in self.file else 0
+        for sample, params, QQ, IQ, dIQ, PDSP_result in records:
+            index['sample'].append(sample)
+            index['time'].append(time.time())
+            for column in param_columns:
+                value = params[column]
+                if value is None:
+                    value = '' if column in str_param_columns else np.nan
+                index[column].append(value)
+            for column in scalar_columns:
+                index[column].append(getattr(PDSP_result, column))
+
+            for column, values in zip(('QQ', 'IQ', 'dIQ'), (QQ, IQ, dIQ)):
+                curves[column].append(values)
+            for column in ('IQ_fitted',) + r_columns:
+                curves[column].append(getattr(PDSP_result, column))
+            index['Q_start'].append(Q_start)
+            index['num_Q'].append(len(QQ))
+            index['r_start'].append(r_start)
+            index['num_r'].append(len(PDSP_result.rr))
+            Q_start += len(QQ)
+            r_start += len(PDSP_result.rr)
+
+        str_dtype = h5py.string_dtype()
+        num_records = len(self)
+        for column, values in index.items():
+            if num_records and 'index/' + column not in self.file:
+                values = [column_defaults[column]]*num_records + values
+            if column in ('sample',) + str_param_columns:
+                dtype = str_dtype
+            elif column in ('Q_start', 'num_Q', 'r_start', 'num_r'):
+                dtype = np.int64
+            else:
+                dtype = field_dtype(column)
+            self.append_column('index/' + column, values, dtype)
+        for column, values in curves.items():
+            group = 'Q/' if column in Q_columns else 'r/'
+            self.append_column(group + column, np.concatenate(values), field_dtype(column))
+        self.file.flush()
+        self.index_cache = None
+
+    # Return the index as a dict of column name to array, one entry per record
+    def read_index(self):
+        if self.index_cache is None:
+            self.index_cache = {}
+            if 'index' in self.file:
+                for column, dataset in self.file['index'].items():
+                    self.index_cache[column] = (dataset.asstr()[:]
+                                                if h5py.check_string_dtype(dataset.dtype)
+                                                else dataset[:])
+            for column, value in column_defaults.items():
+                if column not in self.index_cache:
+                    self.index_cache[column] = np.full(len(self), value, dtype = 
+                                                       object if isinstance(value, str)
+                                                       else float)
+        return self.index_cache
+
+    # Return the record numbers matching the given sample name and fitting
+    # parameters, e.g. query(sample = 'a.dat', lambda_ = 1, pore_model = 'cylinder').
+    # Numeric parameters are compared up to rounding, and None matches records
+    # without the parameter, e.g. dIQ_percent = None those with the measurement
+    # error from the data
+    def query(self, sample = None, **params):
+        index = self.read_index()
+        unknown_params = set(params) - set(param_columns)
+        if unknown_params:
+            raise ValueError('Unknown fitting parameters: ' + ', '.join(sorted(unknown_params)))
+        match = np.ones(len(self), dtype = bool)
+        if sample is not None:
+            match &= index['sample'] == sample
+        for column, value in params.items():
+            if column in str_param_columns:
+                match &= index[column] == ('' if value is None else value)
+            elif value is None:
+                match &= np.isnan(index[column])
+            else:
+                match &= np.isclose(index[column], value, rtol = 1e-9, atol = 0)
+        return np.flatnonzero(match)
+
+    # Return the curves of a column for the given records as a list of arrays.
+    # The column is read once over the span of the requested records
+    def read_column(self, column, records = None):
+        index = self.read_index()
+        records = np.arange(len(self)) if records is None else np.atleast_1d(records)
+        if len(records) == 0:
+            return []
+        prefix = 'Q' if column in Q_columns else 'r'
+        starts = index[prefix + '_start'][records]
+        ends = starts + index['num_' + prefix][records]
+        span_start, span_end = np.min(starts), np.max(ends)
+        values = self.file[prefix + '/' + column][span_start:span_end]
+        return [values[start - span_start:end - span_start]
+                for start, end in zip(starts, ends)]
+
+    # Return the fitting parameters, fitted data and PDSP result of a record
+    def read_record(self, record):
+        index = self.read_index()
+        params = {}
+        for column in param_columns:
+            value = index[column][record]
+            if column in str_param_columns:
+                params[column] = str(value) or None
+            elif column in int_param_columns:
+                params[column] = None if np.isnan(value) else int(value)
+            else:
+                params[column] = None if np.isnan(value) else float(value)
+
+        arrays = {column: self.read_column(column, record)[0]
+                  for column in Q_columns + r_columns}
+        for column in scalar_columns:
+            arrays[column] = index[column][record]
+        # Results of real fits are returned as real, as from the fit
+        if all(np.all(np.imag(arrays[field]) == 0) for field in pc.PDSPResult.fields):
+            arrays = {column: np.real(values) for column, values in arrays.items()}
+        PDSP_result = pc.PDSPResult.from_arrays(*[arrays[field]
+                                                  for field in pc.PDSPResult.fields],
+                                                pore_model = params['pore_model'])
+        return {'sample': index['sample'][record], 'params': params,
+                'QQ': arrays['QQ'], 'IQ': arrays['IQ'], 'dIQ': arrays['dIQ'],
+                'PDSP_result': PDSP_result}
+
+
+# Append the results of fitting the given data files with the same fitting
+# parameters (e.g. from batch_fitting.fit_files) to a result store in one bulk
+# write. The fitted data are read again from the files. Files that could not
+# be fitted (result None) are skipped. If λ was chosen for each file
+# (lambda_auto), lambda_ is stored as nan, the chosen values are in the PDSP
+# result files
+def store_fit_results(store_file_dir, file_list, results, params):
+    store_params = params if params['lambda_auto'] is None else dict(params, lambda_ = None)
+    records = []
+    for file_dir, PDSP_result in zip(file_list, results):
+        if PDSP_result is None:
+            continue
+        QQ_trim, IQ_trim, dIQ_trim, _, _ = bfit.load_SANS_file(file_dir, params)
+        records.append((os.path.basename(file_dir), store_params, QQ_trim, IQ_trim, dIQ_trim,
+                        PDSP_result))
+    with PDSPResultStore(store_file_dir) as store:
+        store.append(records)
+    return len(records)
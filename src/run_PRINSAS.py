@@ -5,10 +5,24 @@ Created on Thu Dec 19 19:41:41 2024
 @author: NHUHA
 """
 
+import os
 import sys
 import time
+import sqlite3
+import functools
+import multiprocessing
 import warnings
+import concurrent.futures
 import numpy as np
+import PDSP_core as pc
+import batch_fitting as bfit
+import pore_models as pm
+import result_store as rs
+import file_prefetch as fp
+import data_catalog as dc
+import session_file as sf
+import fitting_service as fs
+import lambda_selection as lsel
 import backend_functions as bf
 import plot_formating as pf
 import PyQt5.QtWidgets as QtWdgt
@@ -17,11 +31,38 @@ import PyQt5.QtCore as QtCore
 
 import matplotlib.backends.backend_qt5agg as mpl_backend
 import matplotlib.figure as mpl_figure
+import matplotlib.widgets as mpl_widgets
 
 
 # Ignore UserWarning
 warnings.filterwarnings("ignore", category=UserWarning)
 
+
+# Table model showing a 2D array in a QTableView. Cells are formatted when
+# they are shown, so large tables are not converted to text up front
+class ArrayTableModel(QtCore.QAbstractTableModel):
+    def __init__(self, table, columns):
+        super().__init__()
+        self.table = table
+        self.columns = columns
+        
+    def rowCount(self, parent = QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.table)
+    
+    def columnCount(self, parent = QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+    
+    def data(self, index, role = QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole:
+            return '{:.4g}'.format(self.table[index.row(), index.column()])
+        return None
+    
+    def headerData(self, section, orientation, role = QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.columns[section]
+        return None
+
+
 class PRINSAS_App(QtWdgt.QMainWindow):
     def __init__(self):
         super().__init__()
@@ -54,6 +95,11 @@ class PRINSAS_App(QtWdgt.QMainWindow):
     def closeEvent(self, event):
         """Override the close event to save geometry."""
         self.save_window_location()
+        if self.workspace_executor is not None:
+            self.workspace_executor.shutdown(wait = False, cancel_futures = True)
+        self.prefetcher.shutdown()
+        if self.catalog_dialog is not None:
+            self.catalog_executor.shutdown(wait = False, cancel_futures = True)
         super().closeEvent(event)
 
     # Function used for restore program position
@@ -94,8 +140,28 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         self.section_spacing = round(15*self.scale)
         self.input_result_width = round(680*self.scale)
         self.confirm_button_width = round(150*self.scale)
+        # Attributes, input boxes and data arrays stored in session files
+        self.session_variables = ('chosen_data_file_dir', 'chosen_data_folder_dir',
+                                  'chosen_save_folder_dir', 'bkgrd', 'Qmin', 'Qmax',
+                                  'pts_per_dec', 'lambda_', 'resolution', 'slit_length',
+                                  'contrast', 'density', 'major_phase', 'r_SSA_extrapolate',
+                                  'num_pts_SSA_extrapolate', 'IQ_percent_dIQ',
+                                  'slit_length_data')
+        self.session_input_boxes = ('bkgrd_input_box', 'Qmin_input_box', 'Qmax_input_box',
+                                    'dIQ_percent_input_box', 'slit_length_input_box',
+                                    'pts_per_dec_input_box', 'lambda_input_box',
+                                    'contrast_input_box', 'density_input_box',
+                                    'r_SSA_extrapolate_input_box',
+                                    'num_pts_SSA_extrapolate_input_box')
+        self.session_arrays = ('QQ_origin', 'IQ_origin', 'dIQ_origin', 'dIQ_data', 'dIQ_user',
+                               'dQ_data', 'QQ_trim', 'IQ_trim', 'dIQ_trim', 'dQ_trim')
+        # Address of the fitting service used for fitting, None to fit in-process
+        self.fit_service_url = os.environ.get('PRINSAS_FIT_SERVER') or None
         # Chosen file directory
         self.chosen_data_file_dir = ''
+        # Parsed data files, the files next to the chosen file are read in
+        # the background so stepping through the folder does not wait for them
+        self.prefetcher = fp.DataFilePrefetcher()
         self.chosen_data_folder_dir = ''
         self.chosen_save_folder_dir = ''
         # Large-Q background
@@ -107,6 +173,11 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         self.pts_per_dec = 10
         # Smoothing factor lambda
         self.lambda_ = 1
+        # Instrument resolution used to smear the PDSP model: 'None', 
+        # 'dQ from data' or 'Slit length'
+        self.resolution = 'None'
+        # Slit length for slit-smeared data (A-1)
+        self.slit_length = 0
         # Contrast btw 2 phases (cm-2)
         self.contrast = 3e10
         # Sample bulk density (g/cc)
@@ -117,6 +188,12 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         self.r_SSA_extrapolate = 0.2
         # Number of points for SSA extrapolation
         self.num_pts_SSA_extrapolate = 7
+        # Method of estimating the errors of the result, see pc.uncertainty_modes
+        self.uncertainty = 'heuristic'
+        # Pore model of the kernel, see pore_models
+        self.pore_model = 'sphere'
+        # Number of knots of the B-spline of log IQ0, None to fit every r bin
+        self.spline_knots = None
         
         # SANS data loaded from data file
         self.QQ_origin = []
@@ -125,18 +202,52 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         self.dIQ_data = []
         self.IQ_percent_dIQ = []
         self.dIQ_user = []
+        self.dQ_data = None
+        self.slit_length_data = None
+        # Fast approximate fitter of the live preview, built for the loaded
+        # data and the resolution in preview_resolution
+        self.preview = None
+        self.preview_resolution = None
+        # Number of steps of the background slider of the live preview
+        self.bkgrd_slider_steps = 1000
         
         # background-subtracted SANS data trimmed to a certain Q-max value
         self.QQ_trim = []
         self.IQ_trim = []
         self.dIQ_trim = []
+        self.dQ_trim = None
 
         # PDSP fit result 
+        self.PDSP_result = None
+        # Fitting parameters of the previous fits of the chosen data file, 
+        # latest first. Their results are kept in the fit cache
+        self.fit_history = []
         self.result_phi = 0
         self.result_SSA = 0
         self.result_rr = []
         self.result_fr = []
         self.result_dVdr = []
+        
+        # Data files loaded in the workspace, see create_workspace_panel. Each
+        # entry is a dict of the file, its state as returned by 
+        # get_session_state with its fit history and its fitting parameters
+        # (None until another file is shown), the fitting parameters, fit
+        # cache key, result and trimmed data of its last fit, and the future
+        # of its running background fit
+        self.workspace = []
+        # Index of the entry of the shown data file, None if it is not in the
+        # workspace
+        self.workspace_index = None
+        # Process pool fitting the workspace in the background, created on 
+        # first use
+        self.workspace_executor = None
+        # Catalog of data files searched by the catalog dialog (see 
+        # data_catalog), the dialog, created on first use, and the future of
+        # indexing a folder into the catalog in the background
+        self.catalog_file_dir = QtCore.QSettings("henry@pnhvu.com", 
+                                                 "PRINSAS 2.0").value("catalog file", '')
+        self.catalog_dialog = None
+        self.catalog_future = None
 
     # Function drawing the main ui element 
     def init_ui(self):
@@ -153,6 +264,8 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         self.main_layout = QtWdgt.QGridLayout()
         self.main_layout.setSpacing(round(10*self.scale))
         central_widget.setLayout(self.main_layout)
+        self.create_workspace_panel()
+        self.create_menu()
 
         # User input area
         user_input_result_panel = QtWdgt.QWidget()
@@ -181,7 +294,7 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         data_input_grid.setColumnMinimumWidth(2,round(120*self.scale))
         data_input_grid.setColumnMinimumWidth(3,round(40*self.scale))
         data_input_grid.setVerticalSpacing(round(12*self.scale))
-        data_input_grid.setRowMinimumHeight(5, round(24*self.scale))  # Spacing between lambda input and PDSP input
+        data_input_grid.setRowMinimumHeight(6, round(24*self.scale))  # Spacing between lambda input and PDSP input
         input_group_box.setLayout(data_input_grid)
         user_input_result_layout.addWidget(input_group_box)
         user_input_result_layout.insertSpacing(1, self.section_spacing)
@@ -191,10 +304,10 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         
         # Add number of points per decade input row and lambda input row
         # to user input area
-        self.create_pts_per_dec_lambda_input(data_input_grid, row = 3)
+        self.create_pts_per_dec_lambda_input(data_input_grid, row = 4)
         
         # Add PDSP input row to user input area
-        self.create_PDSP_fit_input(data_input_grid, row = 6)
+        self.create_PDSP_fit_input(data_input_grid, row = 7)
         
         # Add run fit button to user input area
         self.run_fit_button = QtWdgt.QPushButton("Fit PDSP Model!")
@@ -224,6 +337,145 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         user_input_result_layout.addLayout(plot_description_layout)
         user_input_result_layout.addStretch()
         
+    # Add the File menu for opening and saving sessions
+    def create_menu(self):
+        file_menu = self.menuBar().addMenu('File')
+        open_session_action = file_menu.addAction('Open Session...')
+        open_session_action.setShortcut(QtGui.QKeySequence.Open)
+        open_session_action.triggered.connect(self.open_session_func)
+        save_session_action = file_menu.addAction('Save Session...')
+        save_session_action.setShortcut(QtGui.QKeySequence.Save)
+        save_session_action.triggered.connect(self.save_session_func)
+        file_menu.addSeparator()
+        previous_file_action = file_menu.addAction('Previous File in Folder')
+        previous_file_action.setShortcut(QtGui.QKeySequence.Back)
+        previous_file_action.triggered.connect(lambda: self.step_file_func(-1))
+        next_file_action = file_menu.addAction('Next File in Folder')
+        next_file_action.setShortcut(QtGui.QKeySequence.Forward)
+        next_file_action.triggered.connect(lambda: self.step_file_func(1))
+        file_menu.addSeparator()
+        add_files_action = file_menu.addAction('Add Files to Workspace...')
+        add_files_action.triggered.connect(self.add_files_func)
+        file_menu.addAction(self.workspace_dock.toggleViewAction())
+        find_files_action = file_menu.addAction('Find Files in Catalog...')
+        find_files_action.setShortcut(QtGui.QKeySequence.Find)
+        find_files_action.triggered.connect(self.catalog_func)
+        
+        fit_menu = self.menuBar().addMenu('Fit')
+        lambda_menu = fit_menu.addMenu('Choose \u03BB Automatically')
+        for method, method_text in (('gcv', 'Generalised Cross-Validation'),
+                                    ('lcurve', 'L-Curve Corner'),
+                                    ('discrepancy', 'Discrepancy Principle')):
+            lambda_action = lambda_menu.addAction(method_text)
+            lambda_action.triggered.connect(
+                lambda checked, method = method: self.choose_lambda_func(method))
+        
+        uncertainty_menu = fit_menu.addMenu('Error Estimate')
+        uncertainty_group = QtWdgt.QActionGroup(self)
+        self.uncertainty_actions = {}
+        for uncertainty, uncertainty_text in (('heuristic', 'Heuristic (Fit Error of I(Q))'),
+                                              ('laplace', 'Laplace (Hessian of the Fit)')):
+            uncertainty_action = uncertainty_menu.addAction(uncertainty_text)
+            uncertainty_action.setCheckable(True)
+            uncertainty_action.setChecked(uncertainty == self.uncertainty)
+            uncertainty_group.addAction(uncertainty_action)
+            uncertainty_action.triggered.connect(
+                lambda checked, uncertainty = uncertainty: self.set_uncertainty(uncertainty))
+            self.uncertainty_actions[uncertainty] = uncertainty_action
+        
+        self.pore_model_menu = fit_menu.addMenu('Pore Model')
+        self.pore_model_group = QtWdgt.QActionGroup(self)
+        self.pore_model_actions = {}
+        for pore_model, pore_model_text in (('sphere', 'Sphere'),
+                                            ('cylinder', 'Cylinder (Length = 10 r)'),
+                                            ('ellipsoid', 'Spheroid (Polar Semi-Axis = 2 r)'),
+                                            ('shell', 'Shell (Thickness = 0.2 r)')):
+            self.add_pore_model_action(pore_model, pore_model_text)
+        self.pore_model_menu.addSeparator()
+        other_pore_model_action = self.pore_model_menu.addAction('Other Shape...')
+        other_pore_model_action.triggered.connect(self.choose_pore_model_func)
+        
+        self.spline_action = fit_menu.addAction('Spline Distribution...')
+        self.spline_action.setCheckable(True)
+        self.spline_action.triggered.connect(self.choose_spline_knots_func)
+        
+        fit_menu.addSeparator()
+        sensitivity_action = fit_menu.addAction('Sensitivity Analysis...')
+        sensitivity_action.triggered.connect(self.sensitivity_func)
+        fit_workspace_action = fit_menu.addAction('Fit All Workspace Files')
+        fit_workspace_action.triggered.connect(self.fit_workspace_func)
+        
+    # Add a checkable action choosing the pore model to the Pore Model menu
+    def add_pore_model_action(self, pore_model, pore_model_text):
+        pore_model_action = QtWdgt.QAction(pore_model_text, self)
+        pore_model_action.setCheckable(True)
+        pore_model_action.setChecked(pore_model == self.pore_model)
+        self.pore_model_group.addAction(pore_model_action)
+        separators = [action for action in self.pore_model_menu.actions() if action.isSeparator()]
+        self.pore_model_menu.insertAction(separators[0] if separators else None, pore_model_action)
+        pore_model_action.triggered.connect(
+            lambda checked, pore_model = pore_model: self.set_pore_model(pore_model))
+        self.pore_model_actions[pore_model] = pore_model_action
+        
+    # Set the pore model of the next fits, adding it to the Pore Model menu if
+    # it is not listed there
+    def set_pore_model(self, pore_model):
+        if pore_model not in self.pore_model_actions:
+            self.add_pore_model_action(pore_model, pore_model)
+        self.pore_model = pore_model
+        self.pore_model_actions[pore_model].setChecked(True)
+        print(f"Pore model set to: {pm.get_pore_model(pore_model).name}")
+        if len(self.QQ_trim) > 0:
+            self.run_fit_button.setEnabled(True)
+            
+    # Function used to enter a pore model with a shape parameter, e.g. 
+    # cylinder:20. Activated from Fit > Pore Model > Other Shape...
+    def choose_pore_model_func(self):
+        pore_model, accepted = QtWdgt.QInputDialog.getText(
+            self, 'Pore Model', 
+            'Pore model and shape parameter (' + ', '.join(pm.pore_model_factories) + 
+            '), e.g. cylinder:20', text = self.pore_model)
+        if not accepted:
+            self.pore_model_actions[self.pore_model].setChecked(True)
+            return
+        pore_model = pore_model.strip()
+        try:
+            pm.check_pore_model(pore_model)
+        except ValueError as e:
+            self.show_error_message(str(e))
+            return
+        self.set_pore_model(pore_model)
+        
+    # Set the number of knots of the B-spline of log IQ0 of the next fits, or
+    # None to fit every r bin
+    def set_spline_knots(self, spline_knots):
+        self.spline_knots = spline_knots
+        self.spline_action.setChecked(spline_knots is not None)
+        print("Distribution fitted " + ('per r bin' if spline_knots is None else
+                                        f"as a B-spline with {spline_knots} knots"))
+        if len(self.QQ_trim) > 0:
+            self.run_fit_button.setEnabled(True)
+            
+    # Function used to enter the number of knots of the B-spline of log IQ0,
+    # 0 to fit every r bin. Activated from Fit > Spline Distribution...
+    def choose_spline_knots_func(self):
+        spline_knots, accepted = QtWdgt.QInputDialog.getInt(
+            self, 'Spline Distribution',
+            'Number of knots of the cubic B-spline of log IQ0 (0: fit every r bin)',
+            value = self.spline_knots or 0, min = 0, max = 1000)
+        if accepted:
+            self.set_spline_knots(spline_knots if spline_knots >= 2 else None)
+        else:
+            self.spline_action.setChecked(self.spline_knots is not None)
+        
+    # Set the method of estimating the errors of the next fits
+    def set_uncertainty(self, uncertainty):
+        self.uncertainty = uncertainty
+        self.uncertainty_actions[uncertainty].setChecked(True)
+        print(f"Error estimate set to: {uncertainty}")
+        if len(self.QQ_trim) > 0:
+            self.run_fit_button.setEnabled(True)
+        
     # This function create the elements necessary for selecting the SANS data file
     def create_file_selection(self, file_selection_row):
         # Data file section
@@ -239,6 +491,15 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         self.choose_file_dir_button.clicked.connect(self.choose_file)
         file_selection_layout.addWidget(self.choose_file_dir_button)
         
+        # Button to search the data files of the catalog
+        self.find_file_button = QtWdgt.QPushButton("Find")
+        self.find_file_button.setFixedWidth(round(80*self.scale))
+        self.find_file_button.setStyleSheet(self.choose_file_dir_button.styleSheet())
+        self.find_file_button.setToolTip('Find data files by name, header entries and Q '
+                                         'range in the catalog of indexed folders')
+        self.find_file_button.clicked.connect(self.catalog_func)
+        file_selection_layout.addWidget(self.find_file_button)
+        
         # Tooltip
         file_select_description = (
             "The program reads ASCII data files. The first two required columns are the "
@@ -257,7 +518,7 @@ class PRINSAS_App(QtWdgt.QMainWindow):
             f'''
             QLabel{{font-size: {round(18*self.scale)}px;}}''')
         self.file_dir_label.setFixedWidth(self.input_result_width
-                                          -round(180*self.scale))
+                                          -round(260*self.scale))
         file_selection_layout.addWidget(self.file_dir_label)
         
         # Add element to the main program
@@ -349,6 +610,30 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         Qmax_tool_tip = self.make_tool_tip(dIQ_description)
         data_input_grid.addWidget(Qmax_tool_tip, row+2, self.input_tool_tip_col)
         
+        # Instrument resolution input elements
+        resolution_label = QtWdgt.QLabel("Resolution<br>smearing")
+        data_input_grid.addWidget(resolution_label, row+3, 0)
+        self.resolution_combo_box = QtWdgt.QComboBox()
+        self.resolution_combo_box.addItems(['None', 'dQ from data', 'Slit length'])
+        self.resolution_combo_box.model().item(1).setEnabled(False)
+        data_input_grid.addWidget(self.resolution_combo_box, row+3, 
+                                  self.input_field_col)
+        self.slit_length_input_box = QtWdgt.QLineEdit()
+        self.slit_length_input_box.setPlaceholderText("slit (\u212B\u207B\u00B9)")
+        data_input_grid.addWidget(self.slit_length_input_box, row+3, 
+                                  self.input_field_col+1)
+        resolution_description = (
+            "<b>Resolution smearing:</b><br>"
+            "Smears the PDSP model with the instrument resolution, so that smeared data "
+            "can be fitted without desmearing.<br><br>"
+            "• None: pinhole data without resolution correction.<br>"
+            "• dQ from data: Gaussian resolution using the fourth (sigmaQ) column of the data file.<br>"
+            "• Slit length: slit-smeared data (e.g. Kookaburra USANS), with the slit length in "
+            "\u212B<sup>-1</sup>. Read from the data file when it contains negative sigmaQ values."
+            )
+        resolution_tool_tip = self.make_tool_tip(resolution_description)
+        data_input_grid.addWidget(resolution_tool_tip, row+3, self.input_tool_tip_col)
+        
         # Confirm button
         self.confirm_bkgrd_Q_range_button = QtWdgt.QPushButton("Confirm\nValue")
         self.confirm_bkgrd_Q_range_button.setMinimumWidth(self.confirm_button_width)
@@ -357,7 +642,7 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         self.confirm_bkgrd_Q_range_button.clicked.connect(self.set_bkgrd_Q_range)
         self.confirm_bkgrd_Q_range_button.setEnabled(False)
         data_input_grid.addWidget(self.confirm_bkgrd_Q_range_button, row, 
-                                  self.input_confirm_col, 3, 1)
+                                  self.input_confirm_col, 4, 1)
         
     # Create input fields for points-per-decade and smoothing factor λ,
     # and set up input monitoring via focus events and timers.
@@ -623,6 +908,13 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         self.save_result_button.setEnabled(False)
         result_grid.addWidget(self.save_result_button, 4, 0, 1, 3)
         
+        # Fit history, selecting an entry restores its inputs and result
+        result_grid.addWidget(QtWdgt.QLabel('Fit history'), 5, 0)
+        self.fit_history_combo_box = QtWdgt.QComboBox()
+        self.fit_history_combo_box.setPlaceholderText('-')
+        self.fit_history_combo_box.activated.connect(self.restore_fit_history)
+        result_grid.addWidget(self.fit_history_combo_box, 5, 2)
+        
     # Add plot description for user
     def create_plot_description(self, plot_description_layout):
         description = QtWdgt.QLabel(
@@ -653,6 +945,7 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         plot_group_box_SAS, self.figure_SAS, self.canvas_SAS =\
                                         self.create_plot_layout('SAS Data')
         pf.set_SAS_plot(self.figure_SAS, self.scale)
+        self.create_preview_controls(plot_group_box_SAS.layout())
         self.main_layout.addWidget(plot_group_box_SAS, 0, 1)
         
         # Plotting window for background-subtracted data and fitted data
@@ -707,6 +1000,75 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         group_box.setLayout(plot_layout)
         return group_box, fig, canvas
 
+    # This function creates the live preview controls of the 'SAS Data' plot: a
+    # check box switching the preview on, a slider for the background and a
+    # span selector for the Q range dragged on the plot. While the preview is
+    # on, both update the input boxes and show a fast approximate fit. The full
+    # fit runs when 'Fit PDSP Model!' is pressed
+    def create_preview_controls(self, plot_layout):
+        preview_layout = QtWdgt.QHBoxLayout()
+        self.preview_check_box = QtWdgt.QCheckBox('Live preview')
+        self.preview_check_box.setEnabled(False)
+        self.preview_check_box.toggled.connect(self.toggle_preview)
+        preview_layout.addWidget(self.preview_check_box)
+        preview_layout.addWidget(QtWdgt.QLabel('Background'))
+        self.bkgrd_slider = QtWdgt.QSlider(QtCore.Qt.Horizontal)
+        self.bkgrd_slider.setRange(0, self.bkgrd_slider_steps)
+        self.bkgrd_slider.setEnabled(False)
+        self.bkgrd_slider.valueChanged.connect(self.move_bkgrd_slider)
+        preview_layout.addWidget(self.bkgrd_slider)
+        plot_layout.addLayout(preview_layout)
+        
+        # Mouse events of the plot go to the top axis, whose data coordinate is 0.1/Q
+        self.Q_range_selector = mpl_widgets.SpanSelector(
+            self.figure_SAS.get_axes()[1], self.select_Q_range_preview, 'horizontal',
+            useblit = True, interactive = True, onmove_callback = self.select_Q_range_preview,
+            props = dict(facecolor = 'tab:orange', alpha = 0.2))
+        self.Q_range_selector.set_active(False)
+        
+        # Preview updates are coalesced, at most one preview fit runs per 
+        # timer interval while the slider or the span is being dragged
+        self.preview_timer = QtCore.QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(30)
+        self.preview_timer.timeout.connect(self.update_preview)
+
+    # Create the workspace panel listing the loaded data files. Each file keeps
+    # its own inputs, data and results, which are shown when it is selected;
+    # all files can be fitted at once in background processes, and the 
+    # results of the checked files are overlaid in the four plots
+    def create_workspace_panel(self):
+        self.workspace_dock = QtWdgt.QDockWidget('Workspace', self)
+        self.workspace_dock.setObjectName('workspace_dock')
+        workspace_panel = QtWdgt.QWidget()
+        workspace_layout = QtWdgt.QVBoxLayout()
+        workspace_panel.setLayout(workspace_layout)
+        
+        self.workspace_list = QtWdgt.QListWidget()
+        self.workspace_list.setToolTip('Select a file to show it, check files to overlay '
+                                       'their results in the plots')
+        self.workspace_list.currentRowChanged.connect(self.select_workspace_entry)
+        self.workspace_list.itemChanged.connect(self.plot_overlays)
+        workspace_layout.addWidget(self.workspace_list)
+        
+        workspace_buttons = QtWdgt.QHBoxLayout()
+        for button_text, button_func in (('Add Files...', self.add_files_func),
+                                         ('Remove', self.remove_workspace_entry_func),
+                                         ('Fit All', self.fit_workspace_func)):
+            workspace_button = QtWdgt.QPushButton(button_text)
+            workspace_button.clicked.connect(button_func)
+            workspace_buttons.addWidget(workspace_button)
+        workspace_layout.addLayout(workspace_buttons)
+        
+        self.workspace_dock.setWidget(workspace_panel)
+        self.addDockWidget(QtCore.Qt.LeftDockWidgetArea, self.workspace_dock)
+        self.workspace_dock.hide()
+        
+        # Poll the background fits of the workspace, so the UI is not blocked
+        self.workspace_timer = QtCore.QTimer(self)
+        self.workspace_timer.setInterval(200)
+        self.workspace_timer.timeout.connect(self.check_workspace_fits)
+
     # Function create for selecting the SAS data file, activated when the button
     # 'Choose File' is clicked
     def choose_file(self):
@@ -716,71 +1078,104 @@ class PRINSAS_App(QtWdgt.QMainWindow):
                                                          self.chosen_data_folder_dir or "", 
                                                          "Text Files (*.txt *.dat *.csv *.ABS)")
         if file_dir:  # If a file is selected
-            # Read and obtain data from the selected file, then assign the
-            # data to the corresponding predefined variables and 
+            self.open_workspace_file(file_dir)
+            
+    # Read and plot the SAS data file, replacing the data shown. Return False
+    # if the file cannot be read, leaving the data shown unchanged
+    def load_data_file(self, file_dir):
+        # Read and obtain data from the selected file, then assign the
+        # data to the corresponding predefined variables and 
+        # the instrument resolution if available in the data file. The file
+        # is usually read already if it is next to the previously chosen file
+        try:
+            self.QQ_origin, self.IQ_origin, self.dIQ_data, \
+                QQ_resolution, dQ_resolution, self.slit_length_data = \
+                                                self.prefetcher.read(file_dir)
+        except (ValueError, OSError) as e:
+            self.show_error_message(str(e))
+            return False
+
+        self.dQ_data = (None if dQ_resolution is None else
+                        np.interp(self.QQ_origin, QQ_resolution, dQ_resolution))
+        self.resolution_combo_box.model().item(1).setEnabled(self.dQ_data is not None)
+        if self.slit_length_data:
+            self.resolution_combo_box.setCurrentText('Slit length')
+            self.slit_length_input_box.setText('{:g}'.format(self.slit_length_data))
+        elif self.resolution_combo_box.currentText() == 'dQ from data' and \
+                self.dQ_data is None:
+            self.resolution_combo_box.setCurrentText('None')
+
+        if not pc.has_valid_dIQ(self.QQ_origin, self.IQ_origin, self.dIQ_data):
+            self.choose_dIQ.buttons()[0].setEnabled(False)
+            self.choose_dIQ.buttons()[0].setChecked(False)
+            self.choose_dIQ.buttons()[1].setChecked(True)
+        else:
+            self.choose_dIQ.buttons()[0].setEnabled(True)
+
+        if self.choose_dIQ.buttons()[1].isChecked():
             try:
-                self.QQ_origin, self.IQ_origin, self.dIQ_data = \
-                                                    bf.read_SANS_data(file_dir)
+                self.set_parameter("IQ_percent_dIQ", 'Percentage Error',self.dIQ_percent_input_box, 
+                                   default_val = 2, min_val = 0, 
+                                   error_msg = ("Invalid dI(Q) percentage value. Must be a number > 0. " +
+                                                "Background percentage set to 2%"))
             except ValueError as e:
                 self.show_error_message(str(e))
-                return
-            
-            if isinstance(self.dIQ_data, int) or \
-                    (isinstance(self.dIQ_data, (list, np.ndarray)) and (len(self.dIQ_data) != len(self.QQ_origin) or 
-                                                                        np.sum(self.dIQ_data/self.IQ_origin) < 1e-5)):
-                self.choose_dIQ.buttons()[0].setEnabled(False)
-                self.choose_dIQ.buttons()[0].setChecked(False)
-                self.choose_dIQ.buttons()[1].setChecked(True)
-            else:
-                self.choose_dIQ.buttons()[0].setEnabled(True)
+            self.dIQ_user = self.IQ_origin * self.IQ_percent_dIQ/100
 
-            if self.choose_dIQ.buttons()[1].isChecked():
-                try:
-                    self.set_parameter("IQ_percent_dIQ", 'Percentage Error',self.dIQ_percent_input_box, 
-                                       default_val = 2, min_val = 0, 
-                                       error_msg = ("Invalid dI(Q) percentage value. Must be a number > 0. " +
-                                                    "Background percentage set to 2%"))
-                except ValueError as e:
-                    self.show_error_message(str(e))
-                self.dIQ_user = self.IQ_origin * self.IQ_percent_dIQ/100
+        # Result and fit history only apply to the previously chosen file
+        self.PDSP_result = None
+        self.fit_history = []
+        self.fit_history_combo_box.clear()
 
-            # Save chosen file location and displaying file info
-            self.chosen_data_file_dir = file_dir
-            self.chosen_data_folder_dir = '/'.join(self.chosen_data_file_dir.split('/')[:-1])
-            self.file_dir_label.setText(self.chosen_data_file_dir.split('/')[-1]) # Display selected file name
-            print('Folder of chosen data file: ' + self.chosen_data_folder_dir)
-            print('')
-            
-            # Clear plots, result prior to plotting new data set
-            bf.clear_plot(self.figure_SAS, self.canvas_SAS)
-            bf.clear_plot(self.figure_SAS_fitted, self.canvas_SAS_fitted)
-            self.clear_result()
-                        
-            # Plot the input SAS data
-            self.dIQ_origin = self.dIQ_data.copy() \
-                if self.choose_dIQ.buttons()[0].isChecked() \
-                    else self.dIQ_user.copy()
-                
-            bf.plot_SANS_data(self.QQ_origin, self.IQ_origin, self.dIQ_origin,
+        # Save chosen file location and displaying file info
+        self.chosen_data_file_dir = file_dir
+        self.chosen_data_folder_dir = '/'.join(self.chosen_data_file_dir.split('/')[:-1])
+        self.file_dir_label.setText(self.chosen_data_file_dir.split('/')[-1]) # Display selected file name
+        print('Folder of chosen data file: ' + self.chosen_data_folder_dir)
+        print('')
+
+        # Clear plots, result prior to plotting new data set
+        bf.clear_plot(self.figure_SAS, self.canvas_SAS)
+        bf.clear_plot(self.figure_SAS_fitted, self.canvas_SAS_fitted)
+        self.clear_result()
+
+        # Plot the input SAS data
+        self.dIQ_origin = self.dIQ_data.copy() \
+            if self.choose_dIQ.buttons()[0].isChecked() \
+                else self.dIQ_user.copy()
+
+        bf.plot_SANS_data(self.QQ_origin, self.IQ_origin, self.dIQ_origin,
+                          self.figure_SAS, self.canvas_SAS)
+        self.QQ_trim = self.QQ_origin.copy()
+        self.IQ_trim = self.IQ_origin.copy()
+        self.dIQ_trim = self.dIQ_origin.copy()
+        self.QQ_trim, self.IQ_trim, self.dIQ_trim = \
+            pc.subtract_background(self.QQ_origin, self.IQ_origin, self.dIQ_origin,
+                                   self.bkgrd, self.Qmin, self.Qmax)
+        self.trim_resolution()
+        bf.plot_SANS_subtract(self.QQ_trim, self.IQ_trim, 
+                              self.QQ_origin, self.bkgrd,
                               self.figure_SAS, self.canvas_SAS)
-            self.QQ_trim = self.QQ_origin.copy()
-            self.IQ_trim = self.IQ_origin.copy()
-            self.dIQ_trim = self.dIQ_origin.copy()
-            self.QQ_trim, self.IQ_trim, self.dIQ_trim = \
-                bf.subtract_background(self.QQ_origin, self.IQ_origin, self.dIQ_origin,
-                                       self.bkgrd, self.Qmin, self.Qmax)
-            bf.plot_SANS_subtract(self.QQ_trim, self.IQ_trim, 
-                                  self.QQ_origin, self.bkgrd,
-                                  self.figure_SAS, self.canvas_SAS)
-            bf.plot_SANS_fit(self.QQ_trim, self.IQ_trim, 
-                             self.figure_SAS_fitted, self.canvas_SAS_fitted, 
-                             which = 'input')
-            
-            # Enable/disable action buttons to prevent accidental inputs
-            self.confirm_bkgrd_Q_range_button.setEnabled(True)
-            self.run_fit_button.setEnabled(True)       
-            self.recalc_PDSP_input_button.setEnabled(False)
-            self.save_result_button.setEnabled(False)
+        bf.plot_SANS_fit(self.QQ_trim, self.IQ_trim, 
+                         self.figure_SAS_fitted, self.canvas_SAS_fitted, 
+                         which = 'input')
+
+        # Enable/disable action buttons to prevent accidental inputs
+        self.confirm_bkgrd_Q_range_button.setEnabled(True)
+        self.preview = None
+        self.preview_check_box.setEnabled(True)
+        self.run_fit_button.setEnabled(True)       
+        self.recalc_PDSP_input_button.setEnabled(False)
+        self.save_result_button.setEnabled(False)
+        self.plot_overlays()
+        
+        # Read the files next to the chosen file and calculate their kernels
+        # for the current fitting parameters in the background
+        try:
+            self.prefetcher.prefetch(fp.neighbour_files(file_dir), self.get_fit_parameters())
+        except OSError:
+            pass
+        return True
 
 
     # Function to assign value to fitting variables with validation.
@@ -824,7 +1219,8 @@ class PRINSAS_App(QtWdgt.QMainWindow):
     # limiting Q range, activated when the button 'Confirm Value' is clicked
     def set_bkgrd_Q_range(self, clear_result = False, propagate_error = False):
         prev_values = {"bkgrd": self.bkgrd, "Qmin": self.Qmin, 
-                       "Qmax": self.Qmax, "dIQ_origin": self.dIQ_origin}
+                       "Qmax": self.Qmax, "dIQ_origin": self.dIQ_origin,
+                       "resolution": self.resolution, "slit_length": self.slit_length}
         button_dIQ_data, button_dIQ_user = self.choose_dIQ.buttons()
 
         try:
@@ -848,6 +1244,16 @@ class PRINSAS_App(QtWdgt.QMainWindow):
                                                 "dI(Q) percentage set to 2%"))
                 self.dIQ_user = self.IQ_origin * self.IQ_percent_dIQ/100
                 self.dIQ_origin = self.dIQ_user.copy()
+            
+            # Process instrument resolution inputs
+            self.resolution = self.resolution_combo_box.currentText()
+            if self.resolution == 'Slit length':
+                self.set_parameter("slit_length", 'Slit length', self.slit_length_input_box,
+                                   default_val = self.slit_length_data or 0, min_val = 0,
+                                   error_msg = "Invalid slit length. Must be a number > 0.")
+                if not self.slit_length:
+                    raise ValueError("Slit length must be provided for slit-smeared data.")
+            print(f"Resolution smearing set to: {self.resolution}")
                 
         except ValueError as e:
             if not propagate_error:
@@ -866,22 +1272,136 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         if value_changed or clear_result:            
             if not np.array_equal(prev_values['dIQ_origin'], self.dIQ_origin):
                 self.QQ_trim, self.IQ_trim, self.dIQ_trim = \
-                    bf.subtract_background(self.QQ_origin, self.IQ_origin, self.dIQ_origin,
+                    pc.subtract_background(self.QQ_origin, self.IQ_origin, self.dIQ_origin,
                                            self.bkgrd, self.Qmin, self.Qmax)
                 bf.plot_SANS_data(self.QQ_origin, self.IQ_origin, self.dIQ_origin,
                                   self.figure_SAS, self.canvas_SAS)
 
             self.QQ_trim, self.IQ_trim, self.dIQ_trim = \
-                bf.subtract_background(self.QQ_origin, self.IQ_origin, self.dIQ_origin,
+                pc.subtract_background(self.QQ_origin, self.IQ_origin, self.dIQ_origin,
                                        self.bkgrd, self.Qmin, self.Qmax)
+            self.trim_resolution()
+            self.clear_preview()
 
             bf.plot_SANS_subtract(self.QQ_trim, self.IQ_trim, self.QQ_origin, self.bkgrd, self.figure_SAS, self.canvas_SAS)
             bf.plot_SANS_fit(self.QQ_trim, self.IQ_trim, self.figure_SAS_fitted, self.canvas_SAS_fitted, which='input')
             self.clear_result()
+            self.plot_overlays()
             self.recalc_PDSP_input_button.setEnabled(False)
             self.run_fit_button.setEnabled(True)
             self.save_result_button.setEnabled(False)
             
+    # Switch the live preview on or off
+    def toggle_preview(self, checked):
+        self.Q_range_selector.set_active(checked)
+        self.bkgrd_slider.setEnabled(checked)
+        if checked:
+            self.bkgrd_slider.blockSignals(True)
+            self.bkgrd_slider.setValue(self.bkgrd_slider_value(self.bkgrd))
+            self.bkgrd_slider.blockSignals(False)
+            self.preview_timer.start()
+        else:
+            self.Q_range_selector.clear()
+            self.clear_preview()
+
+    # Return the background of a position of the background slider: 0 at the
+    # left end, otherwise logarithmic over 3 decades up to the median 
+    # intensity of the 10 points at the highest Q
+    def slider_bkgrd(self, value):
+        if value == 0:
+            return 0
+        bkgrd_max = np.median(self.IQ_origin[np.argsort(self.QQ_origin)[-10:]])
+        return bkgrd_max*10**(3*(value/self.bkgrd_slider_steps - 1))
+
+    # Return the position of the background slider closest to the background
+    def bkgrd_slider_value(self, bkgrd):
+        if bkgrd <= 0 or len(self.IQ_origin) == 0:
+            return 0
+        bkgrd_max = np.median(self.IQ_origin[np.argsort(self.QQ_origin)[-10:]])
+        value = round(self.bkgrd_slider_steps*(1 + np.log10(bkgrd/bkgrd_max)/3))
+        return int(np.clip(value, 1, self.bkgrd_slider_steps))
+
+    # Enter the background of the slider position and update the preview
+    def move_bkgrd_slider(self, value):
+        self.bkgrd_input_box.setText('{:.4g}'.format(self.slider_bkgrd(value)))
+        if not self.preview_timer.isActive():
+            self.preview_timer.start()
+
+    # Enter the Q range of the span dragged on the 'SAS Data' plot, in the 
+    # coordinate 0.1/Q of the top axis, and update the preview
+    def select_Q_range_preview(self, x_min, x_max):
+        if not x_max > x_min > 0:
+            return
+        self.Qmin_input_box.setText('{:.4g}'.format(0.1/x_max))
+        self.Qmax_input_box.setText('{:.4g}'.format(0.1/x_min))
+        if not self.preview_timer.isActive():
+            self.preview_timer.start()
+
+    # Fit the data with the background, Q range and λ in the input boxes by 
+    # the fast approximate fitter, and show the subtracted data, the fitted
+    # I(Q) and f(r) as preview lines. Invalid inputs leave the preview empty
+    def update_preview(self):
+        if not self.preview_check_box.isChecked() or len(self.QQ_origin) == 0:
+            return
+        def read_box(input_box, default_val):
+            try:
+                return float(input_box.text())
+            except ValueError:
+                return default_val
+        bkgrd = read_box(self.bkgrd_input_box, 0)
+        Qmin = read_box(self.Qmin_input_box, 0)
+        Qmax = read_box(self.Qmax_input_box, np.inf)
+        lambda_ = read_box(self.lambda_input_box, self.lambda_)
+        
+        try:
+            # The preview is smeared with the confirmed resolution
+            resolution = (self.resolution, self.slit_length, self.pore_model)
+            if self.preview is None or self.preview_resolution != resolution:
+                self.preview = pc.PDSPPreview(
+                    self.QQ_origin,
+                    dQ = self.dQ_data if self.resolution == 'dQ from data' else None,
+                    slit_length = self.slit_length if self.resolution == 'Slit length' else None,
+                    pore_model = self.pore_model)
+                self.preview_resolution = resolution
+            QQ_trim, IQ_trim, dIQ_trim = pc.subtract_background(
+                self.QQ_origin, self.IQ_origin, self.dIQ_origin, bkgrd, Qmin, Qmax)
+            IQ_fitted, rr, f_r = self.preview.fit(QQ_trim, IQ_trim, dIQ_trim, lambda_)
+        except ValueError as e:
+            print(f'Preview not available: {e}')
+            self.clear_preview()
+            return
+        
+        QQ_bkgrd = self.QQ_origin if bkgrd > 0 else []
+        bf.plot_preview(QQ_bkgrd, np.full(len(QQ_bkgrd), bkgrd), 'Background',
+                        self.figure_SAS, self.canvas_SAS, fmt = '--b')
+        bf.plot_preview(QQ_trim, IQ_trim, 'Subtracted Data', self.figure_SAS_fitted,
+                        self.canvas_SAS_fitted, fmt = 'sg')
+        bf.plot_preview(QQ_trim, IQ_fitted, 'Fitted Result', self.figure_SAS_fitted,
+                        self.canvas_SAS_fitted, fmt = '-g')
+        bf.plot_preview(rr, f_r[:,0], 'f(r)', self.figure_fr_SSA, self.canvas_fr_SSA,
+                        fmt = '--g', autoscale = True)
+        self.run_fit_button.setEnabled(True)
+
+    # Remove the preview lines from all plots
+    def clear_preview(self):
+        for fig, canvas in ((self.figure_SAS, self.canvas_SAS),
+                            (self.figure_SAS_fitted, self.canvas_SAS_fitted),
+                            (self.figure_fr_SSA, self.canvas_fr_SSA)):
+            bf.clear_preview(fig, canvas)
+
+    # Trim the resolution dQ of the data to the background-subtracted Q range
+    def trim_resolution(self):
+        self.dQ_trim = (None if self.dQ_data is None else
+                        np.interp(self.QQ_trim, self.QQ_origin, self.dQ_data))
+
+    # Return the (dQ, slit_length) pair used to smear the PDSP model
+    def get_resolution(self):
+        if self.resolution == 'dQ from data':
+            return self.dQ_trim, None
+        elif self.resolution == 'Slit length':
+            return None, self.slit_length
+        return None, None
+            
     # Set PDSP fit parameters: contrast, bulk density, pore radius for SSA extrapolate
     # number of points for SSA extrapolation, and major phase
     def set_PDSP_fit_inputs(self, propagate_error = False):
@@ -922,6 +1442,35 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         print(f"Major phase of sample: {self.major_phase}")
         print('')
                 
+    # Choose the smoothing factor λ for the current data with the given method
+    # of lambda_selection, using the entered λ as the reference of the
+    # linearisation, and enter the chosen λ for the next fit. Activated from
+    # the Fit menu
+    def choose_lambda_func(self, method):
+        if len(self.QQ_trim) == 0:
+            self.show_error_message('Choose a data file before choosing \u03BB.')
+            return
+        try:
+            self.set_bkgrd_Q_range(propagate_error = True)
+            self.set_parameter('pts_per_dec', 'Number of points per decade for result', 
+                               self.pts_per_dec_input_box, default_val = 10, min_val = 3, 
+                               error_msg = ('Invalid number of points per decade for result. '
+                                            'Must be an integer >= 3'))
+            self.set_parameter('lambda_', 'Smoothing factor lambda', 
+                               self.lambda_input_box, default_val = 1, min_val = 0, 
+                               error_msg = ('Invalid lambda value. Must be > 0'))
+            lambda_, _ = lsel.select_lambda_for_data(self.QQ_trim, self.IQ_trim, self.dIQ_trim,
+                                                     self.pts_per_dec, method,
+                                                     *self.get_resolution(),
+                                                     pore_model = self.pore_model,
+                                                     lambda_ref = self.lambda_)
+        except ValueError as e:
+            self.show_error_message(str(e))
+            return
+        print(f"Smoothing factor lambda chosen by {method}: {lambda_:.3g}\n")
+        self.lambda_input_box.setText('{:.3g}'.format(lambda_))
+        self.run_fit_button.setEnabled(True)
+
     # This function fits, returns, and plots the PDSP result based on the provided
     # inputs. Activated when the button 'Fit PDSP Model!' is clicked.
     def run_fit_func(self):
@@ -948,22 +1497,29 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         # Run fit function
         print('Start PDSP fit')
         try:
-            self.rr, self.IQ_fitted, self.IQ0_fitted, self.f_r, self.f_dash_r, self.SSA,\
-                self.dV_dr, self.phi, self.Vpore_avg, self.phi_on_Vavg, self.SSA_extrapolate = \
-                    bf.fit_PDSP_model(self.QQ_trim, self.IQ_trim, self.dIQ_trim,
-                                      self.pts_per_dec, self.lambda_, 
-                                      self.contrast, self.density, self.r_SSA_extrapolate, 
-                                      self.num_pts_SSA_extrapolate, self.major_phase)
+            # Fit on the fitting service if one is given, otherwise in-process
+            if self.fit_service_url and self.uncertainty != 'heuristic':
+                raise ValueError('Only heuristic errors are available on the fitting service')
+            if self.fit_service_url and self.pore_model != 'sphere':
+                raise ValueError('Only the sphere pore model is available on the fitting service')
+            if self.fit_service_url and self.spline_knots is not None:
+                raise ValueError('Spline distributions are not available on the fitting service')
+            fit_func = (functools.partial(fs.fit_PDSP_remote, self.fit_service_url)
+                        if self.fit_service_url else
+                        functools.partial(pc.fit_PDSP_model_cached, uncertainty = self.uncertainty,
+                                          pore_model = self.pore_model,
+                                          spline_knots = self.spline_knots))
+            PDSP_result = fit_func(self.QQ_trim, self.IQ_trim, self.dIQ_trim,
+                                   self.pts_per_dec, self.lambda_,
+                                   self.contrast, self.density, 
+                                   self.r_SSA_extrapolate,
+                                   self.num_pts_SSA_extrapolate, 
+                                   self.major_phase, *self.get_resolution())
         except ValueError as e:
             self.show_error_message(str(e))
             return
         print('Done PDSP fit!\n')
-        
-        # Display result, enable/disable corresponding buttons to prevent accidental inputs.
-        self.display_result()        
-        self.recalc_PDSP_input_button.setEnabled(True)
-        self.run_fit_button.setEnabled(False)
-        self.save_result_button.setEnabled(True)
+        self.show_fit_result(PDSP_result)
         
         # Return warning message if result are not real value
         if np.iscomplex(self.phi[0]):
@@ -973,6 +1529,16 @@ class PRINSAS_App(QtWdgt.QMainWindow):
                 'Check the absolute scattering intensity or contrast between two phases.')
             self.show_error_message(warning_message, error_type = 'Fit Error')
             
+    # Store and display the PDSP result of the current inputs and add it to the
+    # fit history, then enable/disable the buttons to prevent accidental inputs
+    def show_fit_result(self, PDSP_result):
+        self.set_result(PDSP_result)
+        self.add_fit_history()
+        self.display_result()
+        self.recalc_PDSP_input_button.setEnabled(True)
+        self.run_fit_button.setEnabled(False)
+        self.save_result_button.setEnabled(True)
+        
     # Recalculate PDSP results that doesn't require a full refit, activated
     # when the button 'Recalculate Fit Result' is pressed.
     def recalc_PDSP_result(self):
@@ -984,13 +1550,188 @@ class PRINSAS_App(QtWdgt.QMainWindow):
             return
 
         # Recalculate fit result and display the result
-        _, self.SSA, self.dV_dr, self.phi, self.Vpore_avg,\
-            self.phi_on_Vavg, self.SSA_extrapolate =\
-                bf.calc_PDSP_result(self.rr*10, self.f_r, self.f_dash_r, self.IQ0_fitted, 
-                                    self.contrast, self.density, self.r_SSA_extrapolate,
-                                    self.num_pts_SSA_extrapolate, self.major_phase)
+        self.set_result(self.PDSP_result.recalc(self.contrast, self.density, 
+                                                self.r_SSA_extrapolate,
+                                                self.num_pts_SSA_extrapolate, 
+                                                self.major_phase))
         self.display_result()
         
+    # Open the sensitivity analysis of the current result: the porosity, pore
+    # volume and SSA over grids of contrast, density and SSA extrapolation,
+    # calculated from the current fit without refitting. Activated from
+    # Fit > Sensitivity Analysis...
+    def sensitivity_func(self):
+        if self.PDSP_result is None:
+            self.show_error_message('Fit the PDSP model before the sensitivity analysis.')
+            return
+        dialog = QtWdgt.QDialog(self)
+        dialog.setWindowTitle('Sensitivity Analysis')
+        dialog_layout = QtWdgt.QVBoxLayout(dialog)
+        
+        # Grids around the current inputs, as 'start:stop:num' or lists
+        grid_layout = QtWdgt.QFormLayout()
+        self.sensitivity_input_boxes = {}
+        for name, label, text in (
+                ('contrast', 'Contrast (10<sup>10</sup> cm<sup>-2</sup>)',
+                 '{:g}:{:g}:7'.format(self.contrast*0.7/1e10, self.contrast*1.3/1e10)),
+                ('density', 'Sample bulk density (g/cm<sup>3</sup>)',
+                 '{:g}:{:g}:7'.format(self.density*0.7, self.density*1.3)),
+                ('r_SSA_extrapolate', 'Pore radius for SSA (nm)',
+                 '{:g}:{:g}:5'.format(self.r_SSA_extrapolate*0.5, self.r_SSA_extrapolate*2)),
+                ('num_pts_SSA_extrapolate', 'Number of points for SSA',
+                 ','.join(str(num_pts) for num_pts in 
+                          sorted({max(2, self.num_pts_SSA_extrapolate - 2),
+                                  self.num_pts_SSA_extrapolate,
+                                  self.num_pts_SSA_extrapolate + 2})))):
+            input_box = QtWdgt.QLineEdit(text)
+            input_box.setToolTip("'start:stop:number of values' or a comma separated list")
+            grid_layout.addRow(QtWdgt.QLabel(label), input_box)
+            self.sensitivity_input_boxes[name] = input_box
+        dialog_layout.addLayout(grid_layout)
+        
+        button_layout = QtWdgt.QHBoxLayout()
+        calc_button = QtWdgt.QPushButton('Calculate')
+        calc_button.clicked.connect(self.calc_sensitivity_func)
+        button_layout.addWidget(calc_button)
+        button_layout.addWidget(QtWdgt.QLabel('SSA map at number of points'))
+        self.sensitivity_num_pts_box = QtWdgt.QComboBox()
+        self.sensitivity_num_pts_box.currentIndexChanged.connect(self.plot_sensitivity_func)
+        button_layout.addWidget(self.sensitivity_num_pts_box)
+        save_button = QtWdgt.QPushButton('Save Table')
+        save_button.clicked.connect(self.save_sensitivity_func)
+        button_layout.addWidget(save_button)
+        dialog_layout.addLayout(button_layout)
+        
+        self.figure_sensitivity = mpl_figure.Figure(figsize = (12, 3.6))
+        self.canvas_sensitivity = mpl_backend.FigureCanvas(self.figure_sensitivity)
+        self.canvas_sensitivity.setMinimumSize(round(1200*self.scale), round(400*self.scale))
+        dialog_layout.addWidget(mpl_backend.NavigationToolbar2QT(self.canvas_sensitivity,
+                                                                 dialog))
+        dialog_layout.addWidget(self.canvas_sensitivity)
+        self.sensitivity_table_view = QtWdgt.QTableView()
+        self.sensitivity_table_view.setMinimumHeight(round(250*self.scale))
+        dialog_layout.addWidget(self.sensitivity_table_view)
+        
+        self.sensitivity = None
+        self.calc_sensitivity_func()
+        dialog.show()
+        
+    # Calculate the sensitivity grid of the current result over the entered
+    # grids, then plot and tabulate it
+    def calc_sensitivity_func(self):
+        try:
+            grids = {name: pc.parse_parameter_grid(input_box.text(), 
+                                                   int if name == 'num_pts_SSA_extrapolate'
+                                                   else float)
+                     for name, input_box in self.sensitivity_input_boxes.items()}
+            if any(np.any(values <= 0) for values in grids.values()):
+                raise ValueError('All sensitivity grid values must be > 0')
+            sensitivity = self.PDSP_result.sensitivity(grids['contrast']*1e10, grids['density'],
+                                                       grids['r_SSA_extrapolate'],
+                                                       grids['num_pts_SSA_extrapolate'],
+                                                       self.major_phase)
+        except ValueError as e:
+            self.show_error_message(str(e))
+            return
+        self.sensitivity = sensitivity
+        self.sensitivity_table_view.setModel(
+            ArrayTableModel(pc.calc_sensitivity_table(sensitivity),
+                            pc.sensitivity_table_columns))
+        
+        # Refilling the number of points box replots the maps
+        self.sensitivity_num_pts_box.blockSignals(True)
+        self.sensitivity_num_pts_box.clear()
+        self.sensitivity_num_pts_box.addItems(
+            [str(num_pts) for num_pts in sensitivity['num_pts_SSA_extrapolate']])
+        self.sensitivity_num_pts_box.blockSignals(False)
+        self.plot_sensitivity_func()
+        
+    # Plot the maps of the sensitivity grid, with the SSA map at the chosen
+    # number of points
+    def plot_sensitivity_func(self):
+        if self.sensitivity is not None:
+            bf.plot_sensitivity_maps(self.sensitivity, self.figure_sensitivity,
+                                     self.canvas_sensitivity,
+                                     max(0, self.sensitivity_num_pts_box.currentIndex()))
+            
+    # Save the table of the sensitivity grid into a text file
+    def save_sensitivity_func(self):
+        if self.sensitivity is None:
+            return
+        if self.chosen_save_folder_dir == '':
+            self.chosen_save_folder_dir = self.chosen_data_folder_dir[:]
+        save_file_dir_default = (self.chosen_save_folder_dir + '/' +
+                                 pc.sensitivity_file_name(self.chosen_data_file_dir))
+        save_file_dir, _ = QtWdgt.QFileDialog.getSaveFileName(self, "Save Sensitivity Table", 
+                                                              save_file_dir_default, 
+                                                              "Text Files (*.txt);;All Files (*)")
+        if save_file_dir:
+            self.chosen_save_folder_dir = '/'.join(save_file_dir.split('/')[:-1])
+            pc.write_PDSP_sensitivity(save_file_dir, self.chosen_data_file_dir.split('/')[-1],
+                                      self.sensitivity)
+            print(f"Sensitivity table saved as {save_file_dir}\n")
+        
+    # Add the fitting parameters of the current fit to the top of the fit
+    # history, or move them there if they have been fitted before
+    def add_fit_history(self):
+        params = self.get_fit_parameters()
+        if params in self.fit_history:
+            self.fit_history.remove(params)
+        self.fit_history.insert(0, params)
+        del self.fit_history[pc.fit_cache_size:]
+        self.update_fit_history_box()
+        
+    # List the fit history in the fit history combo box
+    def update_fit_history_box(self):
+        self.fit_history_combo_box.clear()
+        for params in self.fit_history:
+            self.fit_history_combo_box.addItem(
+                'Bkgrd {:g}, Q [{:g}, {:g}], {:d} pts/dec, \u03BB {:g}'
+                .format(params['bkgrd'], params['Qmin'], params['Qmax'], 
+                        params['pts_per_dec'], params['lambda_']) +
+                ('' if params['pore_model'] == 'sphere' else ', ' + params['pore_model']) +
+                ('' if params['spline_knots'] is None else 
+                 ', spline {:d} knots'.format(params['spline_knots'])))
+        self.fit_history_combo_box.setCurrentIndex(0)
+        
+    # Restore the inputs of the selected fit history entry and redisplay its
+    # result, which is returned from the fit cache without refitting
+    def restore_fit_history(self, index):
+        params = self.fit_history[index]
+        self.bkgrd_input_box.setText('{:g}'.format(params['bkgrd']))
+        self.Qmin_input_box.setText('{:g}'.format(params['Qmin']))
+        self.Qmax_input_box.setText('' if np.isinf(params['Qmax']) else 
+                                    '{:g}'.format(params['Qmax']))
+        if params['dIQ_percent'] is None:
+            self.choose_dIQ.buttons()[0].setChecked(True)
+        else:
+            self.choose_dIQ.buttons()[1].setChecked(True)
+            self.dIQ_percent_input_box.setText('{:g}'.format(params['dIQ_percent']))
+        self.resolution_combo_box.setCurrentText(params['resolution'])
+        if params['resolution'] == 'Slit length':
+            self.slit_length_input_box.setText('{:g}'.format(params['slit_length']))
+        self.pts_per_dec_input_box.setText(str(params['pts_per_dec']))
+        self.lambda_input_box.setText('{:g}'.format(params['lambda_']))
+        self.contrast_input_box.setText('{:g}'.format(params['contrast']/1e10))
+        self.density_input_box.setText('{:g}'.format(params['density']))
+        self.r_SSA_extrapolate_input_box.setText('{:g}'.format(params['r_SSA_extrapolate']))
+        self.num_pts_SSA_extrapolate_input_box.setText(str(params['num_pts_SSA_extrapolate']))
+        for button in self.choose_major_phase.buttons():
+            button.setChecked(button.text().lower() == params['major_phase'])
+        self.set_uncertainty(params['uncertainty'])
+        self.set_pore_model(params['pore_model'])
+        self.set_spline_knots(params['spline_knots'])
+        self.run_fit_func()
+        
+    # Store the PDSP result and unpack its fields into the attributes used for
+    # displaying and saving the result
+    def set_result(self, PDSP_result):
+        self.PDSP_result = PDSP_result
+        self.result_data = (self.QQ_trim, self.IQ_trim)
+        self.rr, self.IQ_fitted, self.IQ0_fitted, self.f_r, self.f_dash_r, self.SSA,\
+            self.dV_dr, self.phi, self.Vpore_avg, self.phi_on_Vavg, self.SSA_extrapolate = \
+                PDSP_result
+        
     # Function used to present the result, including filling out the text boxes
     # in the result area and plotting the result.
     def display_result(self):
@@ -1004,11 +1745,13 @@ class PRINSAS_App(QtWdgt.QMainWindow):
                                                       self.SSA_extrapolate[1]*self.SSA_extrapolate[0]))
         
         # Plotting result
+        self.clear_preview()
         bf.plot_SANS_fit(self.QQ_trim, self.IQ_fitted, self.figure_SAS_fitted, 
                          self.canvas_SAS_fitted, which = 'result')      
         bf.plot_dVdr(self.rr, self.dV_dr, self.figure_dVdr, self.canvas_dVdr)   
         bf.plot_fr_SSA(self.rr, self.f_r, self.SSA, self.num_pts_SSA_extrapolate, 
                        self.r_SSA_extrapolate, self.figure_fr_SSA, self.canvas_fr_SSA)
+        self.plot_overlays()
                 
     # Function used to clear the result, including clearing out the text boxes
     # in the result area and removing the plot of the PDSP fit result.
@@ -1023,13 +1766,8 @@ class PRINSAS_App(QtWdgt.QMainWindow):
     # Function used to save the PDSP fit result into a text file, activated
     # when the button 'Save PDSP Result' is pressed.
     def save_result_func(self):
-        # create result table for r vs f(r), SSA(R), and dV/dr 
-        data_table = np.column_stack((self.rr, self.f_r[:,0], self.SSA[:,0], self.dV_dr[:,0], self.IQ0_fitted[:,1]))
-        
         # initialise save location
-        file_name_save = (self.chosen_data_file_dir.split('/')[-1].replace('.txt','').replace('.ABS','')
-                                  .replace('.dat','').replace('.csv','') 
-                                  + " PDSP Result.txt")
+        file_name_save = pc.result_file_name(self.chosen_data_file_dir)
         if self.chosen_save_folder_dir == '':
             self.chosen_save_folder_dir = self.chosen_data_folder_dir[:]
         save_file_dir_default = self.chosen_save_folder_dir + '/' + file_name_save
@@ -1038,57 +1776,563 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         options = QtWdgt.QFileDialog.Options()
         save_file_dir, _ = QtWdgt.QFileDialog.getSaveFileName(self, "Save File", 
                                                               save_file_dir_default, 
-                                                              "Text Files (*.txt);;All Files (*)", options=options)
+                                                              "Text Files (*.txt);;HDF5 Result Store (*.h5);;All Files (*)", options=options)
         # Remember previously used save folder
         self.chosen_save_folder_dir = '/'.join(save_file_dir.split('/')[:-1])
         
-        if save_file_dir:
+        if save_file_dir.endswith('.h5'):
+            # Append the result to the HDF5 result store
+            try:
+                with rs.PDSPResultStore(save_file_dir) as store:
+                    store.append([(self.chosen_data_file_dir.split('/')[-1],
+                                   self.get_fit_parameters(), self.QQ_trim,
+                                   self.IQ_trim, self.dIQ_trim, self.PDSP_result)])
+            except (ValueError, OSError) as e:
+                self.show_error_message(str(e))
+                return
+            print(f"Result appended to {save_file_dir}\n")
+        elif save_file_dir:
             # Create the file and write result
-            with open(save_file_dir, 'w') as file:
-                # Write file header, including file name, background value,
-                # Q-max, contrast, solid density, porosity, average pore volume,
-                # pore concentration, extrapolated SSA
-                file.write('PDSP Fit Result for ' + self.chosen_data_file_dir.split('/')[-1])
-                file.write('\n\n')
-                file.write('Background value (cm-1): {:.3e}'.format(self.bkgrd))
-                file.write('\n')
-                file.write('Selected Q range (A-1): [{:.3e}, {:.3e}]'.format(self.Qmin, self.Qmax))
-                file.write('\n')
-                if self.choose_dIQ.buttons()[0].isChecked():
-                    file.write('Measurement error dI(Q): From data')
-                elif self.choose_dIQ.buttons()[1].isChecked():
-                    file.write('Measurement error dI(Q): {:.1f}% I(Q)'.format(self.IQ_percent_dIQ))
-                file.write('\n')
-                file.write('Smoothing factor Lambda: {:.1e}'.format(self.lambda_))
-                file.write('\n')
-                file.write('Contrast between 2 phases (cm-2): {:.3e}'.format(self.contrast))
-                file.write('\n')
-                file.write('Density of Solid (g/cm3): {:.3f}'.format(self.density))
-                file.write('\n\n')            
-                file.write('Porosity: {:.5e} ± {:.5e}'.format(self.phi[0], self.phi[1]*self.phi[0]))
-                file.write('\n')
-                file.write('Average Pore Volume (cm3): {:.3e} ± {:.3e}'.format(self.Vpore_avg[0], 
-                                                                               self.Vpore_avg[1]*self.Vpore_avg[0]))
-                file.write('\n')
-                file.write('Pore Concentration (cm-3): {:.3e} ± {:.3e}'.format(self.phi_on_Vavg[0], 
-                                                                               self.phi_on_Vavg[1]*self.phi_on_Vavg[0]))
-                file.write('\n')
-                file.write('SSA interpolated to r = {:.2f} nm (cm2/cm3): '
-                           .format(self.r_SSA_extrapolate) +
-                           '{:.3e} ± {:.3e}'.format(self.SSA_extrapolate[0],
-                                                    self.SSA_extrapolate[1]*self.SSA_extrapolate[0]))
-                file.write('\n\n')
-                
-                # Write result table for r vs f(r), SSA(R), and dV/dr
-                file.write('Pore size distribution table\n')
-                file.write('\t\t'.join(['r\t', 'f(r)', 'SSA\t', 'dV/dr', '% error']) + '\n')
-                [file.write('\t'.join(val if isinstance(val, str)
-                                      else '{:.5e}'.format(val) 
-                                      if val > 0 
-                                      else '{:.4e}'.format(val) 
-                                      for val in line) + '\n')
-                 for line in data_table]
+            pc.write_PDSP_result(save_file_dir, self.chosen_data_file_dir.split('/')[-1],
+                                 self.get_fit_parameters(), self.PDSP_result)
             print(f"File saved as {file_name_save} in {self.chosen_save_folder_dir}\n")
+            
+    # Function used to save the loaded data, inputs, kernel and PDSP result 
+    # into a session file, activated from the File menu
+    def save_session_func(self):
+        if self.chosen_data_file_dir == '':
+            self.show_error_message('No data file loaded, nothing to save.')
+            return
+        file_name_save = (pc.result_file_name(self.chosen_data_file_dir)
+                          .replace(' PDSP Result.txt', '.prinsas'))
+        save_folder_dir = self.chosen_save_folder_dir or self.chosen_data_folder_dir
+        options = QtWdgt.QFileDialog.Options()
+        save_file_dir, _ = QtWdgt.QFileDialog.getSaveFileName(self, "Save Session", 
+                                                              save_folder_dir + '/' + file_name_save,
+                                                              "PRINSAS Sessions (*.prinsas);;All Files (*)", options=options)
+        if not save_file_dir:
+            return
+        
+        inputs, arrays, _ = self.get_session_state()
+        kernels = ([] if self.PDSP_result is None else 
+                   sf.fit_kernels(self.QQ_trim, self.pts_per_dec, *self.get_resolution(),
+                                  self.pore_model))
+        try:
+            sf.save_session(save_file_dir, inputs, arrays, self.PDSP_result, kernels)
+        except OSError as e:
+            self.show_error_message(str(e))
+            return
+        print(f"Session saved as {save_file_dir}\n")
+        
+    # Function used to restore a session saved by save_session_func, including
+    # all plots and the PDSP result, without reading the data file or refitting
+    def open_session_func(self):
+        session_file_dir, _ = QtWdgt.QFileDialog.getOpenFileName(self, 
+                                                                 "Open Session", 
+                                                                 self.chosen_data_folder_dir or "", 
+                                                                 "PRINSAS Sessions (*.prinsas)")
+        if not session_file_dir:
+            return
+        try:
+            inputs, arrays, PDSP_result = sf.load_session(session_file_dir)
+        except (ValueError, KeyError) as e:
+            self.show_error_message(f'Cannot read session file: {e}')
+            return
+        missing_variables = [name for name in self.session_variables if name not in inputs]
+        if missing_variables:
+            self.show_error_message(f'Cannot read session file: {missing_variables[0]!r}')
+            return
+        self.store_workspace_state()
+        self.restore_session_state(inputs, arrays, PDSP_result)
+        self.add_workspace_files([self.chosen_data_file_dir], active = True)
+        print(f"Session restored from {session_file_dir}\n")
+        
+    # Return the inputs, data arrays and PDSP result of the shown data file, as
+    # stored in session files and workspace entries
+    def get_session_state(self):
+        inputs = {name: getattr(self, name) for name in self.session_variables}
+        inputs['input_texts'] = {name: getattr(self, name).text() 
+                                 for name in self.session_input_boxes}
+        inputs['dIQ_from_data'] = self.choose_dIQ.buttons()[0].isChecked()
+        inputs['dIQ_from_data_enabled'] = self.choose_dIQ.buttons()[0].isEnabled()
+        inputs['resolution_selected'] = self.resolution_combo_box.currentText()
+        inputs['uncertainty'] = self.uncertainty
+        inputs['pore_model'] = self.pore_model
+        inputs['spline_knots'] = self.spline_knots
+        arrays = {name: getattr(self, name) for name in self.session_arrays}
+        return inputs, arrays, self.PDSP_result
+        
+    # Restore the inputs, data arrays and PDSP result of get_session_state,
+    # including all plots, and the fit history of the restored file
+    def restore_session_state(self, inputs, arrays, PDSP_result, fit_history = ()):
+        for name in self.session_variables:
+            setattr(self, name, inputs[name])
+        for name in self.session_arrays:
+            setattr(self, name, arrays.get(name))
+            
+        # Restore the inputs as displayed when the session was saved
+        for name, text in inputs['input_texts'].items():
+            getattr(self, name).setText(text)
+        self.choose_dIQ.buttons()[0].setEnabled(inputs['dIQ_from_data_enabled'])
+        self.choose_dIQ.buttons()[0 if inputs['dIQ_from_data'] else 1].setChecked(True)
+        self.resolution_combo_box.model().item(1).setEnabled(self.dQ_data is not None)
+        self.resolution_combo_box.setCurrentText(inputs['resolution_selected'])
+        self.set_uncertainty(inputs.get('uncertainty', 'heuristic'))    # older sessions: heuristic
+        self.set_pore_model(inputs.get('pore_model', 'sphere'))         # older sessions: sphere
+        self.set_spline_knots(inputs.get('spline_knots'))
+        for button in self.choose_major_phase.buttons():
+            button.setChecked(button.text().lower() == self.major_phase)
+        self.SSA_label.setText('SSA extrapolated<br>to {:.2f} nm'.format(self.r_SSA_extrapolate) +
+                               ' (cm<sup>2</sup>/cm<sup>3</sup>)')
+        self.file_dir_label.setText(self.chosen_data_file_dir.split('/')[-1])
+        self.fit_history = list(fit_history)
+        self.update_fit_history_box()
+        
+        # Plot the stored data and result
+        bf.clear_plot(self.figure_SAS, self.canvas_SAS)
+        bf.clear_plot(self.figure_SAS_fitted, self.canvas_SAS_fitted)
+        self.clear_result()
+        bf.plot_SANS_data(self.QQ_origin, self.IQ_origin, self.dIQ_origin,
+                          self.figure_SAS, self.canvas_SAS)
+        bf.plot_SANS_subtract(self.QQ_trim, self.IQ_trim, self.QQ_origin, self.bkgrd,
+                              self.figure_SAS, self.canvas_SAS)
+        bf.plot_SANS_fit(self.QQ_trim, self.IQ_trim, self.figure_SAS_fitted, 
+                         self.canvas_SAS_fitted, which = 'input')
+        if PDSP_result is not None:
+            # Keep the result in the fit cache, so it is returned if the
+            # session is refitted with the same inputs
+            pc.cache_fit(self.current_fit_key(), PDSP_result, write_file = False)
+            self.set_result(PDSP_result)
+            self.add_fit_history()
+            self.display_result()
+        else:
+            self.PDSP_result = None
+            self.plot_overlays()
+        
+        # Enable/disable action buttons as after fitting or choosing the file
+        self.confirm_bkgrd_Q_range_button.setEnabled(True)
+        self.preview = None
+        self.preview_check_box.setEnabled(True)
+        self.run_fit_button.setEnabled(PDSP_result is None)
+        self.recalc_PDSP_input_button.setEnabled(PDSP_result is not None)
+        self.save_result_button.setEnabled(PDSP_result is not None)
+
+    # Show a data file: select its workspace entry if it is in the workspace,
+    # otherwise read it and add it to the workspace
+    def open_workspace_file(self, file_dir):
+        file_dirs = [entry['file_dir'] for entry in self.workspace]
+        if file_dir in file_dirs:
+            self.workspace_list.setCurrentRow(file_dirs.index(file_dir))
+            return
+        self.store_workspace_state()
+        if self.load_data_file(file_dir):
+            self.add_workspace_files([file_dir], active = True)
+            
+    # Show the next (step = 1) or previous (step = -1) data file in the folder of
+    # the shown file, activated from the File menu
+    def step_file_func(self, step):
+        if self.chosen_data_file_dir == '':
+            self.show_error_message('No data file loaded, choose a file first.')
+            return
+        try:
+            file_dir = fp.neighbour_file(self.chosen_data_file_dir, step)
+        except OSError as e:
+            self.show_error_message(str(e))
+            return
+        if file_dir is None:
+            print('No {:s} data file in {:s}\n'.format('next' if step > 0 else 'previous',
+                                                       self.chosen_data_folder_dir))
+            return
+        self.open_workspace_file(file_dir)
+            
+    # Add data files to the workspace, activated from the workspace panel and 
+    # the File menu. The files are read when they are selected or fitted
+    def add_files_func(self):
+        file_dirs, _ = QtWdgt.QFileDialog.getOpenFileNames(self, 
+                                                           "Add SANS Data Files", 
+                                                           self.chosen_data_folder_dir or "", 
+                                                           "Text Files (*.txt *.dat *.csv *.ABS)")
+        if file_dirs:
+            self.add_workspace_files(file_dirs)
+            self.workspace_dock.show()
+            
+    # Add workspace entries of the files not in the workspace yet. If active is
+    # set, the entry of the last file becomes the entry of the shown data
+    def add_workspace_files(self, file_dirs, active = False):
+        loaded_file_dirs = [entry['file_dir'] for entry in self.workspace]
+        for file_dir in file_dirs:
+            if file_dir in loaded_file_dirs:
+                continue
+            loaded_file_dirs.append(file_dir)
+            self.workspace.append({'file_dir': file_dir, 'state': None, 'params': None,
+                                   'fit_params': None, 'key': None, 'result': None,
+                                   'plot_data': None, 'future': None, 'error': None})
+            item = QtWdgt.QListWidgetItem()
+            item.setFlags(item.flags() | QtCore.Qt.ItemIsUserCheckable)
+            item.setCheckState(QtCore.Qt.Unchecked)
+            item.setToolTip(file_dir)
+            self.workspace_list.addItem(item)
+            self.update_workspace_item(len(self.workspace) - 1)
+        if active:
+            self.set_workspace_index(loaded_file_dirs.index(file_dirs[-1]))
+        
+    # Set the entry of the shown data file without switching to it
+    def set_workspace_index(self, index):
+        self.workspace_index = index
+        self.workspace_list.blockSignals(True)
+        self.workspace_list.setCurrentRow(-1 if index is None else index)
+        self.workspace_list.blockSignals(False)
+        
+    # Show the name and the fit status of a workspace entry in the list
+    def update_workspace_item(self, index):
+        entry = self.workspace[index]
+        item_text = entry['file_dir'].split('/')[-1]
+        if entry['future'] is not None:
+            item_text += ' (fitting...)'
+        elif entry['error'] is not None:
+            item_text += ' (fit failed)'
+        elif entry['result'] is not None:
+            item_text += ' (\u03D5 = {:.3f})'.format(np.real(entry['result'].phi[0]))
+        self.workspace_list.blockSignals(True)
+        self.workspace_list.item(index).setText(item_text)
+        self.workspace_list.item(index).setToolTip(entry['file_dir'] + 
+                                                   ('' if entry['error'] is None else 
+                                                    '\n' + entry['error']))
+        self.workspace_list.blockSignals(False)
+        
+    # Store the state, fitting parameters and result of the shown data file 
+    # in its workspace entry
+    def store_workspace_state(self):
+        if self.workspace_index is None:
+            return
+        entry = self.workspace[self.workspace_index]
+        entry['state'] = self.get_session_state() + (list(self.fit_history),)
+        entry['params'] = self.get_fit_parameters()
+        if self.PDSP_result is not None:
+            entry['result'], entry['plot_data'] = self.PDSP_result, self.result_data
+            entry['error'] = None
+        self.update_workspace_item(self.workspace_index)
+        
+    # Show the data file of a workspace entry, activated when it is selected in
+    # the workspace panel. The state of the shown file is kept in its entry
+    def select_workspace_entry(self, index):
+        if index < 0 or index == self.workspace_index:
+            return
+        self.store_workspace_state()
+        entry = self.workspace[index]
+        if entry['state'] is not None:
+            self.workspace_index = index
+            self.restore_session_state(*entry['state'])
+        elif self.load_data_file(entry['file_dir']):
+            self.workspace_index = index
+        else:
+            self.set_workspace_index(self.workspace_index)
+            return
+        self.show_workspace_result()
+        self.plot_overlays()
+        
+    # Show the background fit result of the shown workspace entry if no result
+    # is shown and it was fitted with the current data and fitting parameters
+    def show_workspace_result(self):
+        entry = self.workspace[self.workspace_index]
+        if (entry['result'] is not None and self.PDSP_result is None and 
+                entry['key'] == self.current_fit_key()):
+            self.show_fit_result(entry['result'])
+            
+    # Remove the selected entry from the workspace, activated from the 
+    # workspace panel. The shown data file stays shown
+    def remove_workspace_entry_func(self):
+        index = self.workspace_list.currentRow()
+        if index < 0:
+            return
+        entry = self.workspace.pop(index)
+        if entry['future'] is not None:
+            entry['future'].cancel()
+        self.workspace_list.blockSignals(True)
+        self.workspace_list.takeItem(index)
+        self.workspace_list.blockSignals(False)
+        if self.workspace_index == index:
+            self.set_workspace_index(None)
+        elif self.workspace_index is not None:
+            self.set_workspace_index(self.workspace_index - (self.workspace_index > index))
+        self.plot_overlays()
+        
+    # Fit all workspace files in background processes, each with its own
+    # fitting parameters, or the current ones if it has not been shown yet.
+    # Activated from the workspace panel and the Fit menu
+    def fit_workspace_func(self):
+        if not self.workspace:
+            self.show_error_message('No files in the workspace, add files to fit first.')
+            return
+        self.store_workspace_state()
+        if self.workspace_executor is None:
+            self.workspace_executor = concurrent.futures.ProcessPoolExecutor()
+        current_params = self.get_fit_parameters()
+        for index, entry in enumerate(self.workspace):
+            params = current_params if entry['params'] is None else entry['params']
+            if entry['future'] is not None or (entry['result'] is not None and 
+                                               entry['fit_params'] == params):
+                continue
+            entry['fit_params'] = params
+            entry['future'] = self.workspace_executor.submit(bfit.fit_SANS_file_keyed,
+                                                             entry['file_dir'], params)
+            entry['error'] = None
+            self.update_workspace_item(index)
+        self.workspace_timer.start()
+        
+    # Collect the finished background fits of the workspace, activated by the
+    # workspace timer until all fits are done
+    def check_workspace_fits(self):
+        fits_done = False
+        for index, entry in enumerate(self.workspace):
+            if entry['future'] is None or not entry['future'].done():
+                continue
+            future, entry['future'] = entry['future'], None
+            try:
+                entry['key'], QQ_trim, IQ_trim, entry['result'] = future.result()
+            except Exception as e:
+                # Any failure of the worker is shown as the error of the file
+                if isinstance(e, concurrent.futures.BrokenExecutor):
+                    self.workspace_executor = None
+                entry['error'] = str(e) or type(e).__name__
+                print('Cannot fit ' + entry['file_dir'].split('/')[-1] + ': ' + entry['error'])
+            else:
+                entry['plot_data'] = (QQ_trim, IQ_trim)
+                pc.cache_fit(entry['key'], entry['result'], write_file = False)
+                if index == self.workspace_index:
+                    self.show_workspace_result()
+            self.update_workspace_item(index)
+            fits_done = True
+        if all(entry['future'] is None for entry in self.workspace):
+            self.workspace_timer.stop()
+            print('Done fitting the workspace\n')
+        if fits_done:
+            self.plot_overlays()
+            
+    # Overlay the subtracted data and the results of the checked workspace
+    # entries, other than the shown file, in the four plots
+    def plot_overlays(self):
+        data_overlays, fit_overlays, dVdr_overlays, fr_overlays = [], [], [], []
+        for index, entry in enumerate(self.workspace):
+            if (index == self.workspace_index or entry['result'] is None or
+                    self.workspace_list.item(index).checkState() != QtCore.Qt.Checked):
+                continue
+            file_name = entry['file_dir'].split('/')[-1]
+            QQ_trim, IQ_trim = entry['plot_data']
+            PDSP_result = entry['result']
+            data_overlays.append((QQ_trim, IQ_trim, file_name))
+            fit_overlays.append((QQ_trim, PDSP_result.IQ_fitted, file_name))
+            dVdr_overlays.append((PDSP_result.rr, np.real(PDSP_result.dV_dr[:,0]), file_name))
+            fr_overlays.append((PDSP_result.rr, PDSP_result.f_r[:,0], file_name))
+        bf.plot_overlays(data_overlays, self.figure_SAS, self.canvas_SAS, 
+                         reverse_legend = True)
+        bf.plot_overlays(fit_overlays, self.figure_SAS_fitted, self.canvas_SAS_fitted)
+        bf.plot_overlays(dVdr_overlays, self.figure_dVdr, self.canvas_dVdr)
+        bf.plot_overlays(fr_overlays, self.figure_fr_SSA, self.canvas_fr_SSA)
+
+    # Show the dialog searching the catalog of data files, creating it on first
+    # use. Found files are opened or added to the workspace
+    def catalog_func(self):
+        if self.catalog_dialog is None:
+            self.create_catalog_dialog()
+        self.catalog_dialog.show()
+        self.catalog_dialog.raise_()
+        self.search_catalog_func()
+        
+    def create_catalog_dialog(self):
+        self.catalog_dialog = QtWdgt.QDialog(self)
+        self.catalog_dialog.setWindowTitle('Data File Catalog')
+        dialog_layout = QtWdgt.QVBoxLayout(self.catalog_dialog)
+        
+        catalog_layout = QtWdgt.QHBoxLayout()
+        self.catalog_file_label = QtWdgt.QLabel()
+        catalog_layout.addWidget(self.catalog_file_label, 1)
+        for button_text, button_func in (('Choose Catalog...', self.choose_catalog_func),
+                                         ('Index Folder...', self.index_folder_func)):
+            catalog_button = QtWdgt.QPushButton(button_text)
+            catalog_button.clicked.connect(button_func)
+            catalog_layout.addWidget(catalog_button)
+        dialog_layout.addLayout(catalog_layout)
+        
+        # Query of the catalog, see dc.DataCatalog.query
+        query_layout = QtWdgt.QHBoxLayout()
+        self.catalog_query_boxes = {}
+        for name, label, tool_tip in (
+                ('name', 'Name', "File name pattern, e.g. '*.ABS'"),
+                ('text', 'Text', 'Text in the file name or the header, e.g. a DATAFILE= value'),
+                ('Q_from', 'Q from', 'Only files with data from this Q or lower (A<sup>-1</sup>)'),
+                ('Q_to', 'Q to', 'Only files with data up to this Q or higher (A<sup>-1</sup>)'),
+                ('min_points', 'Min. points', 'Only files with at least this number of points')):
+            query_layout.addWidget(QtWdgt.QLabel(label))
+            query_box = QtWdgt.QLineEdit()
+            query_box.setToolTip(tool_tip)
+            query_box.returnPressed.connect(self.search_catalog_func)
+            query_layout.addWidget(query_box)
+            self.catalog_query_boxes[name] = query_box
+        search_button = QtWdgt.QPushButton('Search')
+        search_button.clicked.connect(self.search_catalog_func)
+        query_layout.addWidget(search_button)
+        dialog_layout.addLayout(query_layout)
+        
+        self.catalog_table = QtWdgt.QTableWidget(0, 6)
+        self.catalog_table.setHorizontalHeaderLabels(['File', 'Q min', 'Q max', 'Points',
+                                                      'Header', 'Folder'])
+        self.catalog_table.setEditTriggers(QtWdgt.QAbstractItemView.NoEditTriggers)
+        self.catalog_table.setSelectionBehavior(QtWdgt.QAbstractItemView.SelectRows)
+        self.catalog_table.verticalHeader().hide()
+        self.catalog_table.setMinimumSize(round(1200*self.scale), round(500*self.scale))
+        self.catalog_table.cellDoubleClicked.connect(self.open_catalog_file_func)
+        dialog_layout.addWidget(self.catalog_table)
+        
+        button_layout = QtWdgt.QHBoxLayout()
+        self.catalog_status_label = QtWdgt.QLabel()
+        button_layout.addWidget(self.catalog_status_label, 1)
+        for button_text, button_func in (('Open', self.open_catalog_file_func),
+                                         ('Add to Workspace', self.add_catalog_files_func)):
+            catalog_button = QtWdgt.QPushButton(button_text)
+            catalog_button.clicked.connect(button_func)
+            button_layout.addWidget(catalog_button)
+        dialog_layout.addLayout(button_layout)
+        
+        # Folders are indexed in a background thread, polled by the timer, so
+        # the UI is not blocked while the files are parsed
+        self.catalog_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        self.catalog_timer = QtCore.QTimer(self)
+        self.catalog_timer.setInterval(200)
+        self.catalog_timer.timeout.connect(self.check_catalog_index)
+        self.update_catalog_label()
+        
+    def update_catalog_label(self):
+        self.catalog_file_label.setText('Catalog: ' + (self.catalog_file_dir or 
+                                                       'none, choose a catalog file'))
+        
+    # Choose the catalog file, which is created if it does not exist
+    def choose_catalog_func(self):
+        catalog_file_dir, _ = QtWdgt.QFileDialog.getSaveFileName(
+            self, "Choose Catalog", self.catalog_file_dir or 
+            ((self.chosen_data_folder_dir or '.') + '/' + dc.default_catalog_name),
+            "Catalog Files (*.sqlite);;All Files (*)",
+            options = QtWdgt.QFileDialog.DontConfirmOverwrite)
+        if catalog_file_dir:
+            self.catalog_file_dir = catalog_file_dir
+            QtCore.QSettings("henry@pnhvu.com", "PRINSAS 2.0").setValue("catalog file",
+                                                                        catalog_file_dir)
+            self.update_catalog_label()
+            self.search_catalog_func()
+            
+    # Index a folder and its subfolders into the catalog in the background.
+    # Only new and changed files are parsed
+    def index_folder_func(self):
+        if self.catalog_future is not None:
+            self.show_error_message('A folder is being indexed, wait for it to finish.')
+            return
+        if not self.catalog_file_dir:
+            self.choose_catalog_func()
+            if not self.catalog_file_dir:
+                return
+        folder_dir = QtWdgt.QFileDialog.getExistingDirectory(self, "Index Folder", 
+                                                             self.chosen_data_folder_dir or "")
+        if folder_dir:
+            self.catalog_future = self.catalog_executor.submit(dc.index_folders,
+                                                               self.catalog_file_dir,
+                                                               [folder_dir])
+            self.catalog_status_label.setText('Indexing ' + folder_dir + '...')
+            self.catalog_timer.start()
+            
+    # Show the catalog once the background indexing is done, activated by the
+    # catalog timer
+    def check_catalog_index(self):
+        if not self.catalog_future.done():
+            return
+        self.catalog_timer.stop()
+        future, self.catalog_future = self.catalog_future, None
+        try:
+            num_indexed, num_unchanged, num_removed = future.result()
+        except (ValueError, OSError, sqlite3.Error, 
+                concurrent.futures.BrokenExecutor) as e:
+            self.catalog_status_label.setText('')
+            self.show_error_message(str(e))
+            return
+        print(f"{num_indexed} files indexed, {num_unchanged} unchanged and {num_removed} "
+              f"removed in {self.catalog_file_dir}\n")
+        self.search_catalog_func()
+            
+    # List the files of the catalog matching the query
+    def search_catalog_func(self):
+        if not self.catalog_file_dir or self.catalog_future is not None:
+            return
+        try:
+            conditions = {}
+            for name, query_box in self.catalog_query_boxes.items():
+                text = query_box.text().strip()
+                if text:
+                    conditions[name] = (text if name in ('name', 'text') else
+                                        int(text) if name == 'min_points' else float(text))
+            entries = dc.query_catalog(self.catalog_file_dir, limit = dc.query_limit,
+                                       **conditions)
+        except (ValueError, sqlite3.Error) as e:
+            self.catalog_status_label.setText(str(e))
+            self.catalog_table.setRowCount(0)
+            return
+        
+        self.catalog_table.setRowCount(len(entries))
+        for row, entry in enumerate(entries):
+            header = ', '.join(key + '=' + str(entry[column]) 
+                               for column, key in dc.header_columns.items()
+                               if entry[column] is not None)
+            for col, text in enumerate((entry['file_name'], '{:.4g}'.format(entry['Qmin']),
+                                        '{:.4g}'.format(entry['Qmax']), 
+                                        str(entry['num_points']), header, entry['folder'])):
+                item = QtWdgt.QTableWidgetItem(text)
+                item.setData(QtCore.Qt.UserRole, entry['path'])
+                item.setToolTip(dc.describe_entry(entry))
+                self.catalog_table.setItem(row, col, item)
+        self.catalog_table.resizeColumnsToContents()
+        self.catalog_status_label.setText(
+            f'{len(entries)} files found' + 
+            (f', showing the first {dc.query_limit}' if len(entries) == dc.query_limit else ''))
+        
+    # Return the files of the selected rows of the catalog table
+    def selected_catalog_files(self):
+        rows = sorted({index.row() for index in self.catalog_table.selectedIndexes()})
+        return [self.catalog_table.item(row, 0).data(QtCore.Qt.UserRole) for row in rows]
+        
+    # Open the first selected file of the catalog table, as the Choose File button
+    def open_catalog_file_func(self):
+        file_dirs = self.selected_catalog_files()
+        if file_dirs:
+            self.open_workspace_file(file_dirs[0])
+            
+    # Add the selected files of the catalog table to the workspace
+    def add_catalog_files_func(self):
+        file_dirs = self.selected_catalog_files()
+        if file_dirs:
+            self.add_workspace_files(file_dirs)
+            self.workspace_dock.show()
+
+    # Return the fit cache key (see pc.fit_key) of fitting the current data with
+    # the confirmed fitting parameters
+    def current_fit_key(self):
+        return pc.fit_key(self.QQ_trim, self.IQ_trim, self.dIQ_trim,
+                          self.pts_per_dec, self.lambda_, self.contrast,
+                          self.density, self.r_SSA_extrapolate,
+                          self.num_pts_SSA_extrapolate, self.major_phase,
+                          *self.get_resolution(), uncertainty = self.uncertainty,
+                          pore_model = self.pore_model, spline_knots = self.spline_knots)
+        
+    # Return the confirmed fitting parameters in the format of 
+    # pc.default_fit_parameters, as used by the batch fitting routines
+    def get_fit_parameters(self):
+        return {'bkgrd': self.bkgrd, 'Qmin': self.Qmin, 'Qmax': self.Qmax,
+                'dIQ_percent': (None if self.choose_dIQ.buttons()[0].isChecked()
+                                else self.IQ_percent_dIQ),
+                'pts_per_dec': self.pts_per_dec, 'lambda_': self.lambda_,
+                'lambda_auto': None, 'resolution': self.resolution, 'slit_length': self.slit_length,
+                'contrast': self.contrast, 'density': self.density,
+                'r_SSA_extrapolate': self.r_SSA_extrapolate,
+                'num_pts_SSA_extrapolate': self.num_pts_SSA_extrapolate,
+                'major_phase': self.major_phase, 'uncertainty': self.uncertainty,
+                'pore_model': self.pore_model, 'spline_knots': self.spline_knots}
 
     # Function used for creating tool tips for inputs and results
     def make_tool_tip(self, tool_tip_message):
@@ -1125,6 +2369,12 @@ class PRINSAS_App(QtWdgt.QMainWindow):
         msg_box.exec_()
             
 if __name__ == "__main__":
+    # Worker processes of the frozen executable start here, not in the GUI
+    multiprocessing.freeze_support()
+
+    # Keep fit results between sessions if a fit cache folder is given
+    if os.environ.get('PRINSAS_FIT_CACHE_DIR'):
+        pc.set_fit_cache_dir(os.environ['PRINSAS_FIT_CACHE_DIR'])
     app = QtWdgt.QApplication(sys.argv)
     main_window = PRINSAS_App()
     main_window.show()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Session files of PRINSAS 2.0 (.prinsas), holding the loaded SAS data, the
+fitting inputs, the kernel of the fit and the PDSP result, so that a session
+reopens with its plots and results without reading the data file again or
+refitting.
+
+A session file is a compressed numpy .npz container. The inputs are stored as
+a JSON string, arrays and the PDSP result block are stored as binary arrays,
+and no pickled objects are used, so loading a session never executes code.
+"""
+
+import json
+import numpy as np
+import PDSP_core as pc
+
+
+# Version of the session file format, increased on incompatible changes
+session_version = 1
+
+
+# Return the kernel used to fit the given data as a list of (key, kernel),
+# or an empty list if the kernel is no longer in the kernel cache
+def fit_kernels(QQ, pts_per_dec, dQ = None, slit_length = None, pore_model = 'sphere'):
+    logR_del = 1/pts_per_dec
+    logR_1D, _ = pc.calc_r_grid(QQ, logR_del)
+    key = pc.kernel_key(logR_1D, logR_del, QQ, dQ, slit_length, pore_model)
+    with pc.kernel_cache_lock:
+        return [(key, pc.kernel_cache[key][0])] if key in pc.kernel_cache else []
+
+
+# Write a session file.
+#   inputs: dict of JSON-serialisable inputs (numbers, strings, lists)
+#   arrays: dict of arrays, entries that are None are not stored
+#   PDSP_result: PDSP result of the session, or None if not fitted
+#   kernels: list of (key, kernel) added to the kernel cache when loaded
+def save_session(session_file_dir, inputs, arrays, PDSP_result = None, kernels = ()):
+    contents = {'session_version': np.array(session_version),
+                'inputs': np.array(json.dumps(inputs))}
+    for name, arr in arrays.items():
+        if arr is not None:
+            contents['array_' + name] = np.asarray(arr)
+    if PDSP_result is not None:
+        contents['result_block'] = PDSP_result.block
+        contents['result_shape'] = np.array([len(PDSP_result.rr),
+                                             len(PDSP_result.IQ_fitted)])
+    for i, (key, kernel) in enumerate(kernels):
+        contents[f'kernel_{i}_' + key] = np.asarray(kernel)
+
+    # Written into an open file, so np.savez does not append '.npz' to the
+    # chosen file name
+    with open(session_file_dir, 'wb') as file:
+        np.savez_compressed(file, **contents)
+
+
+# Read a session file written by save_session and add its kernels to the
+# kernel cache. Return inputs, arrays and the PDSP result (None if the session
+# was not fitted), fitted with the pore model inputs['pore_model'] (sphere for
+# older sessions). Arrays not stored in the session are returned as None by
+# arrays.get
+def load_session(session_file_dir):
+    try:
+        with np.load(session_file_dir, allow_pickle = False) as session:
+            if int(session['session_version']) > session_version:
+                raise ValueError('Session file was written by a newer version of PRINSAS')
+            inputs = json.loads(str(session['inputs']))
+            arrays, PDSP_result = {}, None
+            for name in session.files:
+                if name.startswith('array_'):
+                    arr = session[name]
+                    arrays[name[len('array_'):]] = arr[()] if arr.ndim == 0 else arr
+                elif name.startswith('kernel_'):
+                    pc.cache_kernel(name.split('_', 2)[2], session[name])
+            if 'result_block' in session.files:
+                PDSP_result = pc.PDSPResult(session['result_block'],
+                                            *session['result_shape'],
+                                            pore_model = inputs.get('pore_model', 'sphere'))
+    except (KeyError, OSError, EOFError) as e:
+        raise ValueError('Cannot read session file: ' + str(e))
+    return inputs, arrays, PDSP_result
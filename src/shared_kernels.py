@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Distribution of PDSP kernels to worker processes. The parent process publishes
+each kernel once as a memory-mapped .npy file named by the kernel hash, and
+workers attach to it read-only and zero-copy, so the memory and start-up cost
+per worker does not grow with the number of workers. On Linux the files are
+placed in /dev/shm, so the kernels are held in shared memory.
+"""
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+# Directory searched for published kernels by this process, and the kernels
+# already attached from it
+shared_kernel_dir = None
+attached_kernels = {}
+
+
+# Class used by the parent process to publish kernels for worker processes.
+# The published kernels are removed when the store is closed.
+class SharedKernelStore:
+    def __init__(self, kernel_dir = None):
+        self.owns_dir = kernel_dir is None
+        if self.owns_dir:
+            shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            kernel_dir = tempfile.mkdtemp(prefix = 'PRINSAS_kernels_', dir = shm_dir)
+        self.kernel_dir = kernel_dir
+        self.published = set()
+
+    # Write the kernel to the store under its hash, unless already published
+    def publish(self, key, kernel):
+        if key in self.published:
+            return
+        write_kernel_file(self.kernel_dir, key, kernel)
+        self.published.add(key)
+
+    def close(self):
+        if self.owns_dir:
+            shutil.rmtree(self.kernel_dir, ignore_errors = True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Return the file path of the kernel with the given hash
+def kernel_file_dir(kernel_dir, key):
+    return os.path.join(kernel_dir, key + '.npy')
+
+
+# Write a kernel file into kernel_dir, unless it exists. The file is written
+# under a temporary name unique to this process and then renamed, so processes
+# never attach to a partially written kernel, and several processes may
+# publish the same kernel at the same time
+def write_kernel_file(kernel_dir, key, kernel):
+    kernel_file = kernel_file_dir(kernel_dir, key)
+    if not os.path.exists(kernel_file):
+        tmp_file = kernel_file + '.{:d}.tmp.npy'.format(os.getpid())
+        np.save(tmp_file, np.ascontiguousarray(kernel))
+        os.replace(tmp_file, kernel_file)
+
+
+# Publish a kernel calculated by this process into the directory of published
+# kernels, so that other processes attached to the same directory can reuse
+# it. Does nothing if no directory has been set
+def publish_kernel(key, kernel):
+    if shared_kernel_dir is None or key in attached_kernels:
+        return
+    write_kernel_file(shared_kernel_dir, key, kernel)
+
+
+# Set the directory of published kernels for this process. Used as the
+# initializer of worker pools, e.g.
+# ProcessPoolExecutor(initializer = set_shared_kernel_dir, initargs = (store.kernel_dir,))
+def set_shared_kernel_dir(kernel_dir):
+    global shared_kernel_dir
+    shared_kernel_dir = kernel_dir
+    attached_kernels.clear()
+
+
+# Return the published kernel with the given hash as a read-only memory-mapped
+# array, or None if no such kernel has been published
+def attach_kernel(key):
+    if key in attached_kernels:
+        return attached_kernels[key]
+    if shared_kernel_dir is None:
+        return None
+    kernel_file = kernel_file_dir(shared_kernel_dir, key)
+    if not os.path.exists(kernel_file):
+        return None
+    kernel = np.load(kernel_file, mmap_mode = 'r')
+    attached_kernels[key] = kernel
+    return kernel